@@ -0,0 +1,281 @@
+from __future__ import division, print_function
+import h5py
+import numpy as np
+
+
+def get_columnar_paths(path_prefix):
+    """ :return: paths of the tweet times and of the index of the columnar store """
+    return path_prefix + 'tweet_times.npy', path_prefix + 'tweet_index.npz'
+
+
+class ColumnarLoader:
+    """
+    Tweet times of all the users in a single column.
+
+    The times file holds the tweet times of all the users, in increasing user id order and sorted within each
+    user; the tweets of the i-th user of the index are times[offsets[i]:offsets[i + 1]]. The file is memory-mapped
+    so get_tweets returns a read-only view without reading or sorting anything. It only stores tweets, so it
+    replaces HDFSLoader in the repositories taking the links from elsewhere (HDFSSQLiteUserRepository and
+    CSRUserRepository).
+    """
+
+    def __init__(self, path_prefix=None, mmap_mode='r'):
+        if path_prefix is None:
+            path_prefix = '/dev/shm/'
+        times_path, index_path = get_columnar_paths(path_prefix)
+
+        self._times = np.load(times_path, mmap_mode=mmap_mode)
+        with np.load(index_path) as index:
+            self._user_ids = index['user_ids']
+            self._offsets = index['offsets']
+
+    def __len__(self):
+        return len(self._user_ids)
+
+    def __contains__(self, user_id):
+        return self._find(user_id) >= 0
+
+    def _find(self, user_id):
+        i = np.searchsorted(self._user_ids, user_id)
+        if i < len(self._user_ids) and self._user_ids[i] == user_id:
+            return i
+        return -1
+
+    def user_ids(self):
+        return self._user_ids
+
+    def close(self):
+        """ Drops the times, which are unmapped once the views given out are gone """
+        self._times = None
+
+    def get_tweets(self, user_id):
+        """ :return: sorted tweet times of the user, empty for unknown users """
+        i = self._find(user_id)
+        if i < 0:
+            return self._times[:0]
+        return self._times[self._offsets[i]:self._offsets[i + 1]]
+
+    def iter_tweets(self, user_id):
+        """ Yields the tweet times of the user in time order, paged in from the memory-mapped file """
+        return iter(self.get_tweets(user_id))
+
+
+def _iter_hdf5_users(h5f):
+    """ Yields (user_id, tweets dataset) of the XXXX/YYYY groups (see hdfs.get_group) having tweets """
+    for high in h5f:
+        for low in h5f[high]:
+            group = h5f[high][low]
+            if 'tweets' in group:
+                yield int(high + low), group['tweets']
+
+
+def convert_hdf5_tweets(path_prefix, h5_path=None):
+    """
+    One-time conversion of the tweets of tweets_all.h5 to the columnar store at path_prefix.
+    """
+    if h5_path is None:
+        h5_path = '/dev/shm/tweets_all.h5'
+    times_path, index_path = get_columnar_paths(path_prefix)
+
+    with h5py.File(h5_path, 'r') as h5f:
+        users = sorted((user_id, tweets.name, tweets.shape[0]) for user_id, tweets in _iter_hdf5_users(h5f))
+
+        offsets = np.zeros(len(users) + 1, dtype=np.int64)
+        np.cumsum([count for _, _, count in users], out=offsets[1:])
+
+        times = np.lib.format.open_memmap(times_path, mode='w+', dtype=np.int64, shape=(offsets[-1],))
+        for i, (_, name, _) in enumerate(users):
+            user_times = times[offsets[i]:offsets[i + 1]]
+            user_times[:] = h5f[name][:]
+            user_times.sort()
+        times.flush()
+        del times
+
+    np.savez(index_path, user_ids=np.array([user_id for user_id, _, _ in users], dtype=np.int64), offsets=offsets)
+
+
+def get_encoded_paths(path_prefix):
+    """ :return: paths of the encoded tweet times and of the index of the delta-encoded store """
+    return path_prefix + 'tweet_times_varint.npy', path_prefix + 'tweet_index_varint.npz'
+
+
+def _varint_lengths(values):
+    lengths = np.ones(len(values), dtype=np.int64)
+    for j in range(1, 10):
+        lengths += values >= (np.uint64(1) << np.uint64(7 * j))
+    return lengths
+
+
+def encode_varints(values):
+    """
+    LEB128 encoding of non-negative integers: 7 bits per byte, low bits first, with the high bit set on all the
+    bytes of a value but the last.
+
+    :return: uint8 array
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = _varint_lengths(values)
+    starts = np.zeros(len(values), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+
+    data = np.zeros(lengths.sum(), dtype=np.uint8)
+    for j in range(lengths.max() if len(values) else 0):
+        mask = lengths > j
+        byte = (values[mask] >> np.uint64(7 * j)) & np.uint64(0x7f)
+        byte |= np.where(lengths[mask] > j + 1, np.uint64(0x80), np.uint64(0))
+        data[starts[mask] + j] = byte
+    return data
+
+
+def decode_varints(data):
+    """ :return: int64 array of the values encoded by encode_varints """
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.zeros(len(ends), dtype=np.int64)
+    starts[1:] = ends[:-1] + 1
+
+    # position of every byte in its value
+    shifts = np.arange(len(data), dtype=np.int64)
+    shifts -= np.repeat(starts, ends - starts + 1)
+    shifts *= 7
+
+    parts = (data & 0x7f).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.add.reduceat(parts, starts).astype(np.int64)
+
+
+def _time_deltas(times, offsets):
+    """ :return: gap of each tweet time to the previous tweet of the same user, the first one being kept as is """
+    times = np.asarray(times, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+
+    deltas = np.empty_like(times)
+    deltas[:1] = times[:1]
+    np.subtract(times[1:], times[:-1], out=deltas[1:])
+    firsts = offsets[:-1][offsets[:-1] < offsets[1:]]
+    deltas[firsts] = times[firsts]
+    if np.any(deltas < 0):
+        raise ValueError('Tweet times must be non-negative and sorted within each user')
+    return deltas
+
+
+def _user_byte_offsets(deltas, offsets):
+    """ :return: offsets of the encoded bytes of the users, from the deltas of their times """
+    byte_offsets = np.zeros(len(deltas) + 1, dtype=np.int64)
+    np.cumsum(_varint_lengths(deltas.astype(np.uint64)), out=byte_offsets[1:])
+    return byte_offsets[offsets]
+
+
+def encode_times(times, offsets):
+    """
+    Delta encoding of the sorted tweet times of several users: each time is replaced by its gap to the previous
+    tweet of the same user (the first one is kept as is) and the gaps are varint-encoded.
+
+    :param offsets: the tweets of the i-th user are times[offsets[i]:offsets[i + 1]]
+    :return: (encoded bytes, byte offsets of the users)
+    """
+    deltas = _time_deltas(times, offsets)
+    return encode_varints(deltas), _user_byte_offsets(deltas, offsets)
+
+
+def decode_times(data):
+    """ :return: int64 tweet times of one user from its encoded bytes """
+    return np.cumsum(decode_varints(data))
+
+
+class EncodedColumnarLoader:
+    """
+    Delta-encoded columnar store (see encode_columnar_store), read whole into memory and decoded per user.
+    Tweet gaps mostly fit in one or two bytes, against eight for the raw times.
+    """
+
+    def __init__(self, path_prefix=None):
+        if path_prefix is None:
+            path_prefix = '/dev/shm/'
+        data_path, index_path = get_encoded_paths(path_prefix)
+
+        self._data = np.load(data_path)
+        with np.load(index_path) as index:
+            self._user_ids = index['user_ids']
+            self._byte_offsets = index['byte_offsets']
+
+    def __len__(self):
+        return len(self._user_ids)
+
+    def __contains__(self, user_id):
+        return self._find(user_id) >= 0
+
+    def _find(self, user_id):
+        i = np.searchsorted(self._user_ids, user_id)
+        if i < len(self._user_ids) and self._user_ids[i] == user_id:
+            return i
+        return -1
+
+    def user_ids(self):
+        return self._user_ids
+
+    def close(self):
+        self._data = None
+
+    def get_tweets(self, user_id):
+        """ :return: sorted tweet times of the user, empty for unknown users """
+        i = self._find(user_id)
+        if i < 0:
+            return np.zeros(0, dtype=np.int64)
+        return decode_times(self._data[self._byte_offsets[i]:self._byte_offsets[i + 1]])
+
+    def iter_tweets(self, user_id):
+        return iter(self.get_tweets(user_id))
+
+
+def _iter_user_chunks(offsets, chunk_size):
+    """
+    Yields (start, end) such that the users start:end have at most chunk_size tweets together, or are one user
+    having more
+    """
+    user_count = len(offsets) - 1
+    start = 0
+    while start < user_count:
+        end = np.searchsorted(offsets, offsets[start] + chunk_size, side='right') - 1
+        end = min(max(end, start + 1), user_count)
+        yield start, end
+        start = end
+
+
+def encode_columnar_store(in_path_prefix, out_path_prefix=None, chunk_size=1 << 22):
+    """
+    Writes the delta-encoded version of the columnar store at in_path_prefix.
+
+    The users are encoded chunk_size tweets at a time, in two passes over the memory-mapped times: the first one
+    sizes the encoded bytes of every user, the second one writes the encoded chunks to the memory-mapped output,
+    so the temporaries never hold more than a chunk of tweets.
+    """
+    if out_path_prefix is None:
+        out_path_prefix = in_path_prefix
+    times_path, index_path = get_columnar_paths(in_path_prefix)
+    data_path, encoded_index_path = get_encoded_paths(out_path_prefix)
+
+    times = np.load(times_path, mmap_mode='r')
+    with np.load(index_path) as index:
+        user_ids, offsets = index['user_ids'], index['offsets']
+
+    def chunk_deltas(start, end):
+        return _time_deltas(times[offsets[start]:offsets[end]], offsets[start:end + 1] - offsets[start])
+
+    byte_offsets = np.zeros(len(offsets), dtype=np.int64)
+    for start, end in _iter_user_chunks(offsets, chunk_size):
+        chunk_offsets = _user_byte_offsets(chunk_deltas(start, end), offsets[start:end + 1] - offsets[start])
+        byte_offsets[start + 1:end + 1] = byte_offsets[start] + chunk_offsets[1:]
+
+    if byte_offsets[-1] == 0:
+        np.save(data_path, np.zeros(0, dtype=np.uint8))
+    else:
+        data = np.lib.format.open_memmap(data_path, mode='w+', dtype=np.uint8, shape=(byte_offsets[-1],))
+        for start, end in _iter_user_chunks(offsets, chunk_size):
+            data[byte_offsets[start]:byte_offsets[end]] = encode_varints(chunk_deltas(start, end))
+        data.flush()
+        del data
+
+    np.savez(encoded_index_path, user_ids=user_ids, byte_offsets=byte_offsets)
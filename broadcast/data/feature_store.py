@@ -0,0 +1,185 @@
+from __future__ import division, print_function
+import numpy as np
+import os
+import time
+from os.path import basename, dirname, isfile, getmtime, join
+
+
+def get_store_paths(path_prefix, month, period_length):
+    """
+    :return: paths of the features and of the index of the store of (month, period_length); the features of a
+             store written by write_feature_store are in the versioned file named by its index instead
+    """
+    name = '%sfeatures_%02d_%03d' % (path_prefix, month, period_length)
+    return name + '.npy', name + '_index.npz'
+
+
+def _read_index(index_path, features_path):
+    """ :return: (user ids, offsets, path of the features) of the index """
+    with np.load(index_path) as index:
+        if 'features' in index:
+            features_path = join(dirname(index_path), str(index['features']))
+        return index['user_ids'], index['offsets'], features_path
+
+
+class FollowerFeatureStore:
+    """
+    Follower matrices of all the users of one (month, period_length) in a single file.
+
+    The features file holds a (2, N, period_length) array where N is the total number of followers; the
+    followers of the i-th user of the index are the rows offsets[i]:offsets[i + 1], with their wall intensities
+    in features[0] and their connection probabilities in features[1]. The file is memory-mapped, so processes
+    opening the same store share its pages.
+
+    The index names the features file it goes with, so a store rebuilt while it is being opened is never read
+    with the index of another version: if the features named by the index have been removed in between, or do
+    not have as many followers as the index (stores written before the index named its features), the index is
+    read again.
+    """
+
+    def __init__(self, path_prefix, month, period_length=24, mmap_mode='r', attempts=3):
+        features_path, index_path = get_store_paths(path_prefix, month, period_length)
+
+        for attempt in range(attempts):
+            if attempt > 0:
+                time.sleep(0.1)
+            self._user_ids, self._offsets, path = _read_index(index_path, features_path)
+            try:
+                self._features = np.load(path, mmap_mode=mmap_mode)
+            except IOError:
+                # removed by a rebuild since the index was read
+                continue
+            if self._features.shape[1] == self._offsets[-1]:
+                return
+        raise ValueError('the features of %s do not match its index' % index_path)
+
+    def __len__(self):
+        return len(self._user_ids)
+
+    def __contains__(self, user_id):
+        return self._find(user_id) >= 0
+
+    def _find(self, user_id):
+        i = np.searchsorted(self._user_ids, user_id)
+        if i < len(self._user_ids) and self._user_ids[i] == user_id:
+            return i
+        return -1
+
+    def user_ids(self):
+        return self._user_ids
+
+    def follower_count(self, user_id):
+        i = self._find(user_id)
+        if i < 0:
+            raise KeyError(user_id)
+        return self._offsets[i + 1] - self._offsets[i]
+
+    def get(self, user_id):
+        """
+        :return: (wall intensities, connection probabilities) of the followers of the user, as read-only views
+        """
+        i = self._find(user_id)
+        if i < 0:
+            raise KeyError(user_id)
+
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return self._features[0, start:end], self._features[1, start:end]
+
+
+def write_feature_store(path_prefix, month, period_length, user_ids, load):
+    """
+    Writes the store of (month, period_length).
+
+    :param user_ids: users to put in the store
+    :param load: function returning the (wall intensities, connection probabilities) of a user, or None to skip
+                 the user; it is called twice per user, so it should be cheap (e.g. memory-mapped)
+    """
+    features_path, index_path = get_store_paths(path_prefix, month, period_length)
+    user_ids = np.unique(np.asarray(user_ids, dtype=np.int64))
+
+    # the features go to a new file named by the index, which is written aside and renamed: the rename switches
+    # readers to the new features and index at once, and processes reading the previous store keep their mapping
+    new_features_path = '%s.%d.%d.npy' % (features_path[:-len('.npy')], int(time.time() * 1e6), os.getpid())
+    tmp_index_path = index_path + '.tmp'
+    old_features_path = _read_index(index_path, features_path)[2] if isfile(index_path) else None
+
+    stored_ids, counts = [], []
+    for user_id in user_ids:
+        data = load(user_id)
+        if data is not None:
+            stored_ids.append(user_id)
+            counts.append(data[0].shape[0])
+
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    features = np.lib.format.open_memmap(new_features_path, mode='w+', dtype=np.double,
+                                         shape=(2, offsets[-1], period_length))
+    for i, user_id in enumerate(stored_ids):
+        wall, conn = load(user_id)
+        features[0, offsets[i]:offsets[i + 1]] = wall
+        features[1, offsets[i]:offsets[i + 1]] = conn
+    features.flush()
+    del features
+
+    with open(tmp_index_path, 'wb') as f:
+        np.savez(f, user_ids=np.array(stored_ids, dtype=np.int64), offsets=offsets,
+                 features=basename(new_features_path))
+    os.rename(tmp_index_path, index_path)
+
+    if old_features_path is not None and isfile(old_features_path):
+        os.remove(old_features_path)
+
+
+def consolidate_feature_files(in_path_prefix, out_path_prefix, month, user_ids, period_length=24):
+    """
+    Builds the store from the per-user %08d_%02d_wall.npy and %08d_%02d_conn.npy files, skipping missing users.
+    """
+    def load(user_id):
+        wall_path = '%s%08d_%02d_wall.npy' % (in_path_prefix, user_id, month)
+        conn_path = '%s%08d_%02d_conn.npy' % (in_path_prefix, user_id, month)
+        if not (isfile(wall_path) and isfile(conn_path)):
+            return None
+        return np.load(wall_path, mmap_mode='r'), np.load(conn_path, mmap_mode='r')
+
+    write_feature_store(out_path_prefix, month, period_length, user_ids, load)
+
+
+_open_stores = {}  # (path_prefix, month, period_length) -> ((inode, modification time) of the index, store)
+
+
+def _get_store(path_prefix, month, period_length):
+    """
+    :return: (store, time at which it was built) of (month, period_length), reopened when it has been rebuilt since
+             it was opened (its index is then a new file), or (None, None) if it has not been built
+    """
+    key = (path_prefix, month, period_length)
+    features_path, index_path = get_store_paths(path_prefix, month, period_length)
+    if not isfile(index_path):
+        _open_stores.pop(key, None)
+        return None, None
+
+    stat = os.stat(index_path)
+    version = (stat.st_ino, stat.st_mtime)
+    if key not in _open_stores or _open_stores[key][0] != version:
+        _open_stores[key] = (version, FollowerFeatureStore(path_prefix, month, period_length))
+    return _open_stores[key][1], stat.st_mtime
+
+
+def load_follower_features(path_prefix, user_id, month, period_length=24):
+    """
+    Follower matrices of the user, read from the store of (month, period_length) if it has been built and contains
+    the user, unless the per-user files have been rewritten since (e.g. by a later fetch), or else from the per-user
+    files. Each store is opened once per process, and again when it is rebuilt.
+
+    :return: (wall intensities, connection probabilities)
+    """
+    wall_path = '%s%08d_%02d_wall.npy' % (path_prefix, user_id, month)
+    conn_path = '%s%08d_%02d_conn.npy' % (path_prefix, user_id, month)
+
+    store, built = _get_store(path_prefix, month, period_length)
+    if store is not None and user_id in store:
+        if not any(isfile(path) and getmtime(path) > built for path in [wall_path, conn_path]):
+            return store.get(user_id)
+
+    return np.load(wall_path), np.load(conn_path)
@@ -0,0 +1,112 @@
+from __future__ import division, print_function
+import os
+import sqlite3
+import numpy as np
+
+_arrays = ['node_ids', 'out_indptr', 'out_indices', 'in_indptr', 'in_indices']
+
+
+class CSRGraph:
+    """
+    Follow graph in compressed sparse row form for both directions.
+
+    node_ids holds the sorted ids of all the users with a link. The followees of the i-th of them are
+    out_indices[out_indptr[i]:out_indptr[i + 1]] and its followers in_indices[in_indptr[i]:in_indptr[i + 1]], both
+    stored as sorted user ids, so lookups are slices of the arrays. Loaded with load_csr_graph, the arrays are
+    memory-mapped and shared by all the processes using the same graph.
+    """
+
+    def __init__(self, node_ids, out_indptr, out_indices, in_indptr, in_indices):
+        self.node_ids = node_ids
+        self.out_indptr = out_indptr
+        self.out_indices = out_indices
+        self.in_indptr = in_indptr
+        self.in_indices = in_indices
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def _find(self, user_id):
+        i = np.searchsorted(self.node_ids, user_id)
+        if i < len(self.node_ids) and self.node_ids[i] == user_id:
+            return i
+        return -1
+
+    def followees(self, user_id):
+        i = self._find(user_id)
+        if i < 0:
+            return self.out_indices[:0]
+        return self.out_indices[self.out_indptr[i]:self.out_indptr[i + 1]]
+
+    def followers(self, user_id):
+        i = self._find(user_id)
+        if i < 0:
+            return self.in_indices[:0]
+        return self.in_indices[self.in_indptr[i]:self.in_indptr[i + 1]]
+
+    def _degrees(self, indptr, user_ids):
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        if len(self.node_ids) == 0:
+            return np.zeros(user_ids.shape, dtype=np.int64)
+
+        i = np.minimum(np.searchsorted(self.node_ids, user_ids), len(self.node_ids) - 1)
+        counts = indptr[i + 1] - indptr[i]
+        return np.where(self.node_ids[i] == user_ids, counts, 0)
+
+    def followee_counts(self, user_ids):
+        """ :return: number of followees of each of the users, zero for unknown users """
+        return self._degrees(self.out_indptr, user_ids)
+
+    def follower_counts(self, user_ids):
+        """ :return: number of followers of each of the users, zero for unknown users """
+        return self._degrees(self.in_indptr, user_ids)
+
+    def save(self, path):
+        """ Saves the arrays as .npy files in the directory path """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in _arrays:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+
+def _csr(node_ids, sources, targets):
+    order = np.lexsort((targets, sources))
+    counts = np.bincount(np.searchsorted(node_ids, sources), minlength=len(node_ids))
+
+    indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, targets[order]
+
+
+def build_csr_graph(links_path=None, chunk_size=1000000):
+    """
+    Builds the graph from the links table (ida follows idb) of links.sqlite3.
+    """
+    if links_path is None:
+        links_path = '/dev/shm/links.sqlite3'
+
+    con = sqlite3.connect(links_path)
+    try:
+        cur = con.cursor().execute('select ida, idb from links')
+        chunks = []
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunks.append(np.array(rows, dtype=np.int64).reshape((-1, 2)))
+    finally:
+        con.close()
+
+    links = np.concatenate(chunks) if chunks else np.zeros((0, 2), dtype=np.int64)
+    ida, idb = links[:, 0].copy(), links[:, 1].copy()
+
+    node_ids = np.unique(np.concatenate([ida, idb]))
+    out_indptr, out_indices = _csr(node_ids, ida, idb)
+    in_indptr, in_indices = _csr(node_ids, idb, ida)
+
+    return CSRGraph(node_ids, out_indptr, out_indices, in_indptr, in_indices)
+
+
+def load_csr_graph(path, mmap_mode='r'):
+    """ Loads a graph saved by CSRGraph.save, memory-mapped unless mmap_mode is None """
+    return CSRGraph(*[np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in _arrays])
@@ -1,6 +1,7 @@
 from __future__ import division, print_function, with_statement
 import h5py
 import logging
+import numpy as np
 
 
 def get_group(user_id):
@@ -8,6 +9,29 @@ def get_group(user_id):
     return key[0:4] + '/' + key[4:8]
 
 
+def _iter_in_order(user_id, chunks, read_rest):
+    """
+    Yields the values of the chunks, which are expected in increasing order, each one after the previous ones. When
+    the i-th chunk is not, it is sorted along with read_rest(i), the values of the chunks after it, and yielded
+    instead, unless some of them should have come before the values already yielded.
+    """
+    last = None
+    for i, chunk in enumerate(chunks):
+        if np.all(np.diff(chunk) >= 0) and (last is None or len(chunk) == 0 or chunk[0] >= last):
+            for t in chunk.tolist():
+                yield t
+            if len(chunk) > 0:
+                last = chunk[-1]
+            continue
+
+        rest = np.sort(np.concatenate([chunk, read_rest(i)]))
+        if last is not None and len(rest) > 0 and rest[0] < last:
+            raise ValueError('the tweets of user %d are not stored in time order' % user_id)
+        for t in rest.tolist():
+            yield t
+        return
+
+
 class HDFSLoader:
     def __init__(self, file_path=None):
         if file_path is None:
@@ -16,10 +40,14 @@ class HDFSLoader:
 
     def __del__(self):
         try:
-            self.h5f.close()
+            self.close()
         except Exception as e:
             logging.warning('Ignoring error during destruction: {}'.format(e))
 
+    def close(self):
+        if self.h5f:
+            self.h5f.close()
+
     def get_data(self, user_id, data):
         try:
             return self.h5f[get_group(user_id) + '/' + data]
@@ -31,6 +59,48 @@ class HDFSLoader:
         v.sort()
         return v
 
+    def iter_tweets(self, user_id, chunk_size=4096):
+        """
+        Yields the tweet times of the user in time order, reading chunk_size of them at a time in a single pass.
+        The first chunk gives the stored order: datasets in time order are streamed from their start, the ones in
+        reverse from their end, and others are read whole and sorted. Each chunk is checked as it is read, and the
+        rest of the dataset is read whole and sorted from the first one out of order. Nothing is yielded for
+        unknown users.
+        """
+        dataset = self.get_data(user_id, 'tweets')
+        if dataset is None:
+            return iter([])
+
+        n = len(dataset)
+        first = dataset[:chunk_size]
+        steps = np.diff(first)
+        if n <= chunk_size:
+            return iter(np.sort(first).tolist())
+        elif np.all(steps >= 0):
+            def chunks():
+                yield first
+                for start in range(chunk_size, n, chunk_size):
+                    yield dataset[start:start + chunk_size]
+
+            return _iter_in_order(user_id, chunks(), lambda i: dataset[(i + 1) * chunk_size:])
+        elif np.all(steps <= 0):
+            # the first chunk is kept for the end, instead of being read again
+            ends = list(range(n, chunk_size, -chunk_size))
+
+            def chunks():
+                for end in ends:
+                    yield dataset[max(end - chunk_size, chunk_size):end][::-1]
+                yield first[::-1]
+
+            def read_rest(i):
+                if i == len(ends):
+                    return first[:0]
+                return np.concatenate([dataset[chunk_size:max(ends[i] - chunk_size, chunk_size)], first])
+
+            return _iter_in_order(user_id, chunks(), read_rest)
+        else:
+            return iter(np.sort(dataset[:]).tolist())
+
     def get_followers(self, user_id):
         return self.get_data(user_id, 'followers')
 
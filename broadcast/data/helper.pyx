@@ -2,34 +2,61 @@ from __future__ import division
 
 import numpy as np
 cimport numpy as np
+cimport cython
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _periodic_statistics(const np.int64_t[::1] times, const np.int64_t[::1] period_lengths,
+                               const np.int64_t[::1] slot_offsets, np.int64_t[::1] counts,
+                               np.int64_t[::1] bags) nogil:
+    """
+    Tweets per slot and connection bags of all the period lengths in one pass over the tweets; the slots of the
+    j-th period length are slot_offsets[j]:slot_offsets[j] + period_lengths[j] of counts and bags.
+    """
+    cdef Py_ssize_t i, j, slot
+    cdef np.int64_t hour, prev_time = 0
+    cdef bint new_bag
 
-
-def get_intensity_cy(np.ndarray times, int period_length):
-    cdef int i = 0
-    cdef np.ndarray tweets_per_slot = np.zeros(period_length, dtype=np.long)
-
-    for i in range(times.shape[0]):
-        interval = find_interval(times[i], period_length)
-        tweets_per_slot[interval] += 1
-
-    return tweets_per_slot
-
-
-cdef int find_interval(int tweet_time, int period_length):
-    return int(tweet_time / 3600) % period_length
-
-
-def get_connection_bags_cy(np.ndarray times, int period_length):
-    cdef int i = 0
-    cdef long prev_time = 0
-    
-    cdef np.ndarray bags = np.zeros(period_length, dtype=np.int)
     for i in range(times.shape[0]):
-        if times[i] - prev_time < 3600 and times[i] % 3600 > prev_time % 3600:
-            continue
-
-        interval = find_interval(times[i], period_length)
-        bags[interval] += 1
-
-        prev_time = times[i]
-    return bags
+        hour = times[i] // 3600
+        # a bag is a clock hour with at least one tweet
+        new_bag = not (times[i] - prev_time < 3600 and times[i] % 3600 > prev_time % 3600)
+        if new_bag:
+            prev_time = times[i]
+
+        for j in range(period_lengths.shape[0]):
+            slot = slot_offsets[j] + hour % period_lengths[j]
+            counts[slot] += 1
+            if new_bag:
+                bags[slot] += 1
+
+
+def get_periodic_statistics_cy(times, period_lengths):
+    """
+    :param times: sorted tweet times
+    :param period_lengths: period lengths in hours
+    :return: dict from each period length to its (tweets per slot, connection bags)
+    """
+    cdef const np.int64_t[::1] times_view = np.ascontiguousarray(times, dtype=np.int64)
+    cdef np.int64_t[::1] lengths = np.array(period_lengths, dtype=np.int64)
+    slot_offsets = np.zeros(len(period_lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=slot_offsets[1:])
+
+    counts = np.zeros(slot_offsets[-1], dtype=np.int64)
+    bags = np.zeros(slot_offsets[-1], dtype=np.int64)
+    cdef np.int64_t[::1] offsets_view = slot_offsets, counts_view = counts, bags_view = bags
+    with nogil:
+        _periodic_statistics(times_view, lengths, offsets_view, counts_view, bags_view)
+
+    return {period_length: (counts[slot_offsets[j]:slot_offsets[j + 1]], bags[slot_offsets[j]:slot_offsets[j + 1]])
+            for j, period_length in enumerate(period_lengths)}
+
+
+def get_intensity_cy(times, int period_length):
+    return get_periodic_statistics_cy(times, [period_length])[period_length][0]
+
+
+def get_connection_bags_cy(times, int period_length):
+    return get_periodic_statistics_cy(times, [period_length])[period_length][1]
@@ -1,9 +1,8 @@
 from __future__ import division
-import bisect
 import numpy as np
 from math import ceil
 from ..util.cal import unix_timestamp
-from ..util.decorators import cache_enabled
+from ..util.decorators import memoized
 import pyximport;
 
 pyximport.install()
@@ -12,6 +11,10 @@ from ..data import helper
 
 class ITweetList(object):
     _current = 0  # used in iterator
+    _periodic_statistics = None  # period length -> (tweets per slot, connection bags)
+
+    # period lengths whose statistics are always computed together, in a single pass over the tweets
+    statistics_period_lengths = (24, 24 * 7)
 
     def __getitem__(self, item):
         raise NotImplementedError()
@@ -30,6 +33,8 @@ class ITweetList(object):
             self._current += 1
             return self[self._current - 1]
 
+    __next__ = next
+
     def _get_tweet_list(self):
         raise NotImplementedError()
 
@@ -61,6 +66,20 @@ class ITweetList(object):
         """ Return LOCAL index of slicing to the right """
         raise NotImplementedError()
 
+    def sublist_indices(self, start_dates, end_dates):
+        """
+        Vectorized version of sublist for many windows.
+
+        :param start_dates: starts of the windows
+        :param end_dates: ends of the windows, each tweet at or before the end is in its window (as in sublist)
+        :return: (starts, ends) LOCAL indices, the i-th window holding the tweets starts[i]:ends[i]
+        """
+        times = np.asarray(self._get_tweet_list())
+        start_unix = np.array([unix_timestamp(date) for date in start_dates], dtype=np.int64)
+        end_unix = np.array([unix_timestamp(date) for date in end_dates], dtype=np.int64)
+
+        return np.searchsorted(times, start_unix, side='left'), np.searchsorted(times, end_unix, side='right')
+
     def get_day_tweets(self, date):
         start_ts = int(unix_timestamp(date) / 86400) * 86400
         end_ts = start_ts + 86400
@@ -70,7 +89,18 @@ class ITweetList(object):
 
         return TweetListView(self, slice_left, slice_right - slice_left)
 
-    @cache_enabled
+    def _get_periodic_statistics(self, period_length):
+        """ :return: (tweets per slot, connection bags) of the whole list for period_length """
+        if self._periodic_statistics is None or period_length not in self._periodic_statistics:
+            period_lengths = set(self.statistics_period_lengths) | {period_length}
+            if self._periodic_statistics is not None:
+                period_lengths |= set(self._periodic_statistics)
+            self._periodic_statistics = helper.get_periodic_statistics_cy(self._get_tweet_list(),
+                                                                          sorted(period_lengths))
+
+        return self._periodic_statistics[period_length]
+
+    @memoized(max_bytes=64 * 1024 * 1024)
     def get_periodic_intensity(self, period_length, start_date, end_date):
         """
         :param period_length: in hours, default is one week (must be an integer if time_slots is None)
@@ -83,11 +113,11 @@ class ITweetList(object):
         total_number_of_periods = int(ceil(unix_timestamp(end_date) / 3600 / period_length)) - \
                                   int(unix_timestamp(start_date) / 3600 / period_length)
 
-        tweets_per_slot = helper.get_intensity_cy(self._get_tweet_list(), period_length)
+        tweets_per_slot = self._get_periodic_statistics(period_length)[0]
 
         return (tweets_per_slot / total_number_of_periods).tolist()
 
-    @cache_enabled
+    @memoized(max_bytes=64 * 1024 * 1024)
     def get_connection_probability(self, period_length, start_date, end_date):
         """
         :param period_length: in hours, default is one week (must be an integer if time_slots is None)
@@ -97,7 +127,7 @@ class ITweetList(object):
         if len(self) is 0:
             return [0.] * period_length
 
-        bags = helper.get_connection_bags_cy(self._get_tweet_list(), period_length)
+        bags = self._get_periodic_statistics(period_length)[1]
 
         period_count = int(ceil(unix_timestamp(end_date) / 3600 / period_length)) - \
                        int(unix_timestamp(start_date) / 3600 / period_length)
@@ -105,6 +135,28 @@ class ITweetList(object):
         return (bags / period_count).tolist()
 
 
+    def get_periodic_intensities(self, period_length, start_dates, end_dates):
+        """
+        Vectorized version of get_periodic_intensity for the sublists of many windows.
+
+        :param period_length: in hours
+        :return: (windows x period_length) array, whose i-th row is the intensity of the i-th window sublist
+        """
+        starts, ends = self.sublist_indices(start_dates, end_dates)
+        times = np.asarray(self._get_tweet_list(), dtype=np.int64)
+        n = len(times)
+
+        # tweets sorted by (slot, position), so that the tweets of a window in a slot are a contiguous range
+        slots = (times // 3600) % period_length
+        keys = np.sort(slots * (n + 1) + np.arange(n))
+        slot_keys = np.arange(period_length)[None, :] * (n + 1)
+        counts = np.searchsorted(keys, slot_keys + ends[:, None]) - np.searchsorted(keys, slot_keys + starts[:, None])
+
+        start_periods = np.array([unix_timestamp(date) for date in start_dates]) // 3600 // period_length
+        end_periods = np.ceil(np.array([unix_timestamp(date) for date in end_dates]) / 3600 / period_length)
+        return counts / (end_periods - start_periods)[:, None]
+
+
 class TweetList(ITweetList):
     def __init__(self, times=None):
         """
@@ -122,11 +174,14 @@ class TweetList(ITweetList):
     def __str__(self):
         return 'TweetList (%d tweets) %s' % (len(self), str(self._tweet_times))
 
+    def __sizeof__(self):
+        return object.__sizeof__(self) + getattr(self._tweet_times, 'nbytes', 0)
+
     def get_slice_index_left(self, time_ts):
-        return bisect.bisect_left(self._tweet_times, time_ts)
+        return int(np.searchsorted(self._tweet_times, time_ts, side='left'))
 
     def get_slice_index_right(self, time_ts):
-        return bisect.bisect_right(self._tweet_times, time_ts)
+        return int(np.searchsorted(self._tweet_times, time_ts, side='right'))
 
     def _get_tweet_list(self):
         return self._tweet_times
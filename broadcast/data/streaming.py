@@ -0,0 +1,158 @@
+from __future__ import division
+from collections import deque
+from math import log
+import numpy as np
+
+# decayed weights are rescaled once they have grown by 2 ** _max_doublings
+_max_doublings = 64
+
+
+class StreamingEstimator:
+    """
+    Online version of the periodic intensity and connection probability of ITweetList.
+
+    Tweets are ingested one by one (or by micro-batches) in time order, and each user keeps running tweets per
+    slot and connection bags (clock hours with at least one tweet) over either a sliding window of window_length
+    hours or an exponentially decayed window of half-life half_life hours. Every tweet costs O(1): in the sliding
+    window each (user, clock hour) is queued once and expired once, and in the decayed window the weights are
+    kept relative to a reference time and rescaled lazily.
+
+    Wall intensities are sums of the followees' counts, so follower_matrices gives the (F, M) follower matrices
+    of the optimizer at any moment from the current counts, without going back to the tweets.
+    """
+
+    def __init__(self, repo, period_length=24, window_length=None, half_life=None):
+        """
+        :type repo: data.user_repo.UserRepository
+        :param period_length: in hours
+        :param window_length: length of the sliding window, in hours
+        :param half_life: half-life of the decayed window, in hours (exactly one of window_length and half_life)
+        """
+        if (window_length is None) == (half_life is None):
+            raise ValueError('Exactly one of window_length and half_life must be given')
+
+        self._repo = repo
+        self.period_length = period_length
+        self.window_length = window_length
+        self.half_life = half_life
+
+        self._counts = {}  # user id -> (tweets per slot, connection bags)
+        self._last_records = {}  # user id -> [hour, user id, tweets] of its last clock hour with a tweet
+        self._now = None
+        self._updated = set()  # users having tweets added since the last pop_updated_users
+
+        self._records = deque()  # sliding window: [hour, user id, tweets] of each (user, clock hour)
+        self._reference_time = None  # decayed window: time at which the weights are 1
+
+    def _state(self, user_id):
+        counts = self._counts.get(user_id)
+        if counts is None:
+            counts = np.zeros((2, self.period_length))
+            self._counts[user_id] = counts
+        return counts
+
+    def _weight(self, time):
+        return 2. ** ((time - self._reference_time) / 3600. / self.half_life)
+
+    def advance(self, time):
+        """ Moves the clock to time, expiring what leaves the window """
+        if self._now is not None and time < self._now:
+            raise ValueError('Tweets must be added in time order (%d < %d)' % (time, self._now))
+        self._now = time
+
+        if self.window_length is not None:
+            first_hour = time // 3600 - self.window_length + 1
+            while self._records and self._records[0][0] < first_hour:
+                hour, user_id, tweets = self._records.popleft()
+                counts = self._counts[user_id]
+                counts[0, hour % self.period_length] -= tweets
+                counts[1, hour % self.period_length] -= 1
+        elif self._reference_time is None:
+            self._reference_time = time
+        elif (time - self._reference_time) / 3600. / self.half_life > _max_doublings:
+            scale = 1. / self._weight(time)
+            for counts in self._counts.values():
+                counts *= scale
+            self._reference_time = time
+
+    def add(self, user_id, time):
+        """ Ingests a tweet of the user at time (unix timestamp) """
+        self.advance(time)
+
+        hour = time // 3600
+        slot = hour % self.period_length
+        counts = self._state(user_id)
+        self._updated.add(user_id)
+
+        record = self._last_records.get(user_id)
+        new_bag = record is None or record[0] != hour
+        if new_bag:
+            record = [hour, user_id, 0]
+            self._last_records[user_id] = record
+            if self.window_length is not None:
+                self._records.append(record)
+        record[2] += 1
+
+        weight = 1. if self.window_length is not None else self._weight(time)
+        counts[0, slot] += weight
+        if new_bag:
+            counts[1, slot] += weight
+
+    def add_batch(self, user_ids, times):
+        """ Ingests a micro-batch of tweets, which may be in any order but not older than the last added tweet """
+        user_ids, times = np.asarray(user_ids), np.asarray(times, dtype=np.int64)
+        for i in np.argsort(times, kind='mergesort'):
+            self.add(int(user_ids[i]), int(times[i]))
+
+    def pop_updated_users(self):
+        """
+        :return: set of the users having tweets added since the last call, e.g. for IncrementalOptimizer.updated
+        """
+        updated, self._updated = self._updated, set()
+        return updated
+
+    def _period_count(self):
+        if self.window_length is not None:
+            return self.window_length / self.period_length
+        return self.half_life / log(2.) / self.period_length
+
+    def _scaled(self, counts):
+        if self.window_length is not None or self._now is None:
+            return counts
+        return counts / self._weight(self._now)
+
+    def intensity(self, user_id):
+        """ :return: tweets per hour of the user in each slot """
+        counts = self._counts.get(user_id)
+        if counts is None:
+            return np.zeros(self.period_length)
+        return self._scaled(counts[0]) / self._period_count()
+
+    def connection_probability(self, user_id):
+        """ :return: probability of the user being online in each slot """
+        counts = self._counts.get(user_id)
+        if counts is None:
+            return np.zeros(self.period_length)
+        return self._scaled(counts[1]) / self._period_count()
+
+    def follower_matrices(self, user_id, follower_ids=None):
+        """
+        :param follower_ids: followers to use, all the followers of the user if None
+        :return: (wall intensities, connection probabilities) of the followers, (F, period_length) each, the walls
+                 excluding the user's own tweets
+        """
+        if follower_ids is None:
+            follower_ids = self._repo.get_user_followers(user_id)
+        followees = self._repo.get_users_followees(follower_ids)
+
+        walls = np.zeros((len(follower_ids), self.period_length))
+        conn = np.zeros((len(follower_ids), self.period_length))
+        for i, follower_id in enumerate(follower_ids):
+            for followee_id in followees[follower_id]:
+                counts = self._counts.get(followee_id)
+                if counts is not None and followee_id != user_id:
+                    walls[i] += counts[0]
+            if follower_id in self._counts:
+                conn[i] = self._counts[follower_id][1]
+
+        return self._scaled(walls) / self._period_count(), self._scaled(conn) / self._period_count()
@@ -1,15 +1,37 @@
+import os
 import unittest
-from datetime import datetime
+from datetime import datetime, timedelta
+import shutil
+import sqlite3
 import sys
-from line_profiler import LineProfiler
-from data.db_connector import DbConnection
-from data.hdfs import HDFSLoader
-from data.models import TweetList
-from data.user import User
-from data.user_repo import HDFSSQLiteUserRepository
-from util.cal import unix_timestamp
+import tempfile
+import h5py
+import numpy as np
+try:
+    from line_profiler import LineProfiler
+except ImportError:
+    LineProfiler = None
+import pyximport; pyximport.install()
+from ..data.columnar import encode_varints, decode_varints, encode_times, decode_times, encode_columnar_store, \
+    convert_hdf5_tweets, ColumnarLoader, EncodedColumnarLoader
+from ..data.db_connector import DbConnection
+from ..data.feature_store import FollowerFeatureStore, consolidate_feature_files, get_store_paths, \
+    load_follower_features
+from ..data.graph import build_csr_graph, load_csr_graph
+from ..data.hdfs import HDFSLoader, get_group
+from ..data import helper
+from ..data.models import TweetList
+from ..data.streaming import StreamingEstimator
+from ..data.user import User
+from ..data.user_repo import CSRUserRepository, HDFSSQLiteUserRepository, SQLiteUserRepository, UserRepository
+from ..util.cal import unix_timestamp
 
+# the full data sets, which only the tests of the connection and the loader read
+db_path = '/dev/shm/db.sqlite3'
+hdfs_path = '/dev/shm/tweets_all.h5'
 
+
+@unittest.skipUnless(os.path.exists(db_path), 'no database at %s' % db_path)
 class TestDbConnection(unittest.TestCase):
     def setUp(self):
         self.conn = DbConnection()
@@ -28,6 +50,7 @@ class TestDbConnection(unittest.TestCase):
         self.conn.close()
 
 
+@unittest.skipUnless(os.path.exists(hdfs_path), 'no tweets at %s' % hdfs_path)
 class TestHDFSLoader(unittest.TestCase):
     def setUp(self):
         self.loader = HDFSLoader()
@@ -42,6 +65,372 @@ class TestHDFSLoader(unittest.TestCase):
         del self.loader
 
 
+class CountingDataset(object):
+    """ Dataset counting the values read from it """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.reads = 0
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, item):
+        values = self.dataset[item]
+        self.reads += len(values)
+        return values
+
+
+class CountingHDFSLoader(HDFSLoader):
+    def get_data(self, user_id, data):
+        dataset = HDFSLoader.get_data(self, user_id, data)
+        if dataset is None:
+            return None
+        self.dataset = CountingDataset(dataset)
+        return self.dataset
+
+
+class TestHDFSIterTweets(unittest.TestCase):
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.path = tempfile.mkdtemp()
+        times = np.sort(rs.randint(0, 10 ** 9, 1000))
+        tail = times.copy()
+        np.random.RandomState(1).shuffle(tail[900:])
+        interleaved = times.copy()
+        interleaved[[63, 950]] = interleaved[[950, 63]]
+        reversed_middle = times[::-1].copy()
+        np.random.RandomState(2).shuffle(reversed_middle[500:540])
+
+        self.stored = {
+            1: times,  # in time order
+            2: times[::-1],  # in reverse
+            3: rs.permutation(times),  # in no order
+            4: tail,  # in time order but for its last chunk
+            5: interleaved,  # out of order far apart
+            6: rs.permutation(times[:50]),  # a single chunk
+            7: times[:0],
+            8: reversed_middle,  # in reverse but for a chunk in the middle
+        }
+        with h5py.File(self.path + '/tweets.h5', 'w') as h5f:
+            for user_id, stored in self.stored.items():
+                h5f[get_group(user_id) + '/tweets'] = stored
+        self.loader = CountingHDFSLoader(self.path + '/tweets.h5')
+
+    def test_order(self):
+        for user_id in [1, 2, 3, 4, 6, 7, 8]:
+            self.assertListEqual(list(self.loader.iter_tweets(user_id, chunk_size=64)),
+                                 np.sort(self.stored[user_id]).tolist())
+            self.assertListEqual(list(self.loader.iter_tweets(user_id, chunk_size=64)),
+                                 self.loader.get_tweets(user_id).tolist())
+
+        # the values already yielded can not be taken back
+        self.assertRaises(ValueError, list, self.loader.iter_tweets(5, chunk_size=64))
+
+    def test_single_pass(self):
+        for user_id in [1, 2]:
+            tweets = self.loader.iter_tweets(user_id, chunk_size=64)
+            self.assertEqual(next(tweets), np.min(self.stored[user_id]))
+            # lazily
+            self.assertLessEqual(self.loader.dataset.reads, 2 * 64)
+            list(tweets)
+            self.assertEqual(self.loader.dataset.reads, 1000)
+
+        # at most one chunk is read twice when the stored order breaks
+        for user_id in [3, 4, 8]:
+            list(self.loader.iter_tweets(user_id, chunk_size=64))
+            self.assertLessEqual(self.loader.dataset.reads, 1000 + 64)
+
+    def test_missing_user(self):
+        self.assertListEqual(list(self.loader.iter_tweets(9)), [])
+
+    def tearDown(self):
+        self.loader.close()
+        shutil.rmtree(self.path)
+
+
+class TestFollowerFeatures(unittest.TestCase):
+    def setUp(self):
+        self.rs = np.random.RandomState(0)
+        self.path = tempfile.mkdtemp()
+        self.prefix = self.path + '/'
+        self.features = dict((user_id, self.write_user(user_id, self.rs.randint(0, 5))) for user_id in [3, 1, 7])
+
+    def write_user(self, user_id, followers, mtime=None):
+        wall, conn = self.rs.uniform(0., 2., (followers, 24)), self.rs.uniform(0., 1., (followers, 24))
+        for name, data in [('wall', wall), ('conn', conn)]:
+            path = '%s%08d_03_%s.npy' % (self.prefix, user_id, name)
+            np.save(path, data)
+            if mtime is not None:
+                os.utime(path, (mtime, mtime))
+        return wall, conn
+
+    def assert_features(self, user_id, expected=None):
+        wall, conn = load_follower_features(self.prefix, user_id, 3)
+        expected_wall, expected_conn = self.features[user_id] if expected is None else expected
+        np.testing.assert_array_equal(wall, expected_wall)
+        np.testing.assert_array_equal(conn, expected_conn)
+        return wall
+
+    def test_store(self):
+        # per-user files until the store is built, which is then used
+        self.assertNotIsInstance(self.assert_features(1), np.memmap)
+        consolidate_feature_files(self.prefix, self.prefix, 3, [1, 3, 7, 9])
+        for user_id in [1, 3, 7]:
+            self.assertIsInstance(self.assert_features(user_id), np.memmap)
+
+        store = FollowerFeatureStore(self.prefix, 3)
+        self.assertListEqual(store.user_ids().tolist(), [1, 3, 7])
+        self.assertEqual(store.follower_count(3), len(self.features[3][0]))
+        self.assertRaises(KeyError, store.get, 9)
+
+    def test_stale_store(self):
+        consolidate_feature_files(self.prefix, self.prefix, 3, [1, 3, 7])
+        built = os.path.getmtime(get_store_paths(self.prefix, 3, 24)[1])
+
+        # the files of a user fetched again after the store was built
+        self.features[3] = self.write_user(3, 4, mtime=built + 10)
+        self.assertNotIsInstance(self.assert_features(3), np.memmap)
+        self.assertIsInstance(self.assert_features(1), np.memmap)
+
+        # users missing from the store
+        self.features[5] = self.write_user(5, 2)
+        self.assert_features(5)
+
+    def test_rebuilt_store(self):
+        consolidate_feature_files(self.prefix, self.prefix, 3, [1, 3])
+        old_store = FollowerFeatureStore(self.prefix, 3)
+        old_features = dict((user_id, [np.array(features) for features in old_store.get(user_id)])
+                            for user_id in [1, 3])
+        self.assert_features(1)
+
+        self.features[1] = self.write_user(1, 3)
+        consolidate_feature_files(self.prefix, self.prefix, 3, [1, 3, 7])
+        for user_id in [1, 3, 7]:
+            self.assertIsInstance(self.assert_features(user_id), np.memmap)
+
+        # the previous features are removed, but the stores opened before keep reading them
+        self.assertEqual(len([name for name in os.listdir(self.path) if name.startswith('features_03_024.')]), 1)
+        for user_id in [1, 3]:
+            for features, expected in zip(old_store.get(user_id), old_features[user_id]):
+                np.testing.assert_array_equal(features, expected)
+
+    def test_mismatched_index(self):
+        # features and index of different versions, in the layout where the index does not name the features
+        features_path, index_path = get_store_paths(self.prefix, 3, 24)
+        np.save(features_path, np.zeros((2, 5, 24)))
+        np.savez(index_path, user_ids=np.array([1, 3]), offsets=np.array([0, 2, 4]))
+        self.assertRaises(ValueError, FollowerFeatureStore, self.prefix, 3, attempts=1)
+
+        np.savez(index_path, user_ids=np.array([1, 3]), offsets=np.array([0, 2, 5]))
+        self.assertEqual(FollowerFeatureStore(self.prefix, 3).follower_count(3), 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+class TestCSRGraph(unittest.TestCase):
+    def setUp(self):
+        self.rs = np.random.RandomState(0)
+        self.path = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.path, 'db.sqlite3')
+        self.links_path = os.path.join(self.path, 'links.sqlite3')
+
+        con = sqlite3.connect(self.db_path)
+        con.execute('create table tweets (user_id integer, tweet_time integer)')
+        con.commit()
+        con.close()
+
+        # ida follows idb, inserted in random order, with sparse ids and no self links
+        links = set((int(a), int(b)) for a, b in self.rs.randint(1, 30, (150, 2)) * 7 if a != b)
+        con = sqlite3.connect(self.links_path)
+        con.execute('create table links (ida integer, idb integer)')
+        con.executemany('insert into links values (?, ?)', self.rs.permutation(sorted(links)).tolist())
+        con.commit()
+        con.close()
+
+        # users in both, only following, only followed, and without links
+        self.user_ids = sorted(set(a for a, _ in links) | set(b for _, b in links)) + [0, 3, 1000]
+        self.conn = DbConnection(self.db_path, self.links_path)
+        self.expected = SQLiteUserRepository(self.conn)
+
+    def assert_repository(self, repository):
+        for user_id in self.user_ids:
+            self.assertListEqual(list(repository.get_user_followees(user_id)),
+                                 self.expected.get_user_followees(user_id))
+            self.assertListEqual(list(repository.get_user_followers(user_id)),
+                                 self.expected.get_user_followers(user_id))
+        self.assertDictEqual(repository.get_users_followee_counts(self.user_ids),
+                             self.expected.get_users_followee_counts(self.user_ids))
+        self.assertDictEqual(repository.get_users_follower_counts(self.user_ids),
+                             self.expected.get_users_follower_counts(self.user_ids))
+
+    def test_against_sqlite(self):
+        graph = build_csr_graph(self.links_path, chunk_size=16)
+        self.assert_repository(CSRUserRepository(None, graph))
+
+        graph.save(os.path.join(self.path, 'graph'))
+        graph = load_csr_graph(os.path.join(self.path, 'graph'))
+        self.assertIsInstance(graph.out_indices, np.memmap)
+        self.assert_repository(CSRUserRepository(None, graph))
+
+    def test_empty(self):
+        self.conn.get_cursor().execute('delete from li.links')
+        self.conn.con.commit()
+        graph = build_csr_graph(self.links_path)
+        self.assertEqual(len(graph), 0)
+        self.assert_repository(CSRUserRepository(None, graph))
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.path)
+
+
+class FolloweesRepository(UserRepository):
+    def __init__(self, followees):
+        self.followees = followees
+
+    def get_user_followers(self, user_id):
+        return [follower_id for follower_id in sorted(self.followees) if user_id in self.followees[follower_id]]
+
+    def get_user_followees(self, user_id):
+        return self.followees[user_id]
+
+
+class TestStreamingEstimator(unittest.TestCase):
+    def setUp(self):
+        self.rs = np.random.RandomState(0)
+        self.start = datetime(2009, 1, 1)
+        self.days = 20
+        self.tweets = dict((user_id, np.sort(self.rs.randint(unix_timestamp(self.start),
+                                                             unix_timestamp(self.start) + self.days * 86400,
+                                                             self.rs.randint(0, 300))))
+                           for user_id in range(12))
+        self.repo = FolloweesRepository(dict((user_id, sorted(set(self.rs.choice(12, 4, replace=False)) - {user_id}))
+                                             for user_id in self.tweets))
+        user_ids = np.concatenate([[user_id] * len(times) for user_id, times in self.tweets.items()])
+        times = np.concatenate(list(self.tweets.values()))
+        order = np.argsort(times, kind='mergesort')
+        self.stream = user_ids[order].astype(np.int64), times[order]
+
+    def feed(self, estimator, end):
+        """ Adds the tweets before end, in micro-batches, and moves the clock to the second before end """
+        user_ids, times = self.stream
+        batch = (times >= (estimator._now or 0)) & (times < end)
+        for chunk in np.array_split(np.flatnonzero(batch), 3):
+            estimator.add_batch(user_ids[chunk], times[chunk])
+        estimator.advance(end - 1)
+
+    def test_sliding_window(self):
+        window_days = 7
+        estimator = StreamingEstimator(self.repo, 24, window_length=window_days * 24)
+
+        for day in range(window_days, self.days + 1):
+            end_date = self.start + timedelta(days=day)
+            start_date = end_date - timedelta(days=window_days)
+            start, end = unix_timestamp(start_date), unix_timestamp(end_date)
+            self.feed(estimator, end)
+
+            def window(times):
+                return times[(times >= start) & (times < end)]
+
+            for user_id, times in self.tweets.items():
+                expected = TweetList(times).get_periodic_intensities(24, [start_date], [end_date])[0]
+                np.testing.assert_allclose(estimator.intensity(user_id), expected, atol=1e-12)
+                bags = helper.get_periodic_statistics_cy(window(times), [24])[24][1]
+                np.testing.assert_allclose(estimator.connection_probability(user_id), bags / window_days,
+                                           atol=1e-12)
+
+            followers = self.repo.get_user_followers(0)
+            walls, conn = estimator.follower_matrices(0)
+            for i, follower_id in enumerate(followers):
+                wall = np.sort(np.concatenate([self.tweets[followee_id] for followee_id in self.repo.followees[
+                    follower_id] if followee_id != 0] + [np.zeros(0, dtype=np.int64)]))
+                np.testing.assert_allclose(walls[i], TweetList(wall).get_periodic_intensities(
+                    24, [start_date], [end_date])[0], atol=1e-12)
+                np.testing.assert_allclose(conn[i], estimator.connection_probability(follower_id))
+
+        self.assertSetEqual(estimator.pop_updated_users(), set(user_id for user_id, times in self.tweets.items()
+                                                               if len(times) > 0))
+        self.assertSetEqual(estimator.pop_updated_users(), set())
+        self.assertRaises(ValueError, estimator.add, 0, unix_timestamp(self.start))
+
+    def test_decayed_window(self):
+        # short enough for the weights to be rescaled many times
+        half_life = 3.
+        estimator = StreamingEstimator(self.repo, 24, half_life=half_life)
+        end = unix_timestamp(self.start) + self.days * 86400
+        self.feed(estimator, end)
+        period_count = half_life / np.log(2.) / 24
+
+        for user_id, times in self.tweets.items():
+            weights = 2. ** ((times - (end - 1)) / 3600. / half_life)
+            slots = (times // 3600) % 24
+            first_in_hour = np.concatenate([[True], np.diff(times // 3600) > 0])[:len(times)]
+            expected = np.bincount(slots, weights, minlength=24) / period_count
+            expected_conn = np.bincount(slots[first_in_hour], weights[first_in_hour], minlength=24) / period_count
+            np.testing.assert_allclose(estimator.intensity(user_id), expected, rtol=1e-9, atol=1e-300)
+            np.testing.assert_allclose(estimator.connection_probability(user_id), expected_conn, rtol=1e-9,
+                                       atol=1e-300)
+
+    def tearDown(self):
+        pass
+
+
+def periodic_statistics(times, period_length):
+    """ Tweets per slot and connection bags as get_intensity_cy and get_connection_bags_cy computed them apart """
+    tweets_per_slot, bags = np.zeros(period_length, dtype=np.int64), np.zeros(period_length, dtype=np.int64)
+    for t in times:
+        tweets_per_slot[t // 3600 % period_length] += 1
+
+    prev_time = 0
+    for t in times:
+        if t - prev_time < 3600 and t % 3600 > prev_time % 3600:
+            continue
+        bags[t // 3600 % period_length] += 1
+        prev_time = t
+    return tweets_per_slot, bags
+
+
+class TestPeriodicStatistics(unittest.TestCase):
+    def setUp(self):
+        self.rs = np.random.RandomState(0)
+
+    def random_times(self, count):
+        # bursts within an hour, tweets on the hour and sparse ones over a year
+        times = np.concatenate([self.rs.randint(1230000000, 1260000000, count),
+                                self.rs.randint(1230000000, 1230020000, count // 2),
+                                3600 * self.rs.randint(341667, 350000, count // 4)])
+        return np.sort(times)
+
+    def assert_statistics(self, statistics, times, period_length):
+        expected = periodic_statistics(times.tolist(), period_length)
+        np.testing.assert_array_equal(statistics[0], expected[0])
+        np.testing.assert_array_equal(statistics[1], expected[1])
+
+    def test_against_reference(self):
+        period_lengths = [1, 5, 24, 168]
+        for count in [0, 1, 10, 1000]:
+            times = self.random_times(count)
+            statistics = helper.get_periodic_statistics_cy(times, period_lengths)
+            self.assertListEqual(sorted(statistics), period_lengths)
+            for period_length in period_lengths:
+                self.assert_statistics(statistics[period_length], times, period_length)
+
+    def test_tweet_list(self):
+        times = self.random_times(500)
+        tweet_list = TweetList(times)
+        # the default lengths, then others computed along with the ones already known
+        for period_length in [24, 168, 7, 24, 30, 7]:
+            self.assert_statistics(tweet_list._get_periodic_statistics(period_length), times, period_length)
+        # views compute their own
+        view = tweet_list.sublist(datetime(2009, 3, 1), datetime(2009, 9, 1))
+        self.assert_statistics(view._get_periodic_statistics(24), np.array(view._get_tweet_list()), 24)
+
+    def tearDown(self):
+        pass
+
+
 class TestTweetList(unittest.TestCase):
     def setUp(self):
         self.tweet_times = [unix_timestamp(datetime(2000, 10, 1, 23, 0, 0)),
@@ -62,13 +451,138 @@ class TestTweetList(unittest.TestCase):
 
         self.assertListEqual(list(daily), self.tweet_times[1:3])
 
+    def test_multi_window(self):
+        tweet_list = TweetList(self.tweet_times)
+        start_dates = [datetime(2000, 10, 1), datetime(2000, 10, 2), datetime(2000, 10, 3)]
+        end_dates = [datetime(2000, 10, 8), datetime(2000, 10, 6), datetime(2000, 10, 4)]
+
+        starts, ends = tweet_list.sublist_indices(start_dates, end_dates)
+        intensities = tweet_list.get_periodic_intensities(24, start_dates, end_dates)
+
+        for i in range(len(start_dates)):
+            sub_list = tweet_list.sublist(start_dates[i], end_dates[i])
+            self.assertEqual(ends[i] - starts[i], len(sub_list))
+            self.assertListEqual(list(intensities[i]),
+                                 sub_list.get_periodic_intensity(24, start_dates[i], end_dates[i]))
+
     def test_intensity(self):
         tweet_list = TweetList([2880, 3240, 3960, 8640, 606600, 607320])
-        print(tweet_list.get_periodic_intensity())
+        intensity = tweet_list.get_periodic_intensity(24 * 7, datetime(1970, 1, 1), datetime(1970, 1, 8))
+        self.assertListEqual(intensity, [4., 1., 1.] + [0.] * (24 * 7 - 3))
 
     def tearDown(self):
         pass
 
 
+class TestConvertHDF5(unittest.TestCase):
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.path = tempfile.mkdtemp()
+        self.h5_path = self.path + '/tweets.h5'
+        # users sharing the first four digits, stored unsorted, sorted, reversed and empty
+        self.tweets = {
+            12340001: rs.randint(1230000000, 1260000000, 40),
+            12340002: np.arange(1230000000, 1230000100, 7),
+            12349999: np.arange(1230000100, 1230000000, -3),
+            5: np.array([1240000000]),
+            70000000: np.zeros(0, dtype=np.int64),
+        }
+        with h5py.File(self.h5_path, 'w') as h5f:
+            for user_id, tweets in self.tweets.items():
+                h5f.create_dataset(get_group(user_id) + '/tweets', data=tweets)
+            # a user with links only
+            h5f.create_dataset(get_group(12340003) + '/followers', data=[5])
+
+    def test_against_hdfs(self):
+        prefix = self.path + '/'
+        convert_hdf5_tweets(prefix, self.h5_path)
+
+        columnar, hdfs = ColumnarLoader(prefix), HDFSLoader(self.h5_path)
+        self.assertListEqual(columnar.user_ids().tolist(), sorted(self.tweets))
+        for user_id in self.tweets:
+            tweets = columnar.get_tweets(user_id)
+            self.assertListEqual(tweets.tolist(), sorted(self.tweets[user_id].tolist()))
+            self.assertListEqual(tweets.tolist(), hdfs.get_tweets(user_id).tolist())
+
+        # neither in the store nor with tweets in the file
+        for user_id in [12340003, 6]:
+            self.assertNotIn(user_id, columnar)
+            self.assertEqual(len(columnar.get_tweets(user_id)), 0)
+        columnar.close()
+        hdfs.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+class TestVarintCodec(unittest.TestCase):
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        # empty users first, in the middle and last, and gaps up to 2 ** 62
+        counts = [0, 3, 0, 1, 50, 0]
+        self.tweet_times = [np.sort(rs.randint(0, 2 ** 40, count)) for count in counts]
+        self.tweet_times[4][-1] = 2 ** 62
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.path = tempfile.mkdtemp()
+
+    def test_varints(self):
+        values = [0, 1, 127, 128, 16383, 16384, 2 ** 35, 2 ** 63 - 1]
+        data = encode_varints(values)
+        self.assertEqual(len(data), 1 + 1 + 1 + 2 + 2 + 3 + 6 + 9)
+        self.assertListEqual(decode_varints(data).tolist(), values)
+        self.assertEqual(len(decode_varints(encode_varints([]))), 0)
+
+    def test_round_trip(self):
+        data, byte_offsets = encode_times(np.concatenate(self.tweet_times), self.offsets)
+        self.assertEqual(len(byte_offsets), len(self.tweet_times) + 1)
+
+        for i, times in enumerate(self.tweet_times):
+            self.assertListEqual(decode_times(data[byte_offsets[i]:byte_offsets[i + 1]]).tolist(), times.tolist())
+
+    def test_unsorted(self):
+        self.assertRaises(ValueError, encode_times, [5, 3], [0, 2])
+        # the times of different users need not be sorted
+        self.assertListEqual(decode_times(encode_times([5, 3], [0, 1, 2])[0][1:]).tolist(), [3])
+
+    def test_store(self):
+        prefix = self.path + '/'
+        np.save(prefix + 'tweet_times.npy', np.concatenate(self.tweet_times))
+        user_ids = np.arange(len(self.tweet_times)) * 10
+        np.savez(prefix + 'tweet_index.npz', user_ids=user_ids, offsets=self.offsets)
+
+        # chunks smaller than some users
+        encode_columnar_store(prefix, chunk_size=2)
+        loader = EncodedColumnarLoader(prefix)
+        for user_id, times in zip(user_ids, self.tweet_times):
+            self.assertListEqual(loader.get_tweets(user_id).tolist(), times.tolist())
+        self.assertEqual(len(loader.get_tweets(1)), 0)
+
+    def test_store_against_columnar(self):
+        rs = np.random.RandomState(1)
+        counts = rs.randint(0, 30, 40)
+        counts[[0, 17, 39]] = 0
+        times = [np.sort(rs.randint(1230000000, 1260000000, count)) for count in counts]
+        user_ids = np.sort(rs.choice(10 ** 6, len(counts), replace=False))
+
+        in_prefix, out_prefix = self.path + '/raw_', self.path + '/encoded_'
+        np.save(in_prefix + 'tweet_times.npy', np.concatenate(times))
+        np.savez(in_prefix + 'tweet_index.npz', user_ids=user_ids,
+                 offsets=np.concatenate([[0], np.cumsum(counts)]))
+        encode_columnar_store(in_prefix, out_prefix, chunk_size=64)
+
+        columnar, encoded = ColumnarLoader(in_prefix), EncodedColumnarLoader(out_prefix)
+        self.assertEqual(len(encoded), len(columnar))
+        np.testing.assert_array_equal(encoded.user_ids(), columnar.user_ids())
+        for user_id in user_ids.tolist() + [-1, 10 ** 6]:
+            self.assertEqual(user_id in encoded, user_id in columnar)
+            self.assertListEqual(encoded.get_tweets(user_id).tolist(), columnar.get_tweets(user_id).tolist())
+            self.assertListEqual(list(encoded.iter_tweets(user_id)), list(columnar.iter_tweets(user_id)))
+        columnar.close()
+        encoded.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
 if __name__ == '__main__':
     unittest.main()
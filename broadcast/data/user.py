@@ -4,7 +4,7 @@ import sys
 from ..data import models
 import numpy as np
 
-from ..util.decorators import cache_enabled
+from ..util.decorators import memoized
 
 
 class User:
@@ -41,11 +41,11 @@ class User:
     def user_id(self):
         return self._user_id
 
-    @cache_enabled
+    @memoized(max_bytes=256 * 1024 * 1024)
     def tweet_list(self):
         return models.TweetList(self._repo.get_user_tweets(self.user_id()))
 
-    @cache_enabled
+    @memoized()
     def followees(self):
         followees = []
 
@@ -55,20 +55,13 @@ class User:
 
         return followees
 
-    @cache_enabled
+    @memoized()
     def followers(self):
-        followers = []
+        follower_ids = self._repo.get_user_followers(self.user_id())
+        followee_counts = self._repo.get_users_followee_counts(follower_ids)
 
-        for follower in self._repo.get_user_followers(self.user_id()):
-            follower_user = User(follower, self._repo, **self.options)
-
-            follower_followee_count = len(follower_user.followees())
-            if follower_followee_count <= self.options['max_followee_per_follower']:
-                followers.append(follower_user)
-            else:
-                del follower_user
-
-        return followers
+        return [User(follower, self._repo, **self.options) for follower in follower_ids
+                if followee_counts[follower] <= self.options['max_followee_per_follower']]
 
     def set_follower_weight(self, follower, weight):
         self.followers_weights()
@@ -98,7 +91,7 @@ class User:
 
         return self._followers_weights
 
-    @cache_enabled
+    @memoized(max_bytes=1024 * 1024 * 1024)
     def wall_tweet_list(self, excluded_user_id=0):
         wall = self._repo.get_user_wall(self.user_id(), excluded_user_id)
         return models.TweetList(wall)
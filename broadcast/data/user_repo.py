@@ -1,3 +1,12 @@
+import heapq
+import numpy as np
+
+from ..util.cache import LRUCache
+
+# sqlite allows at most 999 parameters per query
+_max_query_params = 900
+
+
 class UserRepository(object):
     def get_user_tweets(self, user_id):
         raise NotImplementedError()
@@ -11,6 +20,26 @@ class UserRepository(object):
     def get_user_wall(self, user_id, excluded=0):
         raise NotImplementedError()
 
+    def get_users_followee_counts(self, user_ids):
+        """ :return: dict of the number of followees of each user """
+        return {user_id: len(self.get_user_followees(user_id)) for user_id in user_ids}
+
+    def get_users_follower_counts(self, user_ids):
+        """ :return: dict of the number of followers of each user """
+        return {user_id: len(self.get_user_followers(user_id)) for user_id in user_ids}
+
+    def get_users_followees(self, user_ids):
+        """ :return: dict of the sorted followees of each user """
+        return {user_id: self.get_user_followees(user_id) for user_id in user_ids}
+
+    def invalidate_user_tweets(self, user_ids=None):
+        """ Drops the cached tweets of the users, of all the users if None (nothing to do without a cache) """
+        pass
+
+    def iter_user_wall(self, user_id, excluded=0):
+        """ Yields the tweet times of the wall in time order """
+        return iter(self.get_user_wall(user_id, excluded))
+
 
 class SQLiteUserRepository(UserRepository):
     def __init__(self, conn):
@@ -35,13 +64,80 @@ class SQLiteUserRepository(UserRepository):
             (user_id, excluded)).fetchall()
         return [t[0] for t in l]
 
+    def _iter_chunks(self, user_ids):
+        user_ids = list(user_ids)
+        for start in range(0, len(user_ids), _max_query_params):
+            chunk = user_ids[start:start + _max_query_params]
+            yield chunk, ','.join('?' * len(chunk))
+
+    def get_users_followee_counts(self, user_ids):
+        """ :return: dict of the number of followees of each user, fetched with one query per 900 users """
+        counts = {user_id: 0 for user_id in user_ids}
+        for chunk, placeholders in self._iter_chunks(counts):
+            l = self._conn.get_cursor().execute(
+                'select ida, count(*) from li.links where ida in (%s) group by ida' % placeholders, chunk).fetchall()
+            for user_id, count in l:
+                counts[user_id] = count
+        return counts
+
+    def get_users_follower_counts(self, user_ids):
+        """ :return: dict of the number of followers of each user, fetched with one query per 900 users """
+        counts = {user_id: 0 for user_id in user_ids}
+        for chunk, placeholders in self._iter_chunks(counts):
+            l = self._conn.get_cursor().execute(
+                'select idb, count(*) from li.links where idb in (%s) group by idb' % placeholders, chunk).fetchall()
+            for user_id, count in l:
+                counts[user_id] = count
+        return counts
+
+    def get_users_followees(self, user_ids):
+        """ :return: dict of the sorted followees of each user, fetched with one query per 900 users """
+        followees = {user_id: [] for user_id in user_ids}
+        for chunk, placeholders in self._iter_chunks(followees):
+            l = self._conn.get_cursor().execute(
+                'select ida, idb from li.links where ida in (%s) order by ida, idb' % placeholders, chunk).fetchall()
+            for user_id, followee in l:
+                followees[user_id].append(followee)
+        return followees
+
 
 class HDFSUserRepository(UserRepository):
-    def __init__(self, hdfs_loader):
+    def __init__(self, hdfs_loader, cache_bytes=None):
+        """
+        :param cache_bytes: if given, tweets of the users are kept in an LRU cache of this many bytes, which is
+                            shared by all the walls built through this repository
+        """
         self._loader = hdfs_loader
+        self._tweets_cache = LRUCache(max_bytes=cache_bytes) if cache_bytes else None
 
     def get_user_tweets(self, user_id):
-        return self._loader.get_tweets(user_id)
+        if self._tweets_cache is None:
+            return self._loader.get_tweets(user_id)
+
+        tweets = self._tweets_cache.get(user_id)
+        if tweets is None:
+            tweets = self._loader.get_tweets(user_id)
+            tweets.flags.writeable = False  # shared by every caller
+            self._tweets_cache.put(user_id, tweets)
+        return tweets
+
+    def close(self):
+        if self._tweets_cache is not None:
+            self._tweets_cache.clear()
+        self._loader.close()
+
+    def invalidate_user_tweets(self, user_ids=None):
+        if self._tweets_cache is None:
+            return
+        if user_ids is None:
+            self._tweets_cache.clear()
+        else:
+            for user_id in user_ids:
+                self._tweets_cache.invalidate(user_id)
+
+    def tweets_cache_info(self):
+        """ :return: hits, misses, evictions and size of the tweets cache, None if it is disabled """
+        return None if self._tweets_cache is None else self._tweets_cache.info()
 
     def get_user_followers(self, user_id):
         return self._loader.get_followers(user_id)
@@ -49,35 +145,44 @@ class HDFSUserRepository(UserRepository):
     def get_user_followees(self, user_id):
         return self._loader.get_followees(user_id)
 
+    def _get_followees_tweets(self, user_id, excluded):
+        return [self.get_user_tweets(followee) for followee in self.get_user_followees(user_id)
+                if followee != excluded]
+
     def get_user_wall(self, user_id, excluded=0):
-        total_len = 0
-        followees = self.get_user_followees(user_id)
-        for followee in followees:
-            if followee == excluded:
-                continue
-            total_len += len(self.get_user_tweets(followee))
-
-        final_list = [0] * total_len
-        ind = 0
-        for followee in followees:
-            if followee == excluded:
-                continue
-            lst = self.get_user_tweets(followee)
-            final_list[ind:(ind+len(lst))] = lst[:]
-            ind += len(lst)
-
-        final_list.sort()
-        return final_list
+        followees_tweets = self._get_followees_tweets(user_id, excluded)
+        if len(followees_tweets) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # tweets of each followee are already sorted, so the stable (tim)sort only has to merge the runs
+        wall = np.concatenate(followees_tweets).astype(np.int64, copy=False)
+        wall.sort(kind='mergesort')
+        return wall
+
+    def _iter_user_tweets(self, user_id):
+        if self._tweets_cache is not None:
+            tweets = self._tweets_cache.get(user_id)
+            if tweets is not None:
+                return iter(tweets)
+        return self._loader.iter_tweets(user_id)
+
+    def iter_user_wall(self, user_id, excluded=0):
+        """
+        Yields the tweet times of the wall in time order by a k-way merge of the followees' tweets, which are read
+        lazily in chunks (see HDFSLoader.iter_tweets), so only the merge frontier is in memory
+        """
+        return heapq.merge(*[self._iter_user_tweets(followee) for followee in self.get_user_followees(user_id)
+                             if followee != excluded])
 
 
 class HDFSSQLiteUserRepository(SQLiteUserRepository, HDFSUserRepository):
-    def __init__(self, hdfs_loader, conn):
+    def __init__(self, hdfs_loader, conn, cache_bytes=None):
         SQLiteUserRepository.__init__(self, conn)
-        self._loader = hdfs_loader
+        HDFSUserRepository.__init__(self, hdfs_loader, cache_bytes)
 
     def close(self):
         self._conn.close()
-        # self._loader.close()
+        HDFSUserRepository.close(self)
 
     def get_user_followees(self, user_id):
         return SQLiteUserRepository.get_user_followees(self, user_id)
@@ -90,3 +195,31 @@ class HDFSSQLiteUserRepository(SQLiteUserRepository, HDFSUserRepository):
 
     def get_user_wall(self, user_id, excluded=0):
         return HDFSUserRepository.get_user_wall(self, user_id, excluded)
+
+    def iter_user_wall(self, user_id, excluded=0):
+        return HDFSUserRepository.iter_user_wall(self, user_id, excluded)
+
+
+class CSRUserRepository(HDFSUserRepository):
+    """
+    Tweets from HDF5 and links from a CSRGraph (see data.graph), whose lookups are slices of its arrays.
+    """
+
+    def __init__(self, hdfs_loader, graph, cache_bytes=None):
+        """
+        :type graph: data.graph.CSRGraph
+        """
+        HDFSUserRepository.__init__(self, hdfs_loader, cache_bytes)
+        self._graph = graph
+
+    def get_user_followers(self, user_id):
+        return self._graph.followers(user_id)
+
+    def get_user_followees(self, user_id):
+        return self._graph.followees(user_id)
+
+    def get_users_followee_counts(self, user_ids):
+        return dict(zip(user_ids, self._graph.followee_counts(user_ids).tolist()))
+
+    def get_users_follower_counts(self, user_ids):
+        return dict(zip(user_ids, self._graph.follower_counts(user_ids).tolist()))
@@ -3,21 +3,22 @@ import logging
 import multiprocessing
 import numpy as np
 import sys
-import traceback
-import os
 
 sys.path.append('/local/moreka/broadcast-ref')
 
 from datetime import datetime, timedelta
 from data.db_connector import DbConnection
+from data.feature_store import load_follower_features, consolidate_feature_files
 from data.hdfs import HDFSLoader
 from data.user import User
-from data.user_repo import HDFSSQLiteUserRepository
+from data.user_repo import HDFSSQLiteUserRepository, SQLiteUserRepository
 from opt.optimizer import learn_and_optimize
 from opt.utils import *
 from util.cal import unix_timestamp
-from simulator.simulate import generate_piecewise_constant_poisson_process, time_being_in_top_k
+from simulator.simulate import generate_piecewise_constant_poisson_process, time_being_in_top_k_many, stack_walls
+from simulator.engine import simulate_visibility
 from competitors.avm import ravm, ipavm
+from large.scheduler import JobLedger, run_jobs, run_stages, init_worker, get_worker_resource
 
 test_start_date = datetime(2009, 5, 14)
 test_end_date = datetime(2009, 8, 13)
@@ -32,6 +33,8 @@ learn_end_date = test_start_date - timedelta(seconds=1)
 in_path_prefix = '/local/moreka/new_np_data/'
 out_path_prefix = '/local/moreka/new_np_results/'
 
+tweets_cache_bytes = 256 * 1024 * 1024
+
 
 def fetch_wall_array(user):
     intensity_arr = np.zeros((len(user.followers()), 24))
@@ -50,23 +53,21 @@ def fetch_wall_array(user):
     return intensity_arr, connection_arr
 
 
-def worker(pid, user_id, month, funcs):
-    print '[Process-%d] Worker started for user %d' % (pid, user_id)
+def make_repository():
+    # followers of the users share many followees, so their tweets are cached across the users of a worker
+    return HDFSSQLiteUserRepository(HDFSLoader(), DbConnection(), cache_bytes=tweets_cache_bytes)
+
 
-    repo = HDFSSQLiteUserRepository(HDFSLoader(), DbConnection())
-    user = User(user_id, repo)
+def worker(user_id, stages, month=3):
+    print('[%s] Worker started for user %d' % (multiprocessing.current_process().name, user_id))
 
-    try:
-        for func in funcs:
-            func(user, month)
-    except:
-        sys.stderr.write('ERROR FOR USER %d, SO DROPPED. REASON:' % user_id)
-        traceback.print_exc()
+    user = User(user_id, get_worker_resource('repo'))
+
+    return run_stages(commands, user_id, stages, user, month)
         
 
 def do_theoretical_test(user, month):
-    wall_intensity_data = np.load('%s%08d_%02d_wall.npy' % (in_path_prefix, user.user_id(), month))
-    conn_probability_data = np.load('%s%08d_%02d_conn.npy' % (in_path_prefix, user.user_id(), month))
+    wall_intensity_data, conn_probability_data = load_follower_features(in_path_prefix, user.user_id(), month)
 
     user_tweet_list__sublist = user.tweet_list().sublist(learn_start_date, learn_end_date)
     user_learned_intensity = np.array(user_tweet_list__sublist.get_periodic_intensity(24, learn_start_date, learn_end_date))
@@ -117,14 +118,13 @@ def fetch_and_save_wall_and_conn(user, month):
 
 
 def repeated_test(intensity, user, data):
+    walls, wall_offsets = stack_walls([data[target.user_id()]['wall_no_offset'] for target in user.followers()])
+    pis = [data[target.user_id()]['pi'] for target in user.followers()]
+
     result = []
     for iteration in range(10):
         simulated_process = generate_piecewise_constant_poisson_process(intensity)
-        now = []
-        for target in user.followers():
-            now.append(time_being_in_top_k(simulated_process,
-                                           data[target.user_id()]['wall_no_offset'], 1, n,
-                                           data[target.user_id()]['pi']))
+        now = time_being_in_top_k_many(simulated_process, walls, 1, n, pis, wall_offsets=wall_offsets)
         result.append(sum(now))
     return np.mean(result)
 
@@ -135,11 +135,9 @@ def do_practical_test(user, month):
     user_tweet_list__sublist = user.tweet_list().sublist(test_start_date, test_end_date)._get_tweet_list()
     real_process = ((user_tweet_list__sublist - test_start_date_unix) / 3600.).tolist()
 
-    before = []
-    for target in user.followers():
-        before.append(time_being_in_top_k(real_process,
-                                          data[target.user_id()]['wall_no_offset'], 1, n,
-                                          data[target.user_id()]['pi']))
+    before = time_being_in_top_k_many(real_process,
+                                      [data[target.user_id()]['wall_no_offset'] for target in user.followers()], 1, n,
+                                      [data[target.user_id()]['pi'] for target in user.followers()])
 
     s_before = sum(before)
 
@@ -151,8 +149,7 @@ def do_practical_test(user, month):
 
 
 def do_simulation_test(user, month):
-    wall_intensity_data = np.load('%s%08d_%02d_wall.npy' % (in_path_prefix, user.user_id(), month))
-    conn_probability_data = np.load('%s%08d_%02d_conn.npy' % (in_path_prefix, user.user_id(), month))
+    wall_intensity_data, conn_probability_data = load_follower_features(in_path_prefix, user.user_id(), month)
 
     user_tweet_list__sublist = user.tweet_list().sublist(learn_start_date, learn_end_date)
     user_learned_intensity = np.array(
@@ -170,33 +167,17 @@ def do_simulation_test(user, month):
 
         
         if sum(user_best_intensity) > 1e-6 and sum(user_learned_intensity) > 1e-6:
-            now, before = [], []
-
-            for i in range(1000):
-                sum1, sum2 = 0 ,0
-                user_best_realization = generate_piecewise_constant_poisson_process(user_best_intensity)
-                user_learned_realization = generate_piecewise_constant_poisson_process(user_learned_intensity)
-
+            # runs inside a pool worker, so the replicates are simulated in this process
+            estimate = simulate_visibility([user_best_intensity, user_learned_intensity],
+                                           wall_intensity_data, conn_probability_data, k=1,
+                                           replicates=1000, processes=1, seed=user.user_id())
+            now, before = estimate['mean']
 
-                for idx, target in enumerate(user.followers()):
-                    target_learned_intensity = wall_intensity_data[idx]
-                    target_learned_connection = conn_probability_data[idx]
-                    target_realization = generate_piecewise_constant_poisson_process(target_learned_intensity)
-
-                    sum2 += (time_being_in_top_k(user_learned_realization,
-                                                      target_realization, 1, 24,
-                                                      target_learned_connection))
-
-                    sum1 += (time_being_in_top_k(user_best_realization,
-                                                   target_realization, 1, 24,
-                                                   target_learned_connection))
-                now.append(sum1)
-                before.append(sum2)
-            if sum(before) < 1e-6 or sum(now) < 1e-6:
+            if before < 1e-6 or now < 1e-6:
                 print('is it really possible!!! for user %d' %user.user_id())
                 break
             else:
-                results.append(sum(now)/sum(before))
+                results.append(now / before)
 
 
         if len(results) == 0.:
@@ -221,8 +202,7 @@ def test_competitor(test, user, data, month, s_before):
 
 def do_calculate_competitors(user, month):
     print('... user %d ...' % user.user_id())
-    wall_intensity_data = np.load('%s%08d_%02d_wall.npy' % (in_path_prefix, user.user_id(), month))
-    conn_probability_data = np.load('%s%08d_%02d_conn.npy' % (in_path_prefix, user.user_id(), month))
+    wall_intensity_data, conn_probability_data = load_follower_features(in_path_prefix, user.user_id(), month)
     
     upper_bounds = np.ones(24) * 1000.
     
@@ -264,44 +244,45 @@ def collect_data(user):
     return data
 
 
+commands = {
+    'fetch': fetch_and_save_wall_and_conn,
+    'prac': do_practical_test,
+    'theo': do_theoretical_test,
+    'simul': do_simulation_test,
+    'comp': do_calculate_competitors,
+}
+
+
 def main():
-    commands = {
-        'fetch': fetch_and_save_wall_and_conn,
-        'prac': do_practical_test,
-        'theo': do_theoretical_test,
-        'simul': do_simulation_test,
-        'comp': do_calculate_competitors,
-    }
-
-    funcs = []
-    for arg in sys.argv:
-        if arg in commands:
-            funcs.append(commands[arg])
+    stages = [arg for arg in sys.argv if arg in commands]
 
     multiprocessing.log_to_stderr(logging.INFO)
 
 #     good_users = list(set(np.loadtxt('/local/moreka/broadcast-ref/Good-Users.txt', dtype='int').tolist()))
-    good_users = np.load('good_users.npy').tolist()
-    already_seen_users = []
-    for f in os.listdir('/local/moreka/new_np_results/'):
-        try:
-            method = f.split('_')[3]
-            if method == 'simul':
-                already_seen_users.append(int(f.split('_')[0]))
-        except:
-            print('There is a problem in the name of %s' %f)
-            
-        
-#     good_users = [803059]
-
-    pool = multiprocessing.Pool(48)
-    results = []
-    for i in range(len(good_users)):
-        if not (int(good_users[i]) in already_seen_users):
-            results.append(pool.apply_async(worker, (i + 1, int(good_users[i]), 3, funcs, )))
-    for i in range(len(good_users)):
-        if int(good_users[i]) not in already_seen_users:
-            results[i].get()
+    good_users = [int(user_id) for user_id in np.load('good_users.npy').tolist()]
+
+    if 'consolidate' in sys.argv:
+        # one memory-mapped store instead of the per-user files written by fetch, shared by all the workers
+        consolidate_feature_files(in_path_prefix, in_path_prefix, 3, good_users)
+
+    # the run time of a user grows with its followers, so the largest users are scheduled first
+    conn = DbConnection()
+    follower_counts = SQLiteUserRepository(conn).get_users_follower_counts(good_users)
+    conn.close()
+
+    # (user, stage) jobs done in previous runs are skipped, failed ones retried
+    ledger = JobLedger('%sjobs.sqlite3' % out_path_prefix)
+    ledger.add(good_users, stages, follower_counts)
+    if 'reset' in sys.argv:
+        # runs the stages again for all the users, e.g. after changing their code
+        ledger.reset(stages)
+    summary = run_jobs(ledger, worker, stages, processes=48, max_attempts=3,
+                       initializer=init_worker, initargs=({'repo': make_repository},))
+
+    print('Jobs: %s' % ', '.join('%d %s' % (count, status) for status, count in sorted(summary.items())))
+    for user_id, stage, attempts, _ in ledger.failures():
+        print('User %d failed at stage %s after %d attempts' % (user_id, stage, attempts))
+    ledger.close()
 
 
 if __name__ == '__main__':
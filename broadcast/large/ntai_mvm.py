@@ -10,14 +10,16 @@ sys.path.append('/local/moreka/broadcast-ref')
 
 from datetime import datetime, timedelta
 from data.db_connector import DbConnection
+from data.feature_store import load_follower_features
 from data.hdfs import HDFSLoader
 from data.user import User
 from data.user_repo import HDFSSQLiteUserRepository
 from opt.optimizer import learn_and_optimize
 from opt.utils import *
 from util.cal import unix_timestamp
-from simulator.simulate import generate_piecewise_constant_poisson_process, time_being_in_top_k
+from simulator.simulate import generate_piecewise_constant_poisson_process, time_being_in_top_k_many, stack_walls
 from competitors.avm import ravm, ipavm
+from large.scheduler import init_worker, get_worker_resource
 
 test_start_date = datetime(2009, 5, 14)
 test_end_date = datetime(2009, 8, 13)
@@ -33,12 +35,18 @@ in_path_prefix = '/local/moreka/new_np_data/'
 mid_path_prefix = '/local/moreka/new_np_data_mvm/'
 out_path_prefix = '/local/moreka/new_np_results_mvm/'
 
+tweets_cache_bytes = 256 * 1024 * 1024
+
+
+def make_repository():
+    # followers of the users share many followees, so their tweets are cached across the users of a worker
+    return HDFSSQLiteUserRepository(HDFSLoader(), DbConnection(), cache_bytes=tweets_cache_bytes)
+
 
 def worker(pid, user_id, month, funcs):
     print '[Process-%d] Worker started for user %d' % (pid, user_id)
 
-    repo = HDFSSQLiteUserRepository(HDFSLoader(), DbConnection())
-    user = User(user_id, repo)
+    user = User(user_id, get_worker_resource('repo'))
 
     try:
         for func in funcs:
@@ -57,8 +65,7 @@ def fetch_and_save_wall_and_conn(user, month):
 
 
 def get_best_intensity_mvm(user, budget, month, title):
-    wall_intensity_data = np.load('%s%08d_%02d_wall.npy' % (in_path_prefix, user.user_id(), month))
-    conn_probability_data = np.load('%s%08d_%02d_conn.npy' % (in_path_prefix, user.user_id(), month))
+    wall_intensity_data, conn_probability_data = load_follower_features(in_path_prefix, user.user_id(), month)
     
     sum_conn_prob = np.sum(conn_probability_data, axis=1)
     indices = sum_conn_prob >= 0.1
@@ -90,8 +97,7 @@ def get_best_intensity_mvm(user, budget, month, title):
 
 
 def do_theoretical_test(user, month):
-    wall_intensity_data = np.load('%s%08d_%02d_wall.npy' % (in_path_prefix, user.user_id(), month))
-    conn_probability_data = np.load('%s%08d_%02d_conn.npy' % (in_path_prefix, user.user_id(), month))
+    wall_intensity_data, conn_probability_data = load_follower_features(in_path_prefix, user.user_id(), month)
 
     sum_conn_prob = np.sum(conn_probability_data, axis=1)
     indices = sum_conn_prob >= 0.1
@@ -128,11 +134,9 @@ def do_practical_test(user, month):
     user_tweet_list__sublist = user.tweet_list().sublist(test_start_date, test_end_date)._get_tweet_list()
     real_process = ((user_tweet_list__sublist - test_start_date_unix) / 3600.).tolist()
 
-    before = []
-    for target in user.followers():
-        before.append(time_being_in_top_k(real_process,
-                                          data[target.user_id()]['wall_no_offset'], 1, n,
-                                          data[target.user_id()]['pi']))
+    before = time_being_in_top_k_many(real_process,
+                                      [data[target.user_id()]['wall_no_offset'] for target in user.followers()], 1, n,
+                                      [data[target.user_id()]['pi'] for target in user.followers()])
     
     before = np.array(before)
     before_p = before[before > 0]
@@ -165,14 +169,13 @@ def test_competitor(test, user, data, month, s_before):
 
 
 def repeated_test(intensity, user, data):
+    walls, wall_offsets = stack_walls([data[target.user_id()]['wall_no_offset'] for target in user.followers()])
+    pis = [data[target.user_id()]['pi'] for target in user.followers()]
+
     result = []
     for iteration in range(10):
         simulated_process = generate_piecewise_constant_poisson_process(intensity)
-        now = []
-        for target in user.followers():
-            now.append(time_being_in_top_k(simulated_process,
-                                           data[target.user_id()]['wall_no_offset'], 1, n,
-                                           data[target.user_id()]['pi']))
+        now = time_being_in_top_k_many(simulated_process, walls, 1, n, pis, wall_offsets=wall_offsets)
         if len(now):
             now.sort()
             result.append(np.mean(now[:10]))
@@ -186,7 +189,7 @@ def repeated_test(intensity, user, data):
 def collect_data(user):
     data = {}
     
-    conn_probability_data = np.load('%s%08d_%02d_conn.npy' % (in_path_prefix, user.user_id(), 3))
+    conn_probability_data = load_follower_features(in_path_prefix, user.user_id(), 3)[1]
     sum_conn_prob = np.sum(conn_probability_data, axis=1)
     indices = sum_conn_prob >= 0.1
     
@@ -196,7 +199,7 @@ def collect_data(user):
         if indices[i]:
             new_followers.append(user.followers()[i])
     
-    user._followers__ = new_followers
+    User.followers.cache_put(user, new_followers)
 
     for target in user.followers():
         test_list = target.wall_tweet_list(excluded_user_id=user.user_id()).sublist(test_start_date, test_end_date)
@@ -216,8 +219,7 @@ def collect_data(user):
 
 
 def do_simulation_test(user, month):
-    wall_intensity_data = np.load('%s%08d_%02d_wall.npy' % (in_path_prefix, user.user_id(), month))
-    conn_probability_data = np.load('%s%08d_%02d_conn.npy' % (in_path_prefix, user.user_id(), month))
+    wall_intensity_data, conn_probability_data = load_follower_features(in_path_prefix, user.user_id(), month)
 
     user_tweet_list__sublist = user.tweet_list().sublist(learn_start_date, learn_end_date)
     user_learned_intensity = np.array(user_tweet_list__sublist.get_periodic_intensity(24, learn_start_date, learn_end_date))
@@ -230,7 +232,7 @@ def do_simulation_test(user, month):
         if indices[i]:
             new_followers.append(user.followers()[i])
     
-    user._followers__ = new_followers
+    User.followers.cache_put(user, new_followers)
     
     conn_probability_data = conn_probability_data[indices]
     wall_intensity_data = wall_intensity_data[indices]
@@ -256,20 +258,14 @@ def do_simulation_test(user, month):
                 user_best_realization = generate_piecewise_constant_poisson_process(user_best_intensity)
                 user_learned_realization = generate_piecewise_constant_poisson_process(user_learned_intensity)
 
-                vis_now = []
-                vis_before = []
-                for idx, target in enumerate(user.followers()):
-                    target_learned_intensity = wall_intensity_data[idx]
-                    target_learned_connection = conn_probability_data[idx]
-                    target_realization = generate_piecewise_constant_poisson_process(target_learned_intensity)
-
-                    vis_before.append(time_being_in_top_k(user_learned_realization,
-                                                      target_realization, 1, 24,
-                                                      target_learned_connection))
+                # one realization of each follower's wall, against which both intensities are evaluated
+                walls, wall_offsets = stack_walls([generate_piecewise_constant_poisson_process(intensity)
+                                                   for intensity in wall_intensity_data])
 
-                    vis_now.append(time_being_in_top_k(user_best_realization,
-                                                   target_realization, 1, 24,
-                                                   target_learned_connection))
+                vis_before = time_being_in_top_k_many(user_learned_realization, walls, 1, 24,
+                                                      conn_probability_data, wall_offsets=wall_offsets)
+                vis_now = time_being_in_top_k_many(user_best_realization, walls, 1, 24,
+                                                   conn_probability_data, wall_offsets=wall_offsets)
                 
                 vis_now.sort()
                 vis_before.sort()
@@ -310,7 +306,7 @@ def main():
 
     good_users = np.load('good_users.npy').tolist()[100:]
 
-    pool = multiprocessing.Pool(48)
+    pool = multiprocessing.Pool(48, init_worker, ({'repo': make_repository},))
     results = []
     for i in range(len(good_users)):
         results.append(pool.apply_async(worker, (i + 1, int(good_users[i]), 3, funcs, )))
@@ -0,0 +1,284 @@
+from __future__ import division, print_function
+import multiprocessing
+import multiprocessing.connection
+import sqlite3
+import sys
+import time
+import traceback
+from multiprocessing.util import Finalize
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+# resources of the current worker process, see init_worker
+_worker_resources = {}
+
+
+class JobLedger:
+    """
+    Durable record of the (user, stage) jobs of a run, in a SQLite file: status, number of attempts, last error and
+    estimated cost of each job. A job is marked done only once its stage returned, so a run killed at any point
+    resumes from the ledger, redoing at most the stages that were running.
+    """
+
+    def __init__(self, path):
+        self.con = sqlite3.connect(path)
+        with self.con:
+            self.con.execute('create table if not exists jobs (user_id integer not null, stage text not null, '
+                             'cost real not null default 0, status text not null, '
+                             'attempts integer not null default 0, error text, updated real, '
+                             'primary key (user_id, stage))')
+
+    def close(self):
+        if self.con:
+            self.con.close()
+            self.con = None
+
+    def add(self, user_ids, stages, costs=None):
+        """
+        Registers the jobs of the users, keeping the status and attempts of the ones already in the ledger.
+
+        :param costs: dict of the estimated cost of each user (e.g. its number of followers), which is updated for the
+                      jobs already in the ledger
+        """
+        rows = [(int(user_id), stage, float(costs.get(user_id, 0)) if costs else 0., PENDING)
+                for user_id in user_ids for stage in stages]
+        with self.con:
+            self.con.executemany('insert or ignore into jobs (user_id, stage, cost, status) values (?, ?, ?, ?)', rows)
+            if costs:
+                self.con.executemany('update jobs set cost=? where user_id=? and stage=?',
+                                     [(cost, user_id, stage) for user_id, stage, cost, _ in rows])
+
+    def record(self, user_id, stage, error=None):
+        """ Records an attempt of the job, successful if error (e.g. a formatted traceback) is None """
+        with self.con:
+            self.con.execute('update jobs set status=?, attempts=attempts + 1, error=?, updated=? '
+                             'where user_id=? and stage=?',
+                             (DONE if error is None else FAILED, error, time.time(), int(user_id), stage))
+
+    def reset(self, stages=None):
+        """ Marks the jobs of the stages (all the jobs if None) pending again, with no attempts """
+        query = 'update jobs set status=?, attempts=0, error=null, updated=null'
+        args = (PENDING,)
+        if stages is not None:
+            query += ' where stage in (%s)' % ', '.join('?' * len(stages))
+            args += tuple(stages)
+        with self.con:
+            self.con.execute(query, args)
+
+    def pending(self, stages, max_attempts=3):
+        """
+        :param stages: stages of the run, in the order in which each user goes through them
+        :return: list of (user id, stages to run), the most costly users first, where the stages of a user start at its
+                 first stage not done, unless that one already failed max_attempts times
+        """
+        l = self.con.execute('select user_id, stage, cost, status, attempts from jobs where stage in (%s)' %
+                             ', '.join('?' * len(stages)), tuple(stages)).fetchall()
+        jobs = {}
+        for user_id, stage, cost, status, attempts in l:
+            job = jobs.setdefault(user_id, [0., {}])
+            job[0] = max(job[0], cost)
+            job[1][stage] = (status, attempts)
+
+        pending = []
+        for user_id, (cost, states) in jobs.items():
+            todo = [stage for stage in stages if stage in states and states[stage][0] != DONE]
+            if todo and states[todo[0]][1] < max_attempts:
+                pending.append((-cost, user_id, todo))
+        pending.sort()
+        return [(user_id, todo) for _, user_id, todo in pending]
+
+    def failures(self):
+        """ :return: list of (user id, stage, attempts, last error) of the failed jobs """
+        return self.con.execute('select user_id, stage, attempts, error from jobs where status=? '
+                                'order by user_id, stage', (FAILED,)).fetchall()
+
+    def summary(self):
+        """ :return: dict of the number of jobs in each status """
+        return dict(self.con.execute('select status, count(*) from jobs group by status').fetchall())
+
+
+def init_worker(factories):
+    """
+    Pool initializer creating the resources of a worker once, so all the tasks of the worker share them along with
+    whatever they cache (e.g. a repository, its connections and its tweets cache). Each resource is closed when the
+    worker exits.
+
+    :param factories: dict from the name of each resource to a picklable function creating it
+    """
+    for name, factory in factories.items():
+        resource = factory()
+        _worker_resources[name] = resource
+        Finalize(None, resource.close, exitpriority=10)
+
+
+def get_worker_resource(name):
+    """ :return: the resource of the current worker created by init_worker """
+    return _worker_resources[name]
+
+
+def run_stages(functions, user_id, stages, *args):
+    """
+    Runs the stages of a user in order, stopping at the first one that raises.
+
+    :param functions: dict from each stage to its function, called with args
+    :return: list of (stage, error) of the stages that ran, error being the traceback of the failure or None
+    """
+    results = []
+    for stage in stages:
+        try:
+            functions[stage](*args)
+        except Exception:
+            error = traceback.format_exc()
+            sys.stderr.write('ERROR FOR USER %d AT STAGE %s. REASON:\n%s' % (user_id, stage, error))
+            results.append((stage, error))
+            break
+        results.append((stage, None))
+    return results
+
+
+def _run_job(job):
+    task, user_id, stages = job
+    try:
+        return user_id, task(user_id, stages)
+    except Exception:
+        # the task failed before running its first stage
+        return user_id, [(stages[0], traceback.format_exc())]
+
+
+def _worker_loop(conn, initializer, initargs):
+    # runs the jobs received on conn until it receives None
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        conn.send(_run_job(job))
+
+
+class _Worker:
+    """ Worker process running one job at a time, so a worker that dies is charged to the job it was running """
+
+    def __init__(self, initializer, initargs):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_loop, args=(child_conn, initializer, initargs))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.job = None
+        self.started = None
+
+    def submit(self, job):
+        self.job = job
+        self.started = time.time()
+        self.conn.send(job)
+
+    def result(self):
+        """ :return: (user id, results) of the job if the worker sent them, None if it died """
+        try:
+            if self.conn.poll():
+                result = self.conn.recv()
+                self.job = None
+                return result
+        except (EOFError, OSError):
+            # the worker closed its end of the pipe by exiting
+            self.process.join()
+        return None
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (EOFError, OSError):
+            pass
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+def _exit_reason(exitcode):
+    if exitcode is not None and exitcode < 0:
+        return 'worker killed by signal %d (e.g. by the OOM killer)' % -exitcode
+    return 'worker died with exit code %s' % exitcode
+
+
+def run_jobs(ledger, task, stages, processes=None, max_attempts=3, initializer=None, initargs=(), timeout=None):
+    """
+    Runs the pending jobs of the ledger in worker processes, the most costly users first so that the largest ones do
+    not start last, then retries the failed ones until they succeed or fail max_attempts times. The workers only
+    return their results and this process writes them to the ledger as they come.
+
+    A worker that dies while running a job (e.g. killed by the OOM killer) or runs it for longer than timeout is
+    replaced, and the job is recorded as a failed attempt of its first stage, the stages it ran being lost with it.
+
+    :type ledger: JobLedger
+    :param task: picklable function of (user id, stages to run) returning the list of (stage, error) of the stages it
+                 ran, in order (see run_stages)
+    :param stages: stages of the run, in order
+    :param processes: number of workers, the number of CPUs if None
+    :param initializer: called with initargs when each worker starts
+    :param timeout: seconds after which a job is stopped and recorded as failed, no limit if None
+    :return: summary of the ledger
+    """
+    processes = processes or multiprocessing.cpu_count()
+    idle, busy = [], []
+    try:
+        while True:
+            jobs = ledger.pending(stages, max_attempts)
+            if len(jobs) == 0:
+                break
+
+            # popped from the end, the most costly first
+            jobs.reverse()
+            while jobs or busy:
+                while jobs and len(busy) < processes:
+                    while idle and not idle[-1].process.is_alive():
+                        idle.pop().kill()
+                    worker = idle.pop() if idle else _Worker(initializer, initargs)
+                    user_id, todo = jobs.pop()
+                    worker.submit((task, user_id, todo))
+                    busy.append(worker)
+
+                wait_for = None
+                if timeout is not None:
+                    wait_for = max(0., min(worker.started for worker in busy) + timeout - time.time())
+                multiprocessing.connection.wait([worker.conn for worker in busy] +
+                                                [worker.process.sentinel for worker in busy], wait_for)
+
+                for worker in list(busy):
+                    result = worker.result()
+                    if result is not None:
+                        user_id, results = result
+                        for stage, error in results:
+                            ledger.record(user_id, stage, error)
+                        busy.remove(worker)
+                        idle.append(worker)
+                        continue
+
+                    if worker.process.is_alive():
+                        if timeout is None or time.time() - worker.started < timeout:
+                            continue
+                        error = 'job timed out after %d seconds' % timeout
+                    else:
+                        error = _exit_reason(worker.process.exitcode)
+
+                    _, user_id, todo = worker.job
+                    sys.stderr.write('ERROR FOR USER %d AT STAGE %s. REASON: %s\n' % (user_id, todo[0], error))
+                    ledger.record(user_id, todo[0], error)
+                    worker.kill()
+                    busy.remove(worker)
+    except:
+        for worker in idle + busy:
+            worker.kill()
+        raise
+
+    for worker in idle:
+        worker.stop()
+    for worker in idle:
+        worker.process.join()
+        worker.conn.close()
+
+    return ledger.summary()
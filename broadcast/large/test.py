@@ -0,0 +1,133 @@
+from __future__ import division
+import functools
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ..large.scheduler import DONE, FAILED, PENDING, JobLedger, run_jobs, run_stages
+
+
+def succeed(user_id, path):
+    pass
+
+
+def fail(user_id, path):
+    raise ValueError('failed for user %d' % user_id)
+
+
+def fail_once(user_id, path):
+    # fails the first attempt of each user, leaving a file behind
+    marker = os.path.join(path, '%d.tried' % user_id)
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        raise ValueError('first attempt of user %d' % user_id)
+
+
+def crash(user_id, path):
+    # as if the worker was killed, with no chance of reporting
+    os._exit(3)
+
+
+def sleep(user_id, path):
+    time.sleep(60)
+
+
+def task(functions, path, user_id, stages):
+    # each stage of the tests is a function of (user id, path) run for the users of its list, succeed for the others
+    return run_stages(dict((stage, functions[stage][1] if user_id in functions[stage][0] else succeed)
+                           for stage in stages), user_id, stages, user_id, path)
+
+
+class TestJobLedger(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.ledger_path = os.path.join(self.path, 'jobs.sqlite3')
+        self.ledger = JobLedger(self.ledger_path)
+        self.stages = ['fetch', 'theo']
+        self.ledger.add([1, 2, 3], self.stages, {1: 10, 2: 30, 3: 20})
+
+    def run_task(self, functions, **kwargs):
+        return run_jobs(self.ledger, functools.partial(task, functions, self.path), self.stages, processes=2,
+                        **kwargs)
+
+    def statuses(self):
+        return dict(((user_id, stage), (status, attempts)) for user_id, stage, status, attempts in
+                    self.ledger.con.execute('select user_id, stage, status, attempts from jobs').fetchall())
+
+    def test_pending(self):
+        # the most costly first
+        self.assertListEqual(self.ledger.pending(self.stages), [(2, self.stages), (3, self.stages),
+                                                                (1, self.stages)])
+
+        self.ledger.record(2, 'fetch')
+        self.ledger.record(3, 'fetch', 'error')
+        self.ledger.record(1, 'fetch')
+        self.ledger.record(1, 'theo')
+        self.assertListEqual(self.ledger.pending(self.stages), [(2, ['theo']), (3, self.stages)])
+        self.assertListEqual(self.ledger.pending(self.stages, max_attempts=1), [(2, ['theo'])])
+        self.assertDictEqual(self.ledger.summary(), {DONE: 3, FAILED: 1, PENDING: 2})
+
+    def test_resume(self):
+        self.ledger.record(2, 'fetch')
+        self.ledger.close()
+
+        # adding the users again keeps their state
+        self.ledger = JobLedger(self.ledger_path)
+        self.ledger.add([1, 2, 3], self.stages)
+        self.assertListEqual(self.ledger.pending(self.stages), [(2, ['theo']), (3, self.stages),
+                                                                (1, self.stages)])
+
+    def test_skips_done(self):
+        self.ledger.record(2, 'fetch')
+        self.ledger.record(2, 'theo')
+        # would fail if it ran again
+        summary = self.run_task({'fetch': ([2], fail), 'theo': ([2], fail)})
+
+        self.assertDictEqual(summary, {DONE: 6})
+        self.assertTrue(all(attempts == 1 for _, attempts in self.statuses().values()))
+
+    def test_retries_failed(self):
+        summary = self.run_task({'fetch': ([1], fail_once), 'theo': ([3], fail)}, max_attempts=3)
+
+        statuses = self.statuses()
+        self.assertDictEqual(summary, {DONE: 5, FAILED: 1})
+        self.assertEqual(statuses[1, 'fetch'], (DONE, 2))
+        self.assertEqual(statuses[1, 'theo'], (DONE, 1))
+        self.assertEqual(statuses[3, 'theo'], (FAILED, 3))
+
+        [(user_id, stage, attempts, error)] = self.ledger.failures()
+        self.assertEqual((user_id, stage, attempts), (3, 'theo', 3))
+        self.assertIn('failed for user 3', error)
+
+    def test_crash(self):
+        summary = self.run_task({'fetch': ([], succeed), 'theo': ([2], crash)}, max_attempts=2)
+
+        statuses = self.statuses()
+        self.assertDictEqual(summary, {DONE: 4, FAILED: 1, PENDING: 1})
+        # the stages of a job are recorded when it returns, so the crash is charged to its first stage
+        self.assertEqual(statuses[2, 'fetch'], (FAILED, 2))
+        self.assertIn('exit code 3', self.ledger.failures()[0][3])
+
+    def test_timeout(self):
+        summary = self.run_task({'fetch': ([3], sleep), 'theo': ([], succeed)}, max_attempts=1, timeout=1)
+
+        self.assertDictEqual(summary, {DONE: 4, FAILED: 1, PENDING: 1})
+        self.assertIn('timed out', self.ledger.failures()[0][3])
+
+    def test_reset(self):
+        self.run_task({'fetch': ([], succeed), 'theo': ([1], fail)}, max_attempts=1)
+        self.ledger.reset(['theo'])
+
+        self.assertListEqual(self.ledger.pending(self.stages, max_attempts=1), [(2, ['theo']), (3, ['theo']),
+                                                                                (1, ['theo'])])
+        self.assertDictEqual(self.ledger.summary(), {DONE: 3, PENDING: 3})
+
+    def tearDown(self):
+        self.ledger.close()
+        shutil.rmtree(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
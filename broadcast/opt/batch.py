@@ -0,0 +1,103 @@
+from __future__ import division, print_function
+import numpy as np
+import pyximport; pyximport.install()
+
+from ..opt import utils
+from ..opt.optimizer import exact_projection_rows
+
+
+def stack_problems(followers_wall_intensities, followers_conn_probs, followers_weights):
+    """
+    Stacks the follower data of several users into the ragged layout of optimize_many.
+
+    :param followers_wall_intensities: list of the (F_u, M) wall intensities of each user
+    :param followers_conn_probs: list of the (F_u, M) connection probabilities of each user
+    :param followers_weights: list of the (F_u,) follower weights of each user
+    :return: (wall intensities (F, M), connection probabilities (F, M), weights (F,), offsets (U + 1,)), the
+             followers of the u-th user being the rows offsets[u]:offsets[u + 1]
+    """
+    M = np.shape(followers_wall_intensities[0])[-1]
+    walls = [utils.as_follower_matrix(w, M) for w in followers_wall_intensities]
+    conns = [utils.as_follower_matrix(c, M) for c in followers_conn_probs]
+
+    offsets = np.zeros(len(walls) + 1, dtype=np.int64)
+    np.cumsum([len(w) for w in walls], out=offsets[1:])
+
+    return (np.ascontiguousarray(np.concatenate(walls)), np.ascontiguousarray(np.concatenate(conns)),
+            np.concatenate([np.asarray(w, dtype=np.double) for w in followers_weights]), offsets)
+
+
+def optimize_many(lambda2s, pis, weights, offsets, budgets, upper_bounds, threshold, k=1, x0=None,
+                  gamma=0.8, c=0.5, max_iterations=50000, verbose=False, with_iter=False):
+    """
+    Runs the projected gradient ascent of optimize_base (weighted top-k utility, exact projection) for many users
+    in lockstep: every iteration evaluates the gradients of all the active users in one grouped kernel call,
+    projects them together, and backtracks the line searches of the users that still need it together. A user
+    leaves the active set when its step gets shorter than threshold or stops improving its utility.
+
+    :param lambda2s: wall intensities of the followers of all the users, (F, M), see stack_problems
+    :param pis: connection probabilities of the followers, (F, M)
+    :param weights: weights of the followers, (F,)
+    :param offsets: the followers of the u-th user are the rows offsets[u]:offsets[u + 1], (U + 1,)
+    :param budgets: budget of each user, (U,)
+    :param upper_bounds: upper bounds of each user, (U, M)
+    :param k: k of the top-k utility, evaluated with the top-k recurrences even for k == 1, as optimize does with
+              weighted_top_k. The results are then not those of optimize with weighted_top_one (the production
+              utility), which rounds differently and so takes a slightly different path: both stop within about
+              threshold of each other, and their weighted_top_one utilities agree to a relative 1e-6.
+    :param x0: starting points, zeros if None, (U, M)
+    :return: optimized intensities (U, M), and the iteration at which each user stopped if with_iter
+    """
+    lambda2s = np.ascontiguousarray(lambda2s, dtype=np.double)
+    pis = np.ascontiguousarray(pis, dtype=np.double)
+    weights = np.ascontiguousarray(weights, dtype=np.double)
+    offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+    budgets = np.asarray(budgets, dtype=np.double)
+    upper_bounds = np.asarray(upper_bounds, dtype=np.double)
+    U, M = upper_bounds.shape
+
+    x = np.zeros((U, M)) if x0 is None else np.array(x0, dtype=np.double)
+    x = exact_projection_rows(x, budgets, upper_bounds)
+    iterations = np.zeros(U, dtype=np.int64)
+
+    # the obvious case of optimize: the upper bounds fit in the budget
+    active = np.flatnonzero(np.sum(upper_bounds, axis=1) > budgets)
+
+    for i in range(max_iterations):
+        if len(active) == 0:
+            break
+
+        xa = np.ascontiguousarray(x[active])
+        e_f, g = utils.grouped_top_k_value_and_grad_batch(xa, active, lambda2s, pis, weights, offsets, k)
+        d = exact_projection_rows(xa + g * 1000., budgets[active], upper_bounds[active]) - xa
+        slopes = np.sum(g * d, axis=1)
+
+        s = np.full(len(active), gamma)
+        trial = np.empty(len(active))
+        searching = np.arange(len(active))
+        while len(searching) > 0:
+            points = np.ascontiguousarray(xa[searching] + s[searching, None] * d[searching])
+            trial[searching] = utils.grouped_top_k_batch(points, active[searching], lambda2s, pis, weights,
+                                                         offsets, k)
+            step_norms = np.linalg.norm(s[searching, None] * d[searching], axis=1)
+            backtrack = (trial[searching] - e_f[searching] < c * s[searching] * slopes[searching]) & \
+                (step_norms > threshold)
+            searching = searching[backtrack]
+            s[searching] *= gamma
+
+        step_norms = np.linalg.norm(s[:, None] * d, axis=1)
+        moving = (step_norms >= threshold) & (trial - e_f > 0)
+        x[active[moving]] += s[moving, None] * d[moving]
+
+        iterations[active[~moving]] = i
+        active = active[moving]
+
+    iterations[active] = max_iterations - 1
+
+    if verbose:
+        print('Done within %d iterations!' % (np.max(iterations) if U > 0 else 0))
+
+    if with_iter:
+        return x, iterations
+    else:
+        return x
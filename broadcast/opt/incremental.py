@@ -0,0 +1,250 @@
+from __future__ import division, print_function
+import numpy as np
+from math import ceil
+import pyximport; pyximport.install()
+
+from ..opt import utils
+from ..opt.optimizer import fused_utilities, optimize
+from ..data import helper
+from ..data.user import User
+from ..util.cal import unix_timestamp
+
+
+def upper_bounds_from_matrices(our_intensity, followers_wall_intensities, followers_weights):
+    """ Vectorized calculate_upper_bounds over the (F, M) wall intensity matrix """
+    our_intensity = np.asarray(our_intensity, dtype=np.double)
+    walls = np.asarray(followers_wall_intensities, dtype=np.double)
+    if walls.shape[0] == 0:
+        return np.zeros(len(our_intensity))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = np.where(walls != 0., our_intensity / walls, 0.)
+    maxes = np.maximum(ratios.max(axis=1), 0.)
+    return np.dot(np.asarray(followers_weights) * maxes, walls)
+
+
+def _window_counts(times, start, end, period_length):
+    """ :return: (tweets per slot, connection bags) of the tweets in [start, end] """
+    times = np.asarray(times)
+    left, right = np.searchsorted(times, start, side='left'), np.searchsorted(times, end, side='right')
+    return helper.get_periodic_statistics_cy(times[left:right], [period_length])[period_length]
+
+
+def _slide_counts(times, old_window, new_window, period_length):
+    """
+    :return: (tweets per slot, connection bags) added to the window when it moves from old_window to new_window,
+             minus the ones removed
+    """
+    (old_start, old_end), (new_start, new_end) = old_window, new_window
+    added_counts, added_bags = _window_counts(times, old_end + 1, new_end, period_length)
+    removed_counts, removed_bags = _window_counts(times, old_start, new_start - 1, period_length)
+    return added_counts - removed_counts, added_bags - removed_bags
+
+
+def _times_from(times, start, copy=True):
+    """ :return: the sorted times from start on, copied unless copy is False so the full array is not kept alive """
+    times = np.asarray(times)
+    times = times[np.searchsorted(times, start, side='left'):]
+    return times.copy() if copy else times
+
+
+class _UserState:
+    def __init__(self, window):
+        self.window = window
+        # times from the start of the window on, and their counts in the window
+        self.own_times = None
+        self.own_counts = None
+        self.follower_ids = []
+        self.followee_ids = {}  # follower id -> its followees but the user
+        self.walls = []
+        self.tweets = []
+        self.wall_counts = None
+        self.conn_bags = None
+        # users whose tweets changed since the last refresh, None if any may have
+        self.updated = None
+        self.x = None
+
+
+class IncrementalOptimizer:
+    """
+    Re-optimizes the same users as their learning window slides and new tweets come in.
+
+    For each user it keeps the tweet times of the user and of its followers' walls and tweets from the start of the
+    window on, their slot counts in the window and the last optimum. The tweets are assumed unchanged between two
+    refreshes but for the users passed to updated (e.g. from StreamingEstimator.pop_updated_users): a refresh
+    reads again only the followers who are one of them or follow one of them, dropping the memoized tweet lists of
+    these followers and the cached tweets of the updated users, and only moves the window over the kept times for
+    the others. The optimization is warm-started from the last optimum. Sliding needs windows starting and ending
+    on hour boundaries (so connection bags do not straddle them), as the day-aligned windows of the experiments
+    do; other windows are counted from scratch.
+    """
+
+    def __init__(self, period_length=24 * 7, start_hour=0, end_hour=24,
+                 util=utils.weighted_top_one, util_gradient=utils.weighted_top_one_grad,
+                 threshold=0.005, extra_opt=None, projection_method='exact', solver='pgd', util_and_gradient=None):
+        """
+        See learn_and_optimize for the parameters.
+        """
+        self.period_length = period_length
+        self.start_hour = start_hour
+        self.end_hour = end_hour
+        self.util = util
+        self.util_gradient = util_gradient
+        self.threshold = threshold
+        self.extra_opt = [] if extra_opt is None else extra_opt
+        self.projection_method = projection_method
+        self.solver = solver
+        if util_and_gradient is None:
+            util_and_gradient = fused_utilities.get((util, util_gradient))
+        self.util_and_gradient = util_and_gradient
+
+        self._states = {}
+        # users whose cached tweets in the repository are stale, None for all of them
+        self._stale_tweets = set()
+
+    def forget(self, user_id):
+        self._states.pop(user_id, None)
+
+    def updated(self, user_ids=None):
+        """
+        Records that the tweets of the users changed, so the next refresh of each user reads again the followers
+        they affect.
+
+        :param user_ids: users having new (or removed) tweets, all the users if None
+        """
+        if user_ids is None:
+            self._stale_tweets = None
+            for state in self._states.values():
+                state.updated = None
+            return
+
+        user_ids = set(user_ids)
+        if self._stale_tweets is not None:
+            self._stale_tweets |= user_ids
+        for state in self._states.values():
+            if state.updated is not None:
+                state.updated |= user_ids
+
+    def _can_slide(self, state, window):
+        (old_start, old_end), (new_start, new_end) = state.window, window
+        aligned = all(t % 3600 == 0 for t in [old_start, old_end + 1, new_start, new_end + 1])
+        return aligned and old_start <= new_start <= old_end + 1 and old_end <= new_end
+
+    def _fetch(self, user, follower, start):
+        """ :return: (wall, tweets) of the follower from start on, read again from the repository """
+        User.wall_tweet_list.invalidate(follower, excluded_user_id=user.user_id())
+        User.tweet_list.invalidate(follower)
+        wall = follower.wall_tweet_list(excluded_user_id=user.user_id())._get_tweet_list()
+        return _times_from(wall, start), _times_from(follower.tweet_list()._get_tweet_list(), start)
+
+    def _refresh(self, state, user, window):
+        """
+        Moves the state to window, reading again and counting from scratch only the new followers and the ones
+        affected by the updated users.
+
+        :return: number of followers read again
+        """
+        p = self.period_length
+        start, end = window
+        updated = state.updated
+
+        if updated is None or user.user_id() in updated:
+            User.tweet_list.invalidate(user)
+            state.own_times = _times_from(user.tweet_list()._get_tweet_list(), start)
+            state.own_counts = _window_counts(state.own_times, start, end, p)[0]
+        else:
+            state.own_counts = state.own_counts + _slide_counts(state.own_times, state.window, window, p)[0]
+            state.own_times = _times_from(state.own_times, start, copy=False)
+
+        followers = user.followers()
+        follower_ids = [follower.user_id() for follower in followers]
+        rows = {follower_id: i for i, follower_id in enumerate(state.follower_ids)}
+
+        new_ids = [follower_id for follower_id in follower_ids if follower_id not in rows]
+        followee_ids = {follower_id: state.followee_ids[follower_id] for follower_id in follower_ids
+                        if follower_id in rows}
+        for follower_id, followees in user._repo.get_users_followees(new_ids).items():
+            followee_ids[follower_id] = frozenset(followees) - {user.user_id()}
+
+        walls, tweets = [], []
+        wall_counts = np.zeros((len(followers), p), dtype=np.int64)
+        conn_bags = np.zeros((len(followers), p), dtype=np.int64)
+        fetched = 0
+
+        for i, follower in enumerate(followers):
+            follower_id = follower.user_id()
+            row = rows.get(follower_id)
+            if row is None or updated is None or follower_id in updated or \
+                    not updated.isdisjoint(followee_ids[follower_id]):
+                wall, follower_tweets = self._fetch(user, follower, start)
+                wall_counts[i] = _window_counts(wall, start, end, p)[0]
+                conn_bags[i] = _window_counts(follower_tweets, start, end, p)[1]
+                fetched += 1
+            else:
+                wall, follower_tweets = state.walls[row], state.tweets[row]
+                wall_counts[i] = state.wall_counts[row] + _slide_counts(wall, state.window, window, p)[0]
+                conn_bags[i] = state.conn_bags[row] + _slide_counts(follower_tweets, state.window, window, p)[1]
+                wall, follower_tweets = _times_from(wall, start, False), _times_from(follower_tweets, start, False)
+
+            walls.append(wall)
+            tweets.append(follower_tweets)
+
+        state.window = window
+        state.follower_ids = follower_ids
+        state.followee_ids = followee_ids
+        state.walls, state.tweets = walls, tweets
+        state.wall_counts, state.conn_bags = wall_counts, conn_bags
+        state.updated = set()
+        return fetched
+
+    def optimize(self, user, learn_start_date, learn_end_date, budget=None, verbose=False):
+        """
+        Same as learn_and_optimize, reusing the counts and the optimum of the previous call for the user.
+
+        :type user: data.user.User
+        :return: (optimized intensity, upper bounds)
+        """
+        window = (unix_timestamp(learn_start_date), unix_timestamp(learn_end_date))
+        state = self._states.get(user.user_id())
+
+        user._repo.invalidate_user_tweets(self._stale_tweets)
+        self._stale_tweets = set()
+
+        if state is None or not self._can_slide(state, window):
+            state = _UserState(window)
+            self._states[user.user_id()] = state
+        fetched = self._refresh(state, user, window)
+
+        if verbose:
+            print('%d of %d followers read again' % (fetched, len(state.follower_ids)))
+
+        period_count = int(ceil(window[1] / 3600 / self.period_length)) - \
+            int(window[0] / 3600 / self.period_length)
+        hours = slice(self.start_hour, self.end_hour)
+        oi = state.own_counts[hours] / period_count
+        followers_wall_intensities = np.ascontiguousarray(state.wall_counts[:, hours] / period_count)
+        followers_conn_prob = np.ascontiguousarray(state.conn_bags[:, hours] / period_count)
+        followers_weights = np.array([user.get_follower_weight(follower) for follower in user.followers()])
+
+        if budget is None:
+            budget = sum(oi)
+        upper_bounds = upper_bounds_from_matrices(oi, followers_wall_intensities, followers_weights)
+
+        def _util(x):
+            return self.util(x, followers_wall_intensities, followers_conn_prob, followers_weights, *self.extra_opt)
+
+        def _util_grad(x):
+            return self.util_gradient(x, followers_wall_intensities, followers_conn_prob, followers_weights,
+                                      *self.extra_opt)
+
+        _util_and_grad = None
+        if self.util_and_gradient is not None:
+            def _util_and_grad(x):
+                return self.util_and_gradient(x, followers_wall_intensities, followers_conn_prob, followers_weights,
+                                              *self.extra_opt)
+
+        x0 = np.zeros(len(upper_bounds)) if state.x is None else state.x.copy()
+        state.x = np.array(optimize(_util, _util_grad, budget, upper_bounds, threshold=self.threshold, x0=x0,
+                                    verbose=verbose, projection_method=self.projection_method, solver=self.solver,
+                                    util_and_grad=_util_and_grad), dtype=np.double)
+        return state.x.copy(), upper_bounds
@@ -4,6 +4,7 @@ from cvxopt import matrix, solvers
 import pyximport; pyximport.install()
 
 from ..opt import utils
+from ..util.cache import LRUCache
 
 # from opt import utils
 # import opt_utils as utils
@@ -41,8 +42,98 @@ def projection(q, P, G, h, A, C):
     return np.reshape(sol['x'], len(sol['x']))
 
 
-def optimize_base(util, grad, proj, x0, threshold, gamma=0.8, c=0.5, verbose=False, with_iter=False):
+def exact_projection(q, budget, upper_bounds):
+    """
+    minimize    (1/2)*||x - q||^2
+    subject to  0 <= x <= upper_bounds
+                sum(x) = budget
+
+    The solution is clip(q - tau, 0, upper_bounds), where sum(clip(q - tau, 0, upper_bounds)) is piecewise linear and
+    non-increasing in tau with breakpoints at q - upper_bounds and q; sorting them gives tau in O(n log n).
+    """
+    q = np.asarray(q, dtype=np.double)
+    upper_bounds = np.asarray(upper_bounds, dtype=np.double)
+    return exact_projection_rows(q[None, :], [budget], upper_bounds[None, :])[0]
+
+
+def exact_projection_rows(qs, budgets, upper_bounds):
+    """
+    exact_projection of each row of qs, with its own budget and upper bounds, vectorized over the rows.
+
+    :param qs: points to project, shape (U, n)
+    :param budgets: shape (U,)
+    :param upper_bounds: shape (U, n)
+    """
+    qs = np.asarray(qs, dtype=np.double)
+    budgets = np.asarray(budgets, dtype=np.double)
+    upper_bounds = np.asarray(upper_bounds, dtype=np.double)
+    U, n = qs.shape
+
+    totals = np.sum(upper_bounds, axis=1)
+    result = np.zeros((U, n))
+    full = totals <= budgets
+    result[full] = upper_bounds[full]
+
+    rows = np.flatnonzero(~full & (budgets > 0.))
+    if len(rows) == 0:
+        return result
+    q, ub, budget = qs[rows], upper_bounds[rows], budgets[rows]
+
+    breakpoints = np.concatenate([q - ub, q], axis=1)
+    order = np.argsort(breakpoints, axis=1, kind='mergesort')
+    breakpoints = np.take_along_axis(breakpoints, order, axis=1)
+
+    # a coordinate starts decreasing at q - upper_bounds and stops at q
+    directions = np.concatenate([-np.ones(n), np.ones(n)])
+    slopes = np.cumsum(directions[order], axis=1)
+    sums = np.empty_like(breakpoints)
+    sums[:, 0] = totals[rows]
+    sums[:, 1:] = totals[rows, None] + np.cumsum(slopes[:, :-1] * np.diff(breakpoints, axis=1), axis=1)
+
+    # the segment where the sum goes below the budget
+    j = np.sum(sums > budget[:, None], axis=1) - 1
+    r = np.arange(len(rows))
+    tau = breakpoints[r, j] + (budget - sums[r, j]) / slopes[r, j]
+
+    result[rows] = np.clip(q - tau[:, None], 0., ub)
+    return result
+
+
+def memoize_steps(util, grad, util_and_grad=None, max_entries=4):
+    """
+    Wraps the utility and its gradient for a solver: the utilities of the last few points are remembered, as the
+    line searches evaluate the same points again, and if util_and_grad (returning both in one pass) is given, the
+    gradients come with the utility of their point.
+
+    :return: (util, grad)
+    """
+    values = LRUCache(max_entries=max_entries)
+
+    def _util(x):
+        key = x.tobytes()
+        value = values.get(key)
+        if value is None:
+            value = util(x)
+            values.put(key, value)
+        return value
+
+    def _grad(x):
+        if util_and_grad is None:
+            return grad(x)
+        value, g = util_and_grad(x)
+        values.put(x.tobytes(), value)
+        return g
+
+    return _util, _grad
+
+
+def optimize_base(util, grad, proj, x0, threshold, gamma=0.8, c=0.5, verbose=False, with_iter=False,
+                  util_and_grad=None):
+    """
+    :param util_and_grad: optional function returning (util(x), grad(x)) from a single pass
+    """
     max_iterations = 50000
+    util, grad = memoize_steps(util, grad, util_and_grad)
 #     print('difference before and after proj:')
 #     print(x0 - proj(x0))
 #     print(np.linalg.norm(x0 - proj(x0)))
@@ -83,12 +174,92 @@ def optimize_base(util, grad, proj, x0, threshold, gamma=0.8, c=0.5, verbose=Fal
         return x
 
 
-def optimize(util, util_grad, budget, upper_bounds, threshold, x0=None, verbose=False, with_iter=False):
-    # start = int(round(time.time() * 1000))
-    proj_params = get_projector_parameters(budget, upper_bounds)
+def optimize_spg(util, grad, proj, x0, threshold, gamma=0.5, c=1e-4, memory=10, step_min=1e-10, step_max=1e10,
+                 initial_step=1000., verbose=False, with_iter=False, util_and_grad=None):
+    """
+    Spectral projected gradient ascent: the gradient step length is the Barzilai-Borwein ratio of the last two
+    iterates and gradients, and the line search along the projected direction only requires a sufficient increase
+    over the smallest of the last `memory` utilities (non-monotone), so most iterations take the full step with a
+    single utility evaluation. Stops, as optimize_base, when two consecutive iterates are closer than threshold
+    with the step length initial_step.
+
+    :param util_and_grad: optional function returning (util(x), grad(x)) from a single pass
+    """
+    max_iterations = 50000
+    util, grad = memoize_steps(util, grad, util_and_grad)
+
+    x = proj(x0)
+    g = grad(x)
+    f = util(x)
+    step = initial_step
+    history = [f]
+    best_x, best_f = x, f
+
+    for i in range(max_iterations):
+        d = proj(x + step * g) - x
+        f_ref = min(history[-memory:])
+        slope = np.dot(g, d)
+
+        s = 1.
+        f_new = util(x + s * d)
+        while f_new < f_ref + c * s * slope and np.linalg.norm(s * d) > threshold:
+            s *= gamma
+            f_new = util(x + s * d)
+
+        x_new = x + s * d
+        if f_new > best_f:
+            best_x, best_f = x_new, f_new
+
+        if np.linalg.norm(s * d) < threshold:
+            if step == initial_step:
+                break
+            # the spectral step may just be too short, so check again with the initial step before stopping
+            step = initial_step
+            continue
+
+        g_new = grad(x_new)
+        dx, dg = x_new - x, g - g_new
+        curvature = np.dot(dx, dg)
+        step = step_max if curvature <= 0. else min(step_max, max(step_min, np.dot(dx, dx) / curvature))
+
+        x, f, g = x_new, f_new, g_new
+        history.append(f)
+
+    if verbose:
+        print('Done within %d iterations!' % i)
+
+    if with_iter:
+        return best_x, i
+    else:
+        return best_x
 
-    def proj(x):
-        return projection(x, *proj_params)
+
+def optimize(util, util_grad, budget, upper_bounds, threshold, x0=None, verbose=False, with_iter=False,
+             projection_method='exact', solver='pgd', util_and_grad=None):
+    """
+    :param util_and_grad: optional function returning (util(x), util_grad(x)) from a single pass
+    :param projection_method: 'exact' for the sort based projection, or 'cvxopt' for solving the projection QP
+    :param solver: 'pgd' for the projected gradient ascent of optimize_base, or 'spg' for the spectral projected
+                   gradient of optimize_spg
+    """
+    if solver == 'pgd':
+        solve = optimize_base
+    elif solver == 'spg':
+        solve = optimize_spg
+    else:
+        raise ValueError('Unknown solver: %s' % solver)
+
+    # start = int(round(time.time() * 1000))
+    if projection_method == 'exact':
+        def proj(x):
+            return exact_projection(x, budget, upper_bounds)
+    elif projection_method == 'cvxopt':
+        proj_params = get_projector_parameters(budget, upper_bounds)
+
+        def proj(x):
+            return projection(x, *proj_params)
+    else:
+        raise ValueError('Unknown projection method: %s' % projection_method)
 
     if sum(upper_bounds) <= budget:
         if verbose:
@@ -98,12 +269,21 @@ def optimize(util, util_grad, budget, upper_bounds, threshold, x0=None, verbose=
         else:
             return upper_bounds
 
-    opt_rates = optimize_base(util, util_grad, proj, x0, threshold, verbose=verbose, with_iter=with_iter)
+    opt_rates = solve(util, util_grad, proj, x0, threshold, verbose=verbose, with_iter=with_iter,
+                      util_and_grad=util_and_grad)
     # delta = int(round(time.time() * 1000)) - start
     # sys.stderr.write('Total time: %d' % delta)
     return opt_rates
 
 
+# (utility, gradient) -> value and gradient from a single pass
+fused_utilities = {
+    (utils.weighted_top_one, utils.weighted_top_one_grad): utils.weighted_top_one_value_and_grad,
+    (utils.weighted_top_one_k, utils.weighted_top_one_k_grad): utils.weighted_top_one_k_value_and_grad,
+    (utils.weighted_top_k, utils.weighted_top_k_grad): utils.weighted_top_k_value_and_grad,
+}
+
+
 def learn_and_optimize(user, budget=None, upper_bounds=None,
                        period_length=24 * 7,
                        start_hour=0, end_hour=24,
@@ -112,14 +292,19 @@ def learn_and_optimize(user, budget=None, upper_bounds=None,
                        threshold=0.005,
                        extra_opt=None,
                        x0=None,
-                       conn=None, inten=None):
+                       conn=None, inten=None,
+                       projection_method='exact', solver='pgd', util_and_gradient=None):
     """
     :param budget: maximum budget we have
     :param period_length: length of the periods in hours
     :param util_gradient: gradient of the utility function
     :param util: utility function
+    :param util_and_gradient: function returning both in a single pass, by default the fused version of the
+                              utilities of opt.utils that have one
     :param threshold: when norm of the difference of two consecutive iterations is less than this threshold, stop
     :param extra_opt: used for giving extra arguments to utility functions, such as k value
+    :param projection_method: 'exact' (default) or 'cvxopt', see optimize
+    :param solver: 'pgd' (default) or 'spg', see optimize
     :type user: User
     :type upper_bounds: np.ndarray
     :type start_hour: float
@@ -171,6 +356,10 @@ def learn_and_optimize(user, budget=None, upper_bounds=None,
         else:
             followers_conn_prob = conn
 
+    # stack the follower data once, so the utilities do not re-collect it on every evaluation
+    followers_wall_intensities = utils.as_follower_matrix(followers_wall_intensities, len(upper_bounds))
+    followers_conn_prob = utils.as_follower_matrix(followers_conn_prob, len(upper_bounds))
+
     print('upper bounds: ')
     print(upper_bounds)
     print('budget: ')
@@ -182,8 +371,18 @@ def learn_and_optimize(user, budget=None, upper_bounds=None,
     def _util_grad(x):
         return util_gradient(x, followers_wall_intensities, followers_conn_prob, followers_weights, *extra_opt)
 
+    if util_and_gradient is None:
+        util_and_gradient = fused_utilities.get((util, util_gradient))
+    _util_and_grad = None
+    if util_and_gradient is not None:
+        def _util_and_grad(x):
+            return util_and_gradient(x, followers_wall_intensities, followers_conn_prob, followers_weights,
+                                     *extra_opt)
+
     x0 = np.array([0.] * len(upper_bounds)) if x0 is None else x0
-    return optimize(_util, _util_grad, budget, upper_bounds, threshold=threshold, x0=x0), upper_bounds
+    return optimize(_util, _util_grad, budget, upper_bounds, threshold=threshold, x0=x0,
+                    projection_method=projection_method, solver=solver,
+                    util_and_grad=_util_and_grad), upper_bounds
 
 
 def calculate_upper_bounds(user, learn_start_date, learn_end_date, start_hour, end_hour, our_intensity, period_length):
@@ -0,0 +1,296 @@
+from __future__ import division
+import contextlib
+import io
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+from cvxopt import solvers
+import pyximport; pyximport.install()
+
+from ..data.user import User
+from ..data.user_repo import UserRepository
+from ..opt import utils
+from ..opt.batch import optimize_many, stack_problems
+from ..opt.incremental import IncrementalOptimizer
+from ..opt.optimizer import exact_projection, exact_projection_rows, get_projector_parameters, learn_and_optimize, \
+    optimize, projection
+from ..util.cal import unix_timestamp
+
+
+def finite_difference_gradient(f, x, eps=1e-6):
+    grad = np.zeros(len(x))
+    for i in range(len(x)):
+        dx = np.zeros(len(x))
+        dx[i] = eps
+        grad[i] = (f(x + dx) - f(x - dx)) / (2. * eps)
+    return grad
+
+
+class TestGradients(unittest.TestCase):
+    def setUp(self):
+        self.rs = np.random.RandomState(42)
+        self.M = 24
+
+    def random_follower(self):
+        lambda1 = self.rs.uniform(0.1, 2., self.M)
+        lambda2 = self.rs.uniform(0., 5., self.M)
+        pi = self.rs.uniform(0., 1., self.M)
+        # slots where the wall is empty
+        lambda2[self.rs.rand(self.M) < 0.2] = 0.
+        return lambda1, lambda2, pi
+
+    def test_gradient_top_one(self):
+        for _ in range(5):
+            lambda1, lambda2, pi = self.random_follower()
+            expected = finite_difference_gradient(lambda x: utils.expected_f_top_one(x, lambda2, pi), lambda1)
+            np.testing.assert_allclose(utils.gradient_top_one(lambda1, lambda2, pi), expected,
+                                       rtol=1e-5, atol=1e-7)
+
+    def test_gradient_top_k(self):
+        for k in [1, 2, 4]:
+            lambda1, lambda2, pi = self.random_follower()
+            expected = finite_difference_gradient(lambda x: utils.expected_f_top_k(x, lambda2, k, pi), lambda1)
+            np.testing.assert_allclose(utils.gradient_top_k(lambda1, lambda2, k, pi), expected,
+                                       rtol=1e-5, atol=1e-7)
+
+    def test_weighted_gradients(self):
+        F = 6
+        lambda1 = self.rs.uniform(0., 2., self.M)
+        lambda2s = self.rs.uniform(0., 5., (F, self.M))
+        pis = self.rs.uniform(0., 1., (F, self.M))
+        weights = self.rs.uniform(0., 1., F)
+
+        expected = finite_difference_gradient(lambda x: utils.weighted_top_one(x, lambda2s, pis, weights), lambda1)
+        np.testing.assert_allclose(utils.weighted_top_one_grad(lambda1, lambda2s, pis, weights), expected,
+                                   rtol=1e-5, atol=1e-7)
+
+        expected = finite_difference_gradient(lambda x: utils.weighted_top_k(x, lambda2s, pis, weights, 2), lambda1)
+        np.testing.assert_allclose(utils.weighted_top_k_grad(lambda1, lambda2s, pis, weights, 2), expected,
+                                   rtol=1e-5, atol=1e-7)
+
+    def tearDown(self):
+        pass
+
+
+class TestProjection(unittest.TestCase):
+    def setUp(self):
+        self.rs = np.random.RandomState(7)
+        # the default tolerances of cvxopt leave errors up to 1e-2 in the coordinates
+        self.solver_options = dict(solvers.options)
+        solvers.options.update(abstol=1e-12, reltol=1e-12, feastol=1e-12)
+
+    def random_problem(self, n):
+        q = self.rs.normal(0., 5., n)
+        upper_bounds = self.rs.uniform(0., 3., n)
+        upper_bounds[self.rs.rand(n) < 0.1] = 0.
+        budget = self.rs.uniform(0., 1.) * np.sum(upper_bounds)
+        return q, budget, upper_bounds
+
+    def test_against_cvxopt(self):
+        for n in [1, 2, 5, 24, 168]:
+            for _ in range(5):
+                q, budget, upper_bounds = self.random_problem(n)
+                x = exact_projection(q, budget, upper_bounds)
+                expected = projection(q, *get_projector_parameters(budget, upper_bounds))
+
+                np.testing.assert_allclose(x, expected, atol=1e-6)
+                self.assertAlmostEqual(np.sum(x), budget)
+                self.assertTrue(np.all(x >= 0.) and np.all(x <= upper_bounds))
+
+    def test_edge_budgets(self):
+        q, _, upper_bounds = self.random_problem(24)
+        np.testing.assert_array_equal(exact_projection(q, 0., upper_bounds), np.zeros(24))
+        np.testing.assert_array_equal(exact_projection(q, np.sum(upper_bounds) + 1., upper_bounds), upper_bounds)
+
+    def test_rows(self):
+        problems = [self.random_problem(24) for _ in range(10)]
+        qs, budgets, upper_bounds = [np.array(a) for a in zip(*problems)]
+
+        xs = exact_projection_rows(qs, budgets, upper_bounds)
+        for i in range(len(problems)):
+            np.testing.assert_array_equal(xs[i], exact_projection(qs[i], budgets[i], upper_bounds[i]))
+
+    def tearDown(self):
+        solvers.options.clear()
+        solvers.options.update(self.solver_options)
+
+
+class TestSolvers(unittest.TestCase):
+    def setUp(self):
+        self.rs = np.random.RandomState(5)
+        self.M = 12
+
+    def random_problem(self, k):
+        lambda2s = self.rs.uniform(0., 5., (10, self.M))
+        pis = self.rs.uniform(0., 1., (10, self.M))
+        weights = self.rs.uniform(0., 1., 10)
+        upper_bounds = self.rs.uniform(0., 2., self.M)
+        budget = 0.3 * np.sum(upper_bounds)
+        if k == 1:
+            functions = utils.weighted_top_one, utils.weighted_top_one_grad, utils.weighted_top_one_value_and_grad
+            args = (lambda2s, pis, weights)
+        else:
+            functions = utils.weighted_top_k, utils.weighted_top_k_grad, utils.weighted_top_k_value_and_grad
+            args = (lambda2s, pis, weights, k)
+        util, grad, util_and_grad = [lambda x, f=f: f(x, *args) for f in functions]
+        return util, grad, util_and_grad, budget, upper_bounds
+
+    def test_spg_against_pgd(self):
+        for k in [1, 2]:
+            util, grad, util_and_grad, budget, upper_bounds = self.random_problem(k)
+            x = {}
+            for solver in ['pgd', 'spg']:
+                x[solver], iterations = optimize(util, grad, budget, upper_bounds, 1e-3, x0=np.zeros(self.M),
+                                                 with_iter=True, solver=solver, util_and_grad=util_and_grad)
+                self.assertGreater(iterations, 0)
+                self.assertLess(iterations, 50000 - 1)
+
+            # within the box and on the budget
+            self.assertTrue(np.all(x['spg'] >= 0.) and np.all(x['spg'] <= upper_bounds))
+            self.assertAlmostEqual(np.sum(x['spg']), budget)
+            self.assertGreaterEqual(util(x['spg']), util(x['pgd']) * (1. - 1e-4))
+
+    def test_obvious_case(self):
+        util, grad, _, _, upper_bounds = self.random_problem(1)
+        x, iterations = optimize(util, grad, np.sum(upper_bounds) + 1., upper_bounds, 1e-3, x0=np.zeros(self.M),
+                                 with_iter=True, solver='spg')
+        np.testing.assert_array_equal(x, upper_bounds)
+        self.assertEqual(iterations, 0)
+        self.assertRaises(ValueError, optimize, util, grad, 1., upper_bounds, 1e-3, x0=np.zeros(self.M),
+                          solver='newton')
+
+    def tearDown(self):
+        pass
+
+
+class TestOptimizeMany(unittest.TestCase):
+    def setUp(self):
+        self.rs = np.random.RandomState(3)
+        self.M = 12
+        self.walls = [self.rs.uniform(0., 5., (self.rs.randint(1, 6), self.M)) for _ in range(4)]
+        self.conns = [self.rs.uniform(0., 1., w.shape) for w in self.walls]
+        self.weights = [self.rs.uniform(0., 1., len(w)) for w in self.walls]
+        self.upper_bounds = self.rs.uniform(0., 2., (4, self.M))
+        self.budgets = self.rs.uniform(0.2, 0.6, 4) * np.sum(self.upper_bounds, axis=1)
+        # the obvious case
+        self.budgets[0] = np.sum(self.upper_bounds[0]) + 1.
+
+    def optimize_one(self, u, k, threshold):
+        args = (self.walls[u], self.conns[u], self.weights[u], k)
+        return optimize(lambda x: utils.weighted_top_k(x, *args), lambda x: utils.weighted_top_k_grad(x, *args),
+                        self.budgets[u], self.upper_bounds[u], threshold, x0=np.zeros(self.M), with_iter=True,
+                        util_and_grad=lambda x: utils.weighted_top_k_value_and_grad(x, *args))
+
+    def test_against_optimize(self):
+        # k == 1 included: the grouped kernel uses the top-k recurrences, not the top-one ones
+        for k in [1, 3]:
+            x, iterations = optimize_many(*stack_problems(self.walls, self.conns, self.weights),
+                                          budgets=self.budgets, upper_bounds=self.upper_bounds, threshold=1e-2,
+                                          k=k, with_iter=True)
+            for u in range(len(self.walls)):
+                expected, expected_iterations = self.optimize_one(u, k, 1e-2)
+                np.testing.assert_array_equal(x[u], expected)
+                self.assertEqual(iterations[u], expected_iterations)
+
+    def test_against_weighted_top_one(self):
+        # the path of the production utility differs, only the stopping points are close
+        threshold = 1e-4
+        x = optimize_many(*stack_problems(self.walls, self.conns, self.weights), budgets=self.budgets,
+                          upper_bounds=self.upper_bounds, threshold=threshold, k=1)
+        for u in range(len(self.walls)):
+            args = (self.walls[u], self.conns[u], self.weights[u])
+            expected = optimize(lambda x: utils.weighted_top_one(x, *args),
+                                lambda x: utils.weighted_top_one_grad(x, *args),
+                                self.budgets[u], self.upper_bounds[u], threshold, x0=np.zeros(self.M))
+            np.testing.assert_allclose(utils.weighted_top_one(x[u], *args), utils.weighted_top_one(expected, *args),
+                                       rtol=1e-6)
+            np.testing.assert_allclose(x[u], expected, atol=10 * threshold)
+
+    def tearDown(self):
+        pass
+
+
+class MemoryUserRepository(UserRepository):
+    """ Tweets and links in dicts, recording the users whose tweets or walls are read """
+
+    def __init__(self, tweets, followees):
+        self.tweets = tweets
+        self.followees = followees
+        self.reads = set()
+
+    def get_user_tweets(self, user_id):
+        self.reads.add(user_id)
+        return self.tweets[user_id]
+
+    def get_user_followers(self, user_id):
+        return [follower_id for follower_id in sorted(self.followees) if user_id in self.followees[follower_id]]
+
+    def get_user_followees(self, user_id):
+        return self.followees[user_id]
+
+    def get_user_wall(self, user_id, excluded=0):
+        self.reads.add(user_id)
+        walls = [self.tweets[followee_id] for followee_id in self.followees[user_id] if followee_id != excluded]
+        return np.sort(np.concatenate(walls)) if walls else np.zeros(0, dtype=np.int64)
+
+
+class TestIncrementalOptimizer(unittest.TestCase):
+    def setUp(self):
+        self.rs = np.random.RandomState(1)
+        self.start = datetime(2009, 1, 1)
+        self.end = unix_timestamp(self.start + timedelta(days=30))
+        users = range(30)
+        tweets = dict((user_id, self.random_tweets(self.rs.randint(20, 200))) for user_id in users)
+        followees = dict((user_id, sorted(set(self.rs.choice(30, 6, replace=False)) - {user_id}))
+                         for user_id in users)
+        self.repo = MemoryUserRepository(tweets, followees)
+
+    def random_tweets(self, count):
+        return np.sort(self.rs.randint(unix_timestamp(self.start), self.end, count)).astype(np.int64)
+
+    def affected(self, user_id, updated):
+        """ :return: the user if updated and its followers who are updated or follow an updated user """
+        affected = set(updated) & {user_id}
+        for follower_id in self.repo.get_user_followers(user_id):
+            if follower_id in updated or set(self.repo.followees[follower_id]) - {user_id} & set(updated):
+                affected.add(follower_id)
+        return affected
+
+    def test_sliding_window(self):
+        optimizer = IncrementalOptimizer(period_length=24, threshold=1e-4, solver='spg')
+        users = [User(user_id, self.repo) for user_id in range(3)]
+
+        for day in range(6):
+            learn_start_date = self.start + timedelta(days=day)
+            learn_end_date = learn_start_date + timedelta(days=20) - timedelta(seconds=1)
+            updated = []
+            if day >= 2:
+                # new tweets of a few users
+                updated = self.rs.choice(30, 3, replace=False).tolist()
+                for user_id in updated:
+                    self.repo.tweets[user_id] = np.sort(np.concatenate([self.repo.tweets[user_id],
+                                                                        self.random_tweets(5)]))
+                optimizer.updated(updated)
+
+            for user in users:
+                self.repo.reads = set()
+                x, upper_bounds = optimizer.optimize(user, learn_start_date, learn_end_date)
+                if day > 0:
+                    # the same User objects, so their memoized tweets must not be stale either
+                    self.assertSetEqual(self.repo.reads, self.affected(user.user_id(), updated))
+
+                with contextlib.redirect_stdout(io.StringIO()):
+                    expected, expected_upper_bounds = learn_and_optimize(
+                        User(user.user_id(), self.repo), period_length=24, learn_start_date=learn_start_date,
+                        learn_end_date=learn_end_date, threshold=1e-4, solver='spg')
+                np.testing.assert_allclose(upper_bounds, expected_upper_bounds, rtol=1e-12)
+                # warm-started from the last optimum, so only as close as the threshold allows
+                np.testing.assert_allclose(x, expected, atol=1e-4)
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()
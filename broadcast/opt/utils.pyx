@@ -4,9 +4,31 @@ import numpy as np
 cimport numpy as np
 
 import cython
+from cython.parallel cimport parallel, prange, threadid
 
 from libc.math cimport exp, pow
 
+# number of threads between which the batched utilities split the followers
+cdef int _num_threads = 1
+
+
+def set_num_threads(int num_threads):
+    """ Sets the number of threads of the batched utilities and gradients (1 by default) """
+    global _num_threads
+    if num_threads < 1:
+        raise ValueError('num_threads must be positive')
+    _num_threads = num_threads
+
+
+def get_num_threads():
+    return _num_threads
+
+
+cdef inline int _thread_count(Py_ssize_t followers):
+    if followers < _num_threads:
+        return max(<int> followers, 1)
+    return _num_threads
+
 
 # <editor-fold desc="Basic Functions">
 
@@ -32,7 +54,7 @@ cpdef np.ndarray f(double t, int k, double b, double c, np.ndarray h):
     return np.dot(poly_t, alphas) * exp(-(b + c) * t) + betas
 
 
-cdef double our_gamma_function(int n, double x):
+cdef double our_gamma_function(int n, double x) nogil:
     # evaluates n!(1 - exp(-x) * sum (0..n) x**i / i!)
 
     cdef double result = 0., mul = 1., fact = 1.
@@ -120,66 +142,209 @@ cpdef double expected_f_top_k(np.ndarray lambda1, np.ndarray lambda2, int k, np.
     return result
 
 
-cdef np.ndarray gradient_top_k(np.ndarray lambda1, np.ndarray lambda2, int k, np.ndarray pi=None):
+cdef double t_pow_exp_integral(int i, double s) nogil:
+    # evaluates integral (0..1) t**i * exp(-s * t) dt, i.e. our_gamma_function(i, s) / s**(i+1), using the series
+    # sum (-s)**n / (n! (i + n + 1)) for small s where the closed form cancels out
+    if s >= 1.:
+        return our_gamma_function(i, s) * pow(s, -i - 1)
+
+    cdef double result = 0., term = 1.
+    cdef int n = 0
+    while n < 100:
+        result += term / (i + n + 1)
+        n += 1
+        term *= -s / n
+        if -1e-17 < term < 1e-17:
+            break
+    return result
 
-    h0 = np.zeros(k, dtype=np.double)  # if h0 is None else h0
-    # pi = np.ones(k, dtype=np.double) if pi is None else pi
 
-    cdef int n = lambda2.shape[0]
-    cdef np.ndarray grad = np.zeros(n, dtype=np.double)
-    cdef double epsilon = 0.0001
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _top_k_row(const double[::1] lambda1, const double[:, ::1] lambda2s, const double[:, ::1] pis,
+                       Py_ssize_t i, int k, double weight, double[::1] grad, double[:, ::1] hs,
+                       double[:, ::1] work) nogil:
+    # Returns weight * expected_f_top_k of the i-th follower, and if grad is not None, adds its gradient w.r.t. lambda1
+    # to grad by reverse-mode differentiation. hs (M + 1, k) keeps the h entering each slot and work (6, k + 1) is
+    # scratch space, so a gradient costs about two evaluations.
+    #
+    # In a slot with s = b + c, p = b / s, beta[j] = 1 - p**(j+1), d = h - beta and a[j] = b**j / j!:
+    #   value contribution  pi * (beta[k-1] + sum_j a[j] * d[k-1-j] * I[j]),  I[j] = integral (0..1) t**j exp(-s t)
+    #   next h[j]           beta[j] + exp(-s) * sum_(l <= j) a[l] * d[j-l]
+    # and dI[j] / dc = -I[j+1], dbeta[j] / dc = (j + 1) * p**j * b / s**2.
+    cdef Py_ssize_t M = lambda1.shape[0]
+    cdef double[:] beta = work[0], dbeta = work[1], a = work[2], integral = work[3], u = work[4], u_next = work[5]
+
+    cdef Py_ssize_t m
+    cdef int j, l
+    cdef double b, c, s, p, e, pw, conv, dconv, g, result = 0.
 
-    cdef int i
-    cdef double f1, f2
-    for i in range(n):
-        if lambda1[i] >= epsilon:
-            lambda1[i] -= epsilon
-            f1 = expected_f_top_k(lambda1, lambda2, k, pi=pi)
-            lambda1[i] += 2. * epsilon
-            f2 = expected_f_top_k(lambda1, lambda2, k, pi=pi)
-            grad[i] = (f2 - f1) / (2. * epsilon)
-            lambda1[i] -= epsilon
-        else:
-            f1 = expected_f_top_k(lambda1, lambda2, k, pi=pi)
-            lambda1[i] += epsilon
-            f2 = expected_f_top_k(lambda1, lambda2, k, pi=pi)
-            grad[i] = (f2 - f1) / epsilon
-            lambda1[i] -= epsilon
+    for j in range(k):
+        hs[0, j] = 0.
+
+    for m in range(M):
+        b = lambda2s[i, m]
+        c = lambda1[m]
+        s = b + c
+        pw = weight * pis[i, m]
+
+        if s < 1e-5:
+            result += pw * hs[m, k - 1]
+            for j in range(k):
+                hs[m + 1, j] = hs[m, j]
+            continue
+
+        p = b / s
+        e = exp(-s)
+        a[0] = 1.
+        for j in range(k):
+            beta[j] = 1. - pow(p, j + 1)
+            integral[j] = t_pow_exp_integral(j, s)
+            if j > 0:
+                a[j] = a[j - 1] * b / j
+
+        result += pw * beta[k - 1]
+        for j in range(k):
+            result += pw * a[j] * (hs[m, k - 1 - j] - beta[k - 1 - j]) * integral[j]
+
+        for j in range(k):
+            conv = 0.
+            for l in range(j + 1):
+                conv += a[l] * (hs[m, j - l] - beta[j - l])
+            hs[m + 1, j] = beta[j] + e * conv
+
+    if grad is None:
+        return result
+
+    for j in range(k):
+        u[j] = 0.
+
+    for m in range(M - 1, -1, -1):
+        b = lambda2s[i, m]
+        c = lambda1[m]
+        s = b + c
+        pw = weight * pis[i, m]
+
+        if s < 1e-5:
+            # the slot leaves h unchanged, use the derivative of its b, c -> 0 limit: dh[j] / dc = 1 - h[j]
+            g = pw * (1. - hs[m, k - 1]) / 2.
+            for j in range(k):
+                g += u[j] * (1. - hs[m, j])
+            grad[m] += g
+            u[k - 1] += pw
+            continue
+
+        p = b / s
+        e = exp(-s)
+        a[0] = 1.
+        for j in range(k + 1):
+            integral[j] = t_pow_exp_integral(j, s)
+        for j in range(k):
+            beta[j] = 1. - pow(p, j + 1)
+            dbeta[j] = (j + 1) * pow(p, j) * b / (s * s)
+            if j > 0:
+                a[j] = a[j - 1] * b / j
+
+        g = pw * dbeta[k - 1]
+        for j in range(k):
+            g -= pw * a[j] * (dbeta[k - 1 - j] * integral[j] + (hs[m, k - 1 - j] - beta[k - 1 - j]) * integral[j + 1])
+
+        for j in range(k):
+            conv = 0.
+            dconv = 0.
+            for l in range(j + 1):
+                conv += a[l] * (hs[m, j - l] - beta[j - l])
+                dconv += a[l] * dbeta[j - l]
+            g += u[j] * (dbeta[j] - e * conv - e * dconv)
+
+        grad[m] += g
+
+        for l in range(k):
+            u_next[l] = pw * a[k - 1 - l] * integral[k - 1 - l]
+            for j in range(l, k):
+                u_next[l] += e * u[j] * a[j - l]
+        for l in range(k):
+            u[l] = u_next[l]
+
+    return result
+
+
+cpdef np.ndarray gradient_top_k(np.ndarray lambda1, np.ndarray lambda2, int k, np.ndarray pi):
+    cdef int M = lambda1.shape[0]
+    cdef np.ndarray grad = np.zeros(M, dtype=np.double)
+
+    _top_k_row(np.ascontiguousarray(lambda1, dtype=np.double),
+               as_follower_matrix(lambda2, M), as_follower_matrix(pi, M), 0, k,
+               1., grad, np.empty((M + 1, k), dtype=np.double), np.empty((6, k + 1), dtype=np.double))
     return grad
 
 
-cdef np.ndarray gradient_top_one_numerical(np.ndarray lambda1, np.ndarray lambda2, np.ndarray pi=None):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _weighted_top_k(const double[::1] lambda1, const double[:, ::1] lambda2s, const double[:, ::1] pis,
+                            const double[::1] weights, int k, np.ndarray grad):
+    # Weighted top-k utility, whose gradient is written to grad unless it is None, with the followers split
+    # between the threads; each thread has its own scratch space and gradient row, summed at the end.
+    check_follower_matrices(lambda1, lambda2s, pis, weights)
+
+    cdef Py_ssize_t M = lambda1.shape[0], F = lambda2s.shape[0]
+    cdef int threads = _thread_count(F)
+    cdef bint with_grad = grad is not None
+    cdef double[:, :, ::1] hs = np.empty((threads, M + 1, k), dtype=np.double)
+    cdef double[:, :, ::1] work = np.empty((threads, 6, k + 1), dtype=np.double)
+    cdef double[:, ::1] grads = np.zeros((threads, M), dtype=np.double)
+
+    cdef double s = 0, v
+    cdef Py_ssize_t i
+    cdef int t
+    with nogil, parallel(num_threads=threads):
+        t = threadid()
+        for i in prange(F, schedule='static'):
+            if with_grad:
+                v = _top_k_row(lambda1, lambda2s, pis, i, k, weights[i], grads[t], hs[t], work[t])
+            else:
+                v = _top_k_row(lambda1, lambda2s, pis, i, k, weights[i], None, hs[t], work[t])
+            s += v
 
-    # h0 = np.zeros(1, dtype=np.double)  # if h0 is None else h0
-    # pi = np.ones(k, dtype=np.double) if pi is None else pi
+    if with_grad:
+        np.sum(grads, axis=0, out=grad)
+    return s
 
-    cdef int n = lambda2.shape[0]
-    cdef np.ndarray grad = np.zeros(n, dtype=np.double)
-    cdef double epsilon = 0.0001
 
-    cdef int i
-    cdef double f1, f2
-    for i in range(n):
-        if lambda1[i] >= epsilon:
-            lambda1[i] -= epsilon
-            f1 = expected_f_top_one(lambda1, lambda2, pi=pi)
-            lambda1[i] += 2. * epsilon
-            f2 = expected_f_top_one(lambda1, lambda2, pi=pi)
-            grad[i] = (f2 - f1) / (2. * epsilon)
-            lambda1[i] -= epsilon
-        else:
-            f1 = expected_f_top_one(lambda1, lambda2, pi=pi)
-            lambda1[i] += epsilon
-            f2 = expected_f_top_one(lambda1, lambda2, pi=pi)
-            grad[i] = (f2 - f1) / epsilon
-            lambda1[i] -= epsilon
+cpdef double weighted_top_k_batch(const double[::1] lambda1, const double[:, ::1] lambda2s,
+                                  const double[:, ::1] pis, const double[::1] weights, int k):
+    """
+    Weighted top-k utility of all the followers in one compiled pass, see weighted_top_one_batch.
+    """
+    return _weighted_top_k(lambda1, lambda2s, pis, weights, k, None)
+
+
+cpdef np.ndarray weighted_top_k_grad_batch(const double[::1] lambda1, const double[:, ::1] lambda2s,
+                                           const double[:, ::1] pis, const double[::1] weights, int k):
+    """
+    Exact gradient of weighted_top_k_batch, at about the cost of two evaluations.
+    """
+    cdef np.ndarray grad = np.zeros(lambda1.shape[0], dtype=np.double)
+    _weighted_top_k(lambda1, lambda2s, pis, weights, k, grad)
     return grad
 
 
-cdef double f_top_one(double t, double b, double c, double h):
-    cdef np.ndarray h_arr = np.zeros(1, dtype=np.double)
-    h_arr[0] = h
-    return f(t, 1, b, c, h_arr)[0]
+cpdef tuple weighted_top_k_value_and_grad_batch(const double[::1] lambda1, const double[:, ::1] lambda2s,
+                                                const double[:, ::1] pis, const double[::1] weights, int k):
+    """
+    (weighted_top_k_batch, weighted_top_k_grad_batch) sharing one forward pass per follower.
+    """
+    cdef np.ndarray grad = np.zeros(lambda1.shape[0], dtype=np.double)
+    return _weighted_top_k(lambda1, lambda2s, pis, weights, k, grad), grad
+
+
+cdef inline double f_top_one(double t, double b, double c, double h) nogil:
+    # same as f(t, 1, b, c, [h])[0], without allocating the one element array
+    if b + c < 1e-5:
+        return h
+
+    cdef double beta = 1. - b / (b + c)
+    return (h - beta) * exp(-(b + c) * t) + beta
 
 
 cpdef double expected_f_top_one(np.ndarray lambda1, np.ndarray lambda2, np.ndarray pi):
@@ -204,121 +369,287 @@ cpdef double expected_f_top_one(np.ndarray lambda1, np.ndarray lambda2, np.ndarr
     return e_f
 
 
-cdef np.ndarray h_values(np.ndarray lambda1, np.ndarray lambda2, np.ndarray q):
-    cdef int M = lambda1.shape[0]
-    cdef np.ndarray h = np.zeros(M + 1, dtype=np.double)
-
-    cdef int m
-    cdef double bm, cm, dt
-    for m in range(M):
-        bm = lambda2[m]
-        cm = lambda1[m]
-        dt = 1.
-        q[m] = exp(-dt * (bm + cm))
-        h[m] = f_top_one(dt, bm, cm, h[m - 1])
-
-    return h
+cdef check_follower_matrices(const double[::1] lambda1, const double[:, ::1] lambda2s, const double[:, ::1] pis,
+                             const double[::1] weights):
+    if lambda2s.shape[0] != pis.shape[0] or lambda2s.shape[0] != weights.shape[0]:
+        raise ValueError('follower matrices and weights must have the same number of rows')
+    if lambda2s.shape[1] != lambda1.shape[0] or pis.shape[1] != lambda1.shape[0]:
+        raise ValueError('follower matrices must have one column per slot of lambda1')
 
 
-cdef np.ndarray q_values(np.ndarray lambda1, np.ndarray lambda2):
-    cdef int M = lambda1.shape[0]
-    cdef np.ndarray q = np.zeros(M, dtype=np.double)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _expected_f_top_one_row(const double[::1] lambda1, const double[:, ::1] lambda2s,
+                                    const double[:, ::1] pis, Py_ssize_t i) nogil:
+    # expected_f_top_one for the i-th row of the follower matrices
+    cdef Py_ssize_t M = lambda1.shape[0]
+    cdef double e_f = 0
+    cdef double h = 0
 
-    cdef int m
-    cdef double bm, cm, dt
+    cdef Py_ssize_t m
+    cdef double bm, cm, dt, p
     for m in range(M):
-        bm = lambda2[m]
+        bm = lambda2s[i, m]
         cm = lambda1[m]
         dt = 1.
-        q[m] = exp(-dt * (bm + cm))
 
-    return q
+        if bm + cm < 1e-10:
+            e_f += h * dt * pis[i, m]
+        else:
+            p = cm / (bm + cm)
+            e_f += pis[i, m] * ((h - p) * (1. - exp(-dt * (bm + cm))) / (bm + cm) + p * dt)
+            h = f_top_one(dt, bm, cm, h)
 
+    return e_f
 
-cdef np.ndarray h_hessian_values(np.ndarray lambda1, np.ndarray lambda2, np.ndarray h, np.ndarray q):
-    cdef int M = lambda1.shape[0]
-    cdef np.ndarray dh_dc = np.zeros((M, M), dtype=np.double)
 
-    cdef int m
-    cdef double bm, cm, dt
-    for m in range(M):
-        bm = lambda2[m]
-        cm = lambda1[m]
-        dt = 1.
+cpdef double weighted_top_one_batch(const double[::1] lambda1, const double[:, ::1] lambda2s,
+                                    const double[:, ::1] pis, const double[::1] weights):
+    """
+    Weighted top-one utility of all the followers in one compiled pass.
 
-        if bm + cm == 0.:
-            dh_dc[m, m] = dt * (1 - h[m - 1])
+    :param lambda1: intensity of the broadcaster, shape (M,)
+    :param lambda2s: wall intensities of the followers, C-contiguous of shape (F, M)
+    :param pis: connection probabilities of the followers, C-contiguous of shape (F, M)
+    :param weights: weights of the followers, shape (F,)
+    """
+    return _weighted_top_one(lambda1, lambda2s, pis, weights, None)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _gradient_top_one_row(const double[::1] lambda1, const double[:, ::1] lambda2s,
+                                  const double[:, ::1] pis, Py_ssize_t i, double weight, double[::1] grad,
+                                  double[::1] h, double[::1] q) nogil:
+    # Adds weight * gradient_top_one of the i-th follower to grad, using h and q (of length M) as scratch, and
+    # returns weight * expected_f_top_one from the same forward pass.
+    # The derivative of h[m] w.r.t. lambda1[k] is dh_dc[k, k] * q[k + 1] * ... * q[m], so the contribution of
+    # the slots after k can be accumulated backwards in `tail` instead of materializing dh_dc.
+    cdef Py_ssize_t M = lambda1.shape[0]
+
+    cdef Py_ssize_t k
+    cdef double bk, ck, sk, pik, h_prev = 0., dh_dc, tail = 0., e_f = 0.
+    for k in range(M):
+        bk = lambda2s[i, k]
+        ck = lambda1[k]
+        sk = bk + ck
+        q[k] = exp(-sk)
+        if sk < 1e-10:
+            e_f += h_prev * pis[i, k]
         else:
-            dh_dc[m, m] = (1. - q[m]) * bm / ((bm + cm) ** 2) - (h[m - 1] - cm / (bm + cm)) * q[m] * dt
+            e_f += pis[i, k] * ((h_prev - ck / sk) * (1. - q[k]) / sk + ck / sk)
+        h[k] = f_top_one(1., bk, ck, h_prev)
+        h_prev = h[k]
 
-        for j in range(m + 1, M):
-            dh_dc[j, m] = q[j] * dh_dc[j - 1, m]
+    for k in range(M - 1, -1, -1):
+        bk = lambda2s[i, k]
+        ck = lambda1[k]
+        sk = bk + ck
+        pik = pis[i, k]
+        h_prev = h[k - 1] if k > 0 else 0.
+
+        if sk == 0.:
+            dh_dc = 1. - h_prev
+            grad[k] += weight * ((1. - h_prev) / 2. * pik + dh_dc * tail)
+            tail = pik + q[k] * tail
+        else:
+            dh_dc = (1. - q[k]) * bk / (sk * sk) - (h_prev - ck / sk) * q[k]
+            grad[k] += weight * ((-dh_dc * sk - h_prev + h[k] + bk) / (sk * sk) * pik + dh_dc * tail)
+            tail = pik * (1. - q[k]) / sk + q[k] * tail
 
-    return dh_dc
+    return weight * e_f
 
 
 cpdef np.ndarray gradient_top_one(np.ndarray lambda1, np.ndarray lambda2, np.ndarray pi):
     cdef int M = lambda1.shape[0]
     cdef np.ndarray grad = np.zeros(M, dtype=np.double)
-    cdef np.ndarray q = q_values(lambda1, lambda2)
-    cdef np.ndarray h = h_values(lambda1, lambda2, q)
-    cdef np.ndarray dh_dc = h_hessian_values(lambda1, lambda2, h, q)
-
-    cdef int k, m
-    cdef double bk, ck, dtk, bm, cm, dtm
-    for k in range(M):
-        bk = lambda2[k]
-        ck = lambda1[k]
-        dtk = 1.
 
-        if bk + ck == 0.:
-            grad[k] += pow(dtk, 2) * (1. - h[k - 1]) / 2. * pi[k]
-        else:
-            grad[k] += (-dh_dc[k, k] * (bk + ck) - h[k - 1] + h[k] + bk * dtk) / pow(bk + ck, 2) * pi[k]
+    _gradient_top_one_row(np.ascontiguousarray(lambda1, dtype=np.double),
+                          as_follower_matrix(lambda2, M), as_follower_matrix(pi, M), 0,
+                          1., grad, np.empty(M, dtype=np.double), np.empty(M, dtype=np.double))
+    return grad
 
-        for m in range(k + 1, M):
-            bm = lambda2[m]
-            cm = lambda1[m]
-            dtm = 1.
 
-            if bm + cm == 0.:
-                grad[k] += dtm * dh_dc[m - 1, k] * pi[m]
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _weighted_top_one(const double[::1] lambda1, const double[:, ::1] lambda2s, const double[:, ::1] pis,
+                              const double[::1] weights, np.ndarray grad):
+    # Weighted top-one utility, whose gradient is written to grad unless it is None, with the followers split
+    # between the threads as in _weighted_top_k.
+    check_follower_matrices(lambda1, lambda2s, pis, weights)
+
+    cdef Py_ssize_t M = lambda1.shape[0], F = lambda2s.shape[0]
+    cdef int threads = _thread_count(F)
+    cdef bint with_grad = grad is not None
+    cdef double[:, :, ::1] scratch = np.empty((threads, 2, M), dtype=np.double)
+    cdef double[:, ::1] grads = np.zeros((threads, M), dtype=np.double)
+
+    cdef double s = 0, v
+    cdef Py_ssize_t i
+    cdef int t
+    with nogil, parallel(num_threads=threads):
+        t = threadid()
+        for i in prange(F, schedule='static'):
+            if with_grad:
+                v = _gradient_top_one_row(lambda1, lambda2s, pis, i, weights[i], grads[t], scratch[t, 0],
+                                          scratch[t, 1])
             else:
-                grad[k] += (dh_dc[m - 1, k] - dh_dc[m, k]) / (bm + cm) * pi[m]
+                v = _expected_f_top_one_row(lambda1, lambda2s, pis, i) * weights[i]
+            s += v
+
+    if with_grad:
+        np.sum(grads, axis=0, out=grad)
+    return s
+
 
+cpdef np.ndarray weighted_top_one_grad_batch(const double[::1] lambda1, const double[:, ::1] lambda2s,
+                                             const double[:, ::1] pis, const double[::1] weights):
+    """
+    Gradient of weighted_top_one_batch, in O(M) time per follower.
+
+    :param lambda1: intensity of the broadcaster, shape (M,)
+    :param lambda2s: wall intensities of the followers, C-contiguous of shape (F, M)
+    :param pis: connection probabilities of the followers, C-contiguous of shape (F, M)
+    :param weights: weights of the followers, shape (F,)
+    """
+    cdef np.ndarray grad = np.zeros(lambda1.shape[0], dtype=np.double)
+    _weighted_top_one(lambda1, lambda2s, pis, weights, grad)
     return grad
+
+
+cpdef tuple weighted_top_one_value_and_grad_batch(const double[::1] lambda1, const double[:, ::1] lambda2s,
+                                                  const double[:, ::1] pis, const double[::1] weights):
+    """
+    (weighted_top_one_batch, weighted_top_one_grad_batch) sharing one forward pass per follower.
+    """
+    cdef np.ndarray grad = np.zeros(lambda1.shape[0], dtype=np.double)
+    return _weighted_top_one(lambda1, lambda2s, pis, weights, grad), grad
+
+
+cdef check_groups(const double[:, ::1] xs, const np.int64_t[::1] users, const double[:, ::1] lambda2s,
+                  const double[:, ::1] pis, const double[::1] weights, const np.int64_t[::1] offsets):
+    if xs.shape[0] != users.shape[0]:
+        raise ValueError('xs must have one row per user')
+    if lambda2s.shape[0] != pis.shape[0] or lambda2s.shape[0] != weights.shape[0]:
+        raise ValueError('follower matrices and weights must have the same number of rows')
+    if lambda2s.shape[1] != xs.shape[1] or pis.shape[1] != xs.shape[1]:
+        raise ValueError('follower matrices must have one column per slot of xs')
+    if offsets.shape[0] == 0 or offsets[offsets.shape[0] - 1] != lambda2s.shape[0]:
+        raise ValueError('offsets must end at the number of followers')
+
+    cdef Py_ssize_t r
+    for r in range(users.shape[0]):
+        if users[r] < 0 or users[r] >= offsets.shape[0] - 1:
+            raise ValueError('user %d out of range' % users[r])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _grouped_top_k(const double[:, ::1] xs, const np.int64_t[::1] users, const double[:, ::1] lambda2s,
+                    const double[:, ::1] pis, const double[::1] weights, const np.int64_t[::1] offsets, int k,
+                    double[::1] values, double[:, ::1] grads):
+    # values[r] (and grads[r] unless grads is None) of the weighted top-k utility of user users[r] at intensity
+    # xs[r], whose followers are the rows offsets[u]:offsets[u + 1]. Users are split between the threads, and
+    # each writes its own rows, so nothing has to be reduced. k == 1 goes through the top-k recurrences as well, so
+    # the results are those of weighted_top_k rather than of the (numerically different) weighted_top_one.
+    check_groups(xs, users, lambda2s, pis, weights, offsets)
+
+    cdef Py_ssize_t M = xs.shape[1], R = users.shape[0]
+    cdef int threads = _thread_count(R)
+    cdef bint with_grad = grads is not None
+    cdef double[:, :, ::1] hs = np.empty((threads, M + 1, k), dtype=np.double)
+    cdef double[:, :, ::1] work = np.empty((threads, 6, k + 1), dtype=np.double)
+
+    cdef Py_ssize_t r, i
+    cdef int t
+    cdef double v
+    with nogil, parallel(num_threads=threads):
+        t = threadid()
+        for r in prange(R, schedule='dynamic'):
+            v = 0.
+            for i in range(offsets[users[r]], offsets[users[r] + 1]):
+                if with_grad:
+                    v = v + _top_k_row(xs[r], lambda2s, pis, i, k, weights[i], grads[r], hs[t], work[t])
+                else:
+                    v = v + _top_k_row(xs[r], lambda2s, pis, i, k, weights[i], None, hs[t], work[t])
+            values[r] = v
+
+
+cpdef np.ndarray grouped_top_k_batch(const double[:, ::1] xs, const np.int64_t[::1] users,
+                                     const double[:, ::1] lambda2s, const double[:, ::1] pis,
+                                     const double[::1] weights, const np.int64_t[::1] offsets, int k):
+    """
+    Weighted top-k utilities of several users in one compiled pass.
+
+    :param xs: intensity of each evaluated user, shape (R, M)
+    :param users: index of each evaluated user, shape (R,)
+    :param lambda2s: wall intensities of the followers of all the users, C-contiguous of shape (F, M)
+    :param pis: connection probabilities of the followers of all the users, C-contiguous of shape (F, M)
+    :param weights: weights of the followers, shape (F,)
+    :param offsets: the followers of the u-th user are the rows offsets[u]:offsets[u + 1], shape (U + 1,)
+    :return: utility of each evaluated user, shape (R,)
+    """
+    values = np.zeros(xs.shape[0], dtype=np.double)
+    _grouped_top_k(xs, users, lambda2s, pis, weights, offsets, k, values, None)
+    return values
+
+
+cpdef tuple grouped_top_k_value_and_grad_batch(const double[:, ::1] xs, const np.int64_t[::1] users,
+                                               const double[:, ::1] lambda2s, const double[:, ::1] pis,
+                                               const double[::1] weights, const np.int64_t[::1] offsets, int k):
+    """
+    (grouped_top_k_batch, gradients of shape (R, M)) sharing one forward pass per follower.
+    """
+    values = np.zeros(xs.shape[0], dtype=np.double)
+    grads = np.zeros((xs.shape[0], xs.shape[1]), dtype=np.double)
+    _grouped_top_k(xs, users, lambda2s, pis, weights, offsets, k, values, grads)
+    return values, grads
 # </editor-fold>
 
 # <editor-fold desc="Utility Functions">
 
+def as_follower_matrix(rows, M):
+    """ Stacks per-follower vectors (or passes an (F, M) array through) as a C-contiguous double matrix """
+    return np.ascontiguousarray(rows, dtype=np.double).reshape((-1, M))
+
+
 def weighted_top_one(lambda1, lambda2_list, conn_probs, weights, *args):
-    s = 0
-    for i in range(len(lambda2_list)):
-        s += expected_f_top_one(lambda1, lambda2_list[i], conn_probs[i]) * weights[i]
-    return s
+    lambda1 = np.ascontiguousarray(lambda1, dtype=np.double)
+    M = lambda1.shape[0]
+    return weighted_top_one_batch(lambda1,
+                                  as_follower_matrix(lambda2_list, M),
+                                  as_follower_matrix(conn_probs, M),
+                                  np.ascontiguousarray(weights, dtype=np.double))
 
 
 def weighted_top_one_grad(lambda1, lambda2_list, conn_probs, weights, *args):
-    s = np.zeros(len(lambda1))
+    lambda1 = np.ascontiguousarray(lambda1, dtype=np.double)
+    M = lambda1.shape[0]
+    return weighted_top_one_grad_batch(lambda1,
+                                       as_follower_matrix(lambda2_list, M),
+                                       as_follower_matrix(conn_probs, M),
+                                       np.ascontiguousarray(weights, dtype=np.double))
 
-    for i in range(len(lambda2_list)):
-        s += gradient_top_one(lambda1, lambda2_list[i], conn_probs[i]) * weights[i]
-    return s
+
+def weighted_top_one_value_and_grad(lambda1, lambda2_list, conn_probs, weights, *args):
+    lambda1 = np.ascontiguousarray(lambda1, dtype=np.double)
+    M = lambda1.shape[0]
+    return weighted_top_one_value_and_grad_batch(lambda1,
+                                                 as_follower_matrix(lambda2_list, M),
+                                                 as_follower_matrix(conn_probs, M),
+                                                 np.ascontiguousarray(weights, dtype=np.double))
 
 
 def weighted_top_one_k(lambda1, lambda2_list, conn_probs, weights, *args):
-    s = 0
-    for i in range(len(lambda2_list)):
-        s += expected_f_top_k(lambda1, lambda2_list[i], 1, pi=conn_probs[i]) * weights[i]
-    return s
+    return weighted_top_k(lambda1, lambda2_list, conn_probs, weights, 1)
 
 
 def weighted_top_one_k_grad(lambda1, lambda2_list, conn_probs, weights, *args):
-    s = np.zeros(len(lambda1))
+    return weighted_top_k_grad(lambda1, lambda2_list, conn_probs, weights, 1)
 
-    for i in range(len(lambda2_list)):
-        s += gradient_top_one_numerical(lambda1, lambda2_list[i], pi=conn_probs[i]) * weights[i]
-    return s
+
+def weighted_top_one_k_value_and_grad(lambda1, lambda2_list, conn_probs, weights, *args):
+    return weighted_top_k_value_and_grad(lambda1, lambda2_list, conn_probs, weights, 1)
 
 
 def max_min_top_one(lambda1, lambda2_list, conn_probs, weights, *args):
@@ -361,18 +692,30 @@ def max_min_top_one_smt_grad(lambda1, lambda2_list, conn_probs, weights, *args):
 
 
 def weighted_top_k(lambda1, lambda2_list, conn_probs, weights, k, *args):
-    s = 0
-    for i in range(len(lambda2_list)):
-        s += expected_f_top_k(lambda1, lambda2_list[i], k, pi=conn_probs[i]) * weights[i]
-    return s
+    lambda1 = np.ascontiguousarray(lambda1, dtype=np.double)
+    M = lambda1.shape[0]
+    return weighted_top_k_batch(lambda1,
+                                as_follower_matrix(lambda2_list, M),
+                                as_follower_matrix(conn_probs, M),
+                                np.ascontiguousarray(weights, dtype=np.double), k)
 
 
 def weighted_top_k_grad(lambda1, lambda2_list, conn_probs, weights, k, *args):
-    s = np.zeros(len(lambda1))
-
-    for i in range(len(lambda2_list)):
-        s += gradient_top_k(lambda1, lambda2_list[i], k, pi=conn_probs[i]) * weights[i]
-    return s
+    lambda1 = np.ascontiguousarray(lambda1, dtype=np.double)
+    M = lambda1.shape[0]
+    return weighted_top_k_grad_batch(lambda1,
+                                     as_follower_matrix(lambda2_list, M),
+                                     as_follower_matrix(conn_probs, M),
+                                     np.ascontiguousarray(weights, dtype=np.double), k)
+
+
+def weighted_top_k_value_and_grad(lambda1, lambda2_list, conn_probs, weights, k, *args):
+    lambda1 = np.ascontiguousarray(lambda1, dtype=np.double)
+    M = lambda1.shape[0]
+    return weighted_top_k_value_and_grad_batch(lambda1,
+                                               as_follower_matrix(lambda2_list, M),
+                                               as_follower_matrix(conn_probs, M),
+                                               np.ascontiguousarray(weights, dtype=np.double), k)
 
 # </editor-fold>
 
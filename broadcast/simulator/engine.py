@@ -0,0 +1,133 @@
+from __future__ import division
+import multiprocessing
+import numpy as np
+
+from ..simulator.simulate import generate_piecewise_constant_poisson_process, \
+    generate_piecewise_constant_poisson_processes, connection_prefix
+from ..simulator import utils
+
+# two sided normal quantiles of the supported confidence levels
+_z_values = {0.9: 1.6448536269514722, 0.95: 1.959963984540054, 0.99: 2.5758293035489004}
+
+
+def _simulate_shard(args):
+    """
+    Runs the replicates of one shard with its own random stream.
+
+    :return: sums (and sums of squares) of the total and per-follower visibilities of each intensity
+    """
+    seed, replicates, intensities, wall_intensities, pi_prefix, weights, k = args
+    random_state = np.random.default_rng(seed)
+
+    C, M = intensities.shape
+    F = wall_intensities.shape[0]
+    follower_sum, follower_sum_sq = np.zeros((C, F)), np.zeros((C, F))
+    total_sum, total_sum_sq = np.zeros(C), np.zeros(C)
+
+    for r in range(replicates):
+        walls, wall_offsets = generate_piecewise_constant_poisson_processes(wall_intensities,
+                                                                            random_state=random_state)
+        for c in range(C):
+            process = generate_piecewise_constant_poisson_process(intensities[c], random_state=random_state)
+            visibility = utils.time_being_in_top_k_batch(process, walls, wall_offsets, k, M, pi_prefix, k + 1)
+
+            follower_sum[c] += visibility
+            follower_sum_sq[c] += visibility ** 2
+            total = np.dot(weights, visibility)
+            total_sum[c] += total
+            total_sum_sq[c] += total ** 2
+
+    return replicates, total_sum, total_sum_sq, follower_sum, follower_sum_sq
+
+
+def _mean_and_stderr(s, s_sq, n):
+    mean = s / n
+    if n < 2:
+        return mean, np.full_like(mean, np.inf)
+    var = np.maximum(s_sq / n - mean ** 2, 0.) * n / (n - 1)
+    return mean, np.sqrt(var / n)
+
+
+def simulate_visibility(intensities, wall_intensities, conn_probs, k=1, weights=None, replicates=1000,
+                        processes=1, seed=None, shard_size=50, shards_per_round=8,
+                        ci_width=None, confidence=0.95):
+    """
+    Monte-Carlo estimate of the time being in top k of the followers for one or several broadcaster intensities.
+
+    Each replicate draws one realization of every follower's wall, shared by all the intensities, and one
+    realization of each intensity. The replicates are split in shards of shard_size, shard i drawing from the i-th
+    stream spawned from seed, so the result does not depend on the number of processes. Shards are run in rounds
+    of shards_per_round and, if ci_width is given, the simulation stops after the first round at which the
+    confidence interval of the total visibility of every intensity is narrower than ci_width. The per-follower
+    means are not checked, so their intervals may still be wider.
+
+    :param intensities: intensity of the broadcaster (M,), or several of them (C, M)
+    :param wall_intensities: wall intensities of the followers (F, M)
+    :param conn_probs: connection probabilities of the followers (F, M)
+    :param weights: weights of the followers in the total visibility, ones if None
+    :param replicates: maximum number of replicates, at least 1
+    :param processes: number of worker processes, 1 runs the shards in this process (e.g. inside a pool worker)
+    :param seed: seed of the random streams
+    :param ci_width: requested width of the confidence intervals of the total visibility, positive
+    :param confidence: confidence level of the intervals, one of 0.9, 0.95 and 0.99
+    :return: dict with the number of 'replicates' run, the 'mean' and 'stderr' of the total visibility and
+             the 'follower_mean' and 'follower_stderr' of each follower's visibility
+    """
+    intensities = np.asarray(intensities, dtype=np.double)
+    single = intensities.ndim == 1
+    intensities = intensities.reshape((-1, intensities.shape[-1]))
+    wall_intensities = np.ascontiguousarray(wall_intensities, dtype=np.double)
+    pi_prefix = connection_prefix(conn_probs)
+    weights = np.ones(wall_intensities.shape[0]) if weights is None else np.asarray(weights, dtype=np.double)
+
+    if replicates < 1:
+        raise ValueError('At least one replicate is needed: %s' % replicates)
+    if ci_width is not None and ci_width <= 0.:
+        raise ValueError('The confidence interval width must be positive: %s' % ci_width)
+    if confidence not in _z_values:
+        raise ValueError('Unsupported confidence level: %s' % confidence)
+    z = _z_values[confidence]
+
+    shard_count = int(np.ceil(replicates / shard_size))
+    seeds = np.random.SeedSequence(seed).spawn(shard_count)
+    shards = [(seeds[i], min(shard_size, replicates - i * shard_size),
+               intensities, wall_intensities, pi_prefix, weights, k)
+              for i in range(shard_count)]
+
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    n = 0
+    total_sum, total_sum_sq = 0., 0.
+    follower_sum, follower_sum_sq = 0., 0.
+
+    try:
+        for start in range(0, shard_count, shards_per_round):
+            round_shards = shards[start:start + shards_per_round]
+            results = pool.map(_simulate_shard, round_shards) if pool else map(_simulate_shard, round_shards)
+
+            for result in results:
+                n += result[0]
+                total_sum, total_sum_sq = total_sum + result[1], total_sum_sq + result[2]
+                follower_sum, follower_sum_sq = follower_sum + result[3], follower_sum_sq + result[4]
+
+            mean, stderr = _mean_and_stderr(total_sum, total_sum_sq, n)
+            if ci_width is not None and np.all(2. * z * stderr <= ci_width):
+                break
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    follower_mean, follower_stderr = _mean_and_stderr(follower_sum, follower_sum_sq, n)
+
+    result = {
+        'replicates': n,
+        'mean': mean,
+        'stderr': stderr,
+        'follower_mean': follower_mean,
+        'follower_stderr': follower_stderr,
+    }
+    if single:
+        for key in ['mean', 'stderr', 'follower_mean', 'follower_stderr']:
+            result[key] = result[key][0]
+
+    return result
@@ -3,6 +3,10 @@ import numpy as np
 import traceback
 import sys
 import math
+import pyximport
+
+pyximport.install()
+from ..simulator import utils
 
 
 def generate_poisson_process(rate, time_start, time_end):
@@ -31,20 +35,59 @@ def generate_poisson_process(rate, time_start, time_end):
     return points
 
 
-def generate_piecewise_constant_poisson_process(intensity, start_time=0):
+def _slot_rates(intensity):
+    """ Rates of the unit slots, too low rates produce no events (as in generate_poisson_process) """
+    rates = np.asarray(intensity, dtype=np.double)
+    return np.where(rates < 0.1e-6, 0., rates)
+
+
+def generate_piecewise_constant_poisson_process(intensity, start_time=0, random_state=None):
+    """
+    Draws the number of events of each unit slot from a Poisson distribution and places them uniformly in the slot.
+
+    :param intensity: rate of each one hour slot
+    :param start_time: starting time in hours
+    :param random_state: a numpy random Generator (or RandomState) to draw from, the global state if None
+    :return: sorted ndarray of event times
+    """
+    random_state = np.random if random_state is None else random_state
+
+    rates = _slot_rates(intensity)
+    counts = random_state.poisson(rates)
+
+    slots = np.repeat(np.arange(len(rates)), counts)
+    return np.sort(start_time + slots + random_state.random(len(slots)))
+
+
+def generate_piecewise_constant_poisson_processes(intensity, realizations=None, start_time=0, random_state=None):
     """
-    :param start_time: starting time in datetime format
-    :return: a list
+    Draws independent realizations of generate_piecewise_constant_poisson_process at once.
+
+    :param intensity: rate of each one hour slot, or a matrix with the rates of each realization in its rows
+    :param realizations: number of realizations (the number of rows if intensity is a matrix)
+    :param start_time: starting time in hours
+    :param random_state: a numpy random Generator (or RandomState) to draw from, the global state if None
+    :return: (times, offsets) where the sorted events of the r-th realization are times[offsets[r]:offsets[r + 1]]
     """
+    random_state = np.random if random_state is None else random_state
 
-    process = []
-    end_of_last_slot = start_time
+    rates = _slot_rates(intensity)
+    if rates.ndim == 1:
+        rates = np.tile(rates, (realizations, 1))
+    elif realizations is not None and realizations != rates.shape[0]:
+        raise ValueError('%d realizations requested for %d rows of intensities' % (realizations, rates.shape[0]))
+    realizations, M = rates.shape
+    counts = random_state.poisson(rates)
 
-    for rate in intensity:
-        process += generate_poisson_process(rate, end_of_last_slot, 1. + end_of_last_slot)
-        end_of_last_slot += 1.
+    offsets = np.zeros(realizations + 1, dtype=np.int64)
+    np.cumsum(counts.sum(axis=1), out=offsets[1:])
 
-    return process
+    slots = np.tile(np.arange(M), realizations)
+    times = start_time + np.repeat(slots, counts.ravel()) + random_state.random(offsets[-1])
+    for r in range(realizations):
+        times[offsets[r]:offsets[r + 1]].sort()
+
+    return times, offsets
 
 
 def calculate_real_visibility_time(t1, t2, pi):
@@ -73,8 +116,8 @@ def time_being_in_top_k(_process1, _process2, k, end_of_time, pi, process1_initi
     time_on_top = 0
     it1 = 0
     it2 = 0
-    process1 = _process1 + [end_of_time]
-    process2 = _process2 + [end_of_time]
+    process1 = list(_process1) + [end_of_time]
+    process2 = list(_process2) + [end_of_time]
 
     if process1_initial_position is None:
         process1_position = k + 1
@@ -122,6 +165,54 @@ def time_being_in_top_k(_process1, _process2, k, end_of_time, pi, process1_initi
     return time_on_top
 
 
+def stack_walls(walls):
+    """
+    :param walls: a list with the sorted wall events of each follower
+    :return: (times, offsets) where the wall of follower f is times[offsets[f]:offsets[f + 1]]
+    """
+    offsets = np.zeros(len(walls) + 1, dtype=np.int64)
+    np.cumsum([len(wall) for wall in walls], out=offsets[1:])
+    times = np.concatenate([np.asarray(wall, dtype=np.double) for wall in walls] + [np.zeros(0)])
+    return times, offsets
+
+
+def time_being_in_top_k_many(process1, walls, k, end_of_time, pis, process1_initial_position=None,
+                             wall_offsets=None):
+    """
+    Computes time_being_in_top_k of one broadcaster realization against the walls of many followers in one
+    compiled call.
+
+    :param process1: sorted events of the broadcaster
+    :param walls: a list with the sorted wall events of each follower, or the concatenation of them
+    :param wall_offsets: if given, the wall of follower f is walls[wall_offsets[f]:wall_offsets[f + 1]]
+    :param pis: connection probability of each follower (one row per follower) or one profile shared by all of them
+    :return: ndarray with the time being in top k of each follower
+    """
+    if wall_offsets is None:
+        walls, wall_offsets = stack_walls(walls)
+
+    if process1_initial_position is None:
+        process1_initial_position = k + 1
+
+    return utils.time_being_in_top_k_batch(np.ascontiguousarray(process1, dtype=np.double),
+                                           np.ascontiguousarray(walls, dtype=np.double),
+                                           np.ascontiguousarray(wall_offsets, dtype=np.int64),
+                                           k, end_of_time, connection_prefix(pis), process1_initial_position)
+
+
+def connection_prefix(pis):
+    """
+    :param pis: connection probabilities, one row per follower or a single profile
+    :return: matrix whose [f, j] element is the sum of the first j connection probabilities of follower f
+    """
+    pis = np.asarray(pis, dtype=np.double)
+    if pis.ndim == 1:
+        pis = pis.reshape((1, -1))
+    pi_prefix = np.zeros((pis.shape[0], pis.shape[1] + 1))
+    np.cumsum(pis, axis=1, out=pi_prefix[:, 1:])
+    return pi_prefix
+
+
 def get_expectation_std_top_k_simulating(lambda1, lambda2, k, pi, number_of_iterations=10000):
     """
     This function will simulate two poisson processes with rates $\lambda_1$ and $\lambda_2$ for "number_of_iterations"
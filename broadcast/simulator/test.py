@@ -0,0 +1,102 @@
+from __future__ import division
+import unittest
+
+import numpy as np
+import pyximport; pyximport.install()
+
+from ..simulator.engine import simulate_visibility
+from ..simulator.simulate import generate_piecewise_constant_poisson_process, stack_walls, time_being_in_top_k, \
+    time_being_in_top_k_many
+
+
+class TestTimeBeingInTopK(unittest.TestCase):
+    def setUp(self):
+        self.rs = np.random.RandomState(0)
+        self.end_of_time = 24
+        self.process = np.sort(self.rs.uniform(0., self.end_of_time, 15))
+        # ragged walls, the empty ones first, in the middle and last
+        lengths = [0, 1, 40, 3, 0, 100, 7, 0]
+        self.walls = [np.sort(self.rs.uniform(0., self.end_of_time, n)) for n in lengths]
+        self.pis = self.rs.uniform(0., 1., (len(self.walls), self.end_of_time))
+
+    def expected(self, k, pis, initial_position=None):
+        return [time_being_in_top_k(self.process, wall, k, self.end_of_time, pi, initial_position)
+                for wall, pi in zip(self.walls, pis)]
+
+    def test_against_time_being_in_top_k(self):
+        for k in [1, 2, 3, 5]:
+            np.testing.assert_allclose(time_being_in_top_k_many(self.process, self.walls, k, self.end_of_time,
+                                                                self.pis),
+                                       self.expected(k, self.pis), rtol=1e-10, atol=1e-10)
+
+    def test_shared_pi_and_offsets(self):
+        walls, wall_offsets = stack_walls(self.walls)
+        for k in [1, 3]:
+            np.testing.assert_allclose(time_being_in_top_k_many(self.process, walls, k, self.end_of_time,
+                                                                self.pis[0], wall_offsets=wall_offsets),
+                                       self.expected(k, [self.pis[0]] * len(self.walls)), rtol=1e-10, atol=1e-10)
+
+    def test_initial_position(self):
+        for k, position in [(1, 1), (3, 2), (3, 4)]:
+            np.testing.assert_allclose(time_being_in_top_k_many(self.process, self.walls, k, self.end_of_time,
+                                                                self.pis, process1_initial_position=position),
+                                       self.expected(k, self.pis, position), rtol=1e-10, atol=1e-10)
+
+    def tearDown(self):
+        pass
+
+
+class TestSimulateVisibility(unittest.TestCase):
+    def setUp(self):
+        self.rs = np.random.RandomState(0)
+        self.M = 24
+        self.intensities = self.rs.uniform(0., 0.5, (2, self.M))
+        self.wall_intensities = self.rs.uniform(0., 2., (5, self.M))
+        self.conn_probs = self.rs.uniform(0., 1., (5, self.M))
+        self.weights = self.rs.uniform(0., 1., 5)
+
+    def simulate(self, **kwargs):
+        return simulate_visibility(self.intensities, self.wall_intensities, self.conn_probs, k=2,
+                                   weights=self.weights, shard_size=20, shards_per_round=2, **kwargs)
+
+    def test_pool(self):
+        # the shards draw from the same streams whichever process runs them
+        expected = self.simulate(replicates=100, seed=1)
+        result = self.simulate(replicates=100, seed=1, processes=2)
+        self.assertEqual(result['replicates'], 100)
+        for key in ['mean', 'stderr', 'follower_mean', 'follower_stderr']:
+            np.testing.assert_array_equal(result[key], expected[key])
+
+    def test_against_time_being_in_top_k_many(self):
+        replicates = 400
+        result = self.simulate(replicates=replicates, seed=2)
+
+        random_state = np.random.default_rng(3)
+        totals = np.zeros((replicates, len(self.intensities)))
+        for r in range(replicates):
+            walls = [generate_piecewise_constant_poisson_process(intensity, random_state=random_state)
+                     for intensity in self.wall_intensities]
+            for c, intensity in enumerate(self.intensities):
+                process = generate_piecewise_constant_poisson_process(intensity, random_state=random_state)
+                totals[r, c] = np.dot(self.weights, time_being_in_top_k_many(process, walls, 2, self.M,
+                                                                              self.conn_probs))
+
+        # within the 99% interval of the difference of the two independent estimates
+        stderr = np.sqrt(result['stderr'] ** 2 + np.var(totals, axis=0, ddof=1) / replicates)
+        self.assertTrue(np.all(np.abs(result['mean'] - np.mean(totals, axis=0)) <= 2.576 * stderr))
+
+    def test_early_stopping(self):
+        result = self.simulate(replicates=1000, seed=4, ci_width=2.)
+        self.assertLess(result['replicates'], 1000)
+        self.assertEqual(result['replicates'] % 40, 0)
+        self.assertTrue(np.all(2 * 1.96 * result['stderr'] <= 2.))
+
+        # not reached: every replicate runs
+        self.assertEqual(self.simulate(replicates=120, seed=4, ci_width=1e-6)['replicates'], 120)
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+from __future__ import division
+
+import numpy as np
+cimport numpy as np
+
+import cython
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline double connected_time(const double[:, ::1] pi_prefix, Py_ssize_t row, double t) nogil:
+    # integral (0..t) of the piecewise constant connection probability, pi_prefix[row, j] being its integral (0..j)
+    cdef Py_ssize_t L = pi_prefix.shape[1] - 1
+    cdef Py_ssize_t j
+
+    if t <= 0.:
+        return 0.
+    if t >= L:
+        return pi_prefix[row, L]
+
+    j = <Py_ssize_t> t
+    return pi_prefix[row, j] + (t - j) * (pi_prefix[row, j + 1] - pi_prefix[row, j])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _time_being_in_top_k(const double[::1] process, const double[::1] walls,
+                                 Py_ssize_t wall_start, Py_ssize_t wall_end, int k, double end_of_time,
+                                 const double[:, ::1] pi_prefix, Py_ssize_t row, int initial_position) nogil:
+    # same merge as simulate.time_being_in_top_k, events at or after end_of_time are ignored
+    cdef Py_ssize_t it1 = 0, it2 = wall_start, n1 = process.shape[0]
+    cdef int position = initial_position
+    cdef double t, last_time_event = 0., time_on_top = 0.
+    cdef bint from_process
+
+    while True:
+        if it1 < n1 and (it2 >= wall_end or process[it1] < walls[it2]):
+            t = process[it1]
+            from_process = True
+        elif it2 < wall_end:
+            t = walls[it2]
+            from_process = False
+        else:
+            break
+
+        if t >= end_of_time:
+            break
+
+        if position <= k:
+            time_on_top += connected_time(pi_prefix, row, t) - connected_time(pi_prefix, row, last_time_event)
+        last_time_event = t
+
+        if from_process:
+            position = 1
+            it1 += 1
+        else:
+            if position <= k:
+                position += 1
+            it2 += 1
+
+    if position <= k:
+        time_on_top += connected_time(pi_prefix, row, end_of_time) - connected_time(pi_prefix, row, last_time_event)
+
+    return time_on_top
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def time_being_in_top_k_batch(const double[::1] process, const double[::1] walls,
+                              const np.int64_t[::1] wall_offsets, int k, double end_of_time,
+                              const double[:, ::1] pi_prefix, int initial_position):
+    """
+    :param process: sorted events of the broadcaster
+    :param walls: sorted events of the followers' walls, follower f's being walls[wall_offsets[f]:wall_offsets[f + 1]]
+    :param pi_prefix: prefix sums of the connection probabilities, one row per follower or a single shared row
+    :param initial_position: position of the broadcaster in the walls at time zero
+    :return: time being in top k of every follower
+    """
+    cdef Py_ssize_t F = wall_offsets.shape[0] - 1
+    if pi_prefix.shape[0] != 1 and pi_prefix.shape[0] != F:
+        raise ValueError('connection probabilities must have one row per follower or a single row')
+
+    cdef np.ndarray result = np.zeros(F, dtype=np.double)
+    cdef double[::1] result_view = result
+    cdef Py_ssize_t f, row = 0
+
+    with nogil:
+        for f in range(F):
+            if pi_prefix.shape[0] > 1:
+                row = f
+            result_view[f] = _time_being_in_top_k(process, walls, wall_offsets[f], wall_offsets[f + 1], k,
+                                                  end_of_time, pi_prefix, row, initial_position)
+    return result
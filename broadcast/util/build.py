@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+from distutils.ccompiler import new_compiler
+from distutils.errors import CompileError, LinkError
+from distutils.sysconfig import customize_compiler
+
+_openmp_test = r'''
+#include <omp.h>
+
+int main(void) {
+    return omp_get_max_threads() > 0 ? 0 : 1;
+}
+'''
+
+_openmp_flags = None
+
+
+def openmp_flags():
+    """
+    Checks once whether the C compiler builds and links an OpenMP program with -fopenmp (the default clang of macOS
+    does not), in which case the prange loops of the extensions run in a single thread.
+
+    :return: (extra compile args, extra link args), both empty without OpenMP
+    """
+    global _openmp_flags
+    if _openmp_flags is not None:
+        return _openmp_flags
+
+    compiler = new_compiler()
+    customize_compiler(compiler)
+    path = tempfile.mkdtemp()
+    try:
+        source = os.path.join(path, 'openmp_test.c')
+        with open(source, 'w') as f:
+            f.write(_openmp_test)
+        objects = compiler.compile([source], output_dir=path, extra_postargs=['-fopenmp'])
+        compiler.link_executable(objects, os.path.join(path, 'openmp_test'), extra_postargs=['-fopenmp'])
+        _openmp_flags = (['-fopenmp'], ['-fopenmp'])
+    except (CompileError, LinkError):
+        _openmp_flags = ([], [])
+    finally:
+        shutil.rmtree(path)
+
+    return _openmp_flags
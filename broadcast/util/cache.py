@@ -0,0 +1,95 @@
+import sys
+from collections import OrderedDict
+
+import numpy as np
+
+_missing = object()
+
+
+def estimate_size(value):
+    """ Approximate number of bytes held by value (arrays are counted by their data) """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache(object):
+    """
+    Mapping bounded by its number of entries and/or the total size of its values, which evicts the least recently
+    used entries first and counts hits, misses and evictions.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=estimate_size, on_evict=None):
+        """
+        :param max_entries: maximum number of entries, unbounded if None
+        :param max_bytes: maximum total size of the values, unbounded if None
+        :param sizeof: function giving the size of a value
+        :param on_evict: function called with the key of each entry evicted to make room (not of the ones
+                         invalidated or cleared)
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._on_evict = on_evict
+        self._data = OrderedDict()
+
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, _missing)
+        if entry is _missing:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value):
+        """ Stores value, unless it is larger than max_bytes on its own """
+        size = self._sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        self.invalidate(key)
+        self._data[key] = (value, size)
+        self.bytes += size
+
+        while (self.max_entries is not None and len(self._data) > self.max_entries) or \
+                (self.max_bytes is not None and self.bytes > self.max_bytes):
+            evicted_key, (_, evicted_size) = self._data.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+            if self._on_evict is not None:
+                self._on_evict(evicted_key)
+
+    def invalidate(self, key):
+        entry = self._data.pop(key, _missing)
+        if entry is not _missing:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._data),
+            'bytes': self.bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+        }
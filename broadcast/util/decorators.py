@@ -1,13 +1,102 @@
+import weakref
 from functools import wraps
 
+from ..util.cache import LRUCache
 
-def cache_enabled(f):
-    @wraps(f)
-    def wrapper(self, *args, **kwargs):
-        attr = '_%s__%s' % (f.__name__, '_'.join([str(a) for a in args if a is not None]))
-        if not hasattr(self, attr) or getattr(self, attr) is None:
-            setattr(self, attr, f(self, *args, **kwargs))
+_missing = object()
 
-        return getattr(self, attr)
 
-    return wrapper
+def _make_key(args, kwargs):
+    """ Hashable key of a call, in which equal values of different types (e.g. 1 and 1.0) are different """
+    key = tuple((type(a), a) for a in args)
+    if kwargs:
+        key += tuple((k, type(v), v) for k, v in sorted(kwargs.items()))
+    return key
+
+
+def memoized(max_entries=None, max_bytes=None):
+    """
+    Caches the results of a method by instance and arguments in an LRU cache, which is shared by all the instances,
+    so max_entries and max_bytes bound the memory used by the method over the whole process. The entries of an
+    instance are dropped when it is garbage collected. Calls with unhashable arguments are not cached.
+
+    The decorated method gets:
+        - invalidate(instance, *args, **kwargs): drops the result of one call
+        - cache_clear(instance=None): drops the results of an instance, or all of them
+        - cache_put(instance, value, *args, **kwargs): sets the result of a call
+        - cache_info(): hits, misses, evictions and size of the cache, and the number of instances and of keys
+          tracked for them (as many as the entries, as keys are forgotten when their entry is evicted)
+
+    :param max_entries: maximum number of cached results, unbounded if None
+    :param max_bytes: maximum total size of the cached results (see util.cache.estimate_size), unbounded if None
+    """
+
+    def decorator(f):
+        instance_keys = {}  # id of the instance -> keys of its calls in the cache
+
+        def evicted(key):
+            keys = instance_keys.get(key[0])
+            if keys is not None:
+                keys.discard(key)
+
+        cache = LRUCache(max_entries, max_bytes, on_evict=evicted)
+
+        def forget(instance_id):
+            for key in instance_keys.pop(instance_id, ()):
+                cache.invalidate(key)
+
+        def put(instance, key, value):
+            instance_id = id(instance)
+            if instance_id not in instance_keys:
+                instance_keys[instance_id] = set()
+                weakref.finalize(instance, forget, instance_id)
+            cache.put(key, value)
+            # values too large for the cache are not stored
+            if key in cache:
+                instance_keys[instance_id].add(key)
+            else:
+                instance_keys[instance_id].discard(key)
+
+        @wraps(f)
+        def wrapper(self, *args, **kwargs):
+            try:
+                key = (id(self), _make_key(args, kwargs))
+                hash(key)
+            except TypeError:
+                return f(self, *args, **kwargs)
+
+            value = cache.get(key, _missing)
+            if value is _missing:
+                value = f(self, *args, **kwargs)
+                put(self, key, value)
+            return value
+
+        def invalidate(instance, *args, **kwargs):
+            key = (id(instance), _make_key(args, kwargs))
+            cache.invalidate(key)
+            instance_keys.get(id(instance), set()).discard(key)
+
+        def cache_clear(instance=None):
+            if instance is not None:
+                forget(id(instance))
+            else:
+                cache.clear()
+                for keys in instance_keys.values():
+                    keys.clear()
+
+        def cache_put(instance, value, *args, **kwargs):
+            put(instance, (id(instance), _make_key(args, kwargs)), value)
+
+        def cache_info():
+            info = cache.info()
+            info['instances'] = len(instance_keys)
+            info['instance_keys'] = sum(len(keys) for keys in instance_keys.values())
+            return info
+
+        wrapper.invalidate = invalidate
+        wrapper.cache_clear = cache_clear
+        wrapper.cache_put = cache_put
+        wrapper.cache_info = cache_info
+        return wrapper
+
+    return decorator
@@ -0,0 +1,154 @@
+import gc
+import unittest
+
+import numpy as np
+
+from ..util.cache import LRUCache
+from ..util.decorators import memoized
+
+
+class Series(object):
+    def __init__(self, length):
+        self.length = length
+        self.calls = 0
+
+    @memoized(max_bytes=3 * 800)
+    def values(self, scale=1.):
+        self.calls += 1
+        return np.arange(self.length) * scale  # 800 bytes for a length of 100
+
+    @memoized(max_entries=2)
+    def total(self, *args):
+        self.calls += 1
+        return self.length + sum(len(a) for a in args)
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_byte_cap(self):
+        cache = LRUCache(max_bytes=2 * 800)
+        cache.put('a', np.zeros(100))
+        cache.put('b', np.zeros(100))
+        cache.get('a')
+        cache.put('c', np.zeros(100))
+
+        # b is the least recently used
+        self.assertListEqual(sorted(k for k in 'abc' if k in cache), ['a', 'c'])
+        self.assertEqual(cache.bytes, 2 * 800)
+        self.assertEqual(cache.evictions, 1)
+
+        # too large to be cached at all
+        cache.put('d', np.zeros(300))
+        self.assertNotIn('d', cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_on_evict(self):
+        evicted = []
+        cache = LRUCache(max_entries=2, on_evict=evicted.append)
+        for key in 'abc':
+            cache.put(key, 1)
+        cache.invalidate('b')
+        cache.put('d', 1)
+        cache.clear()
+        self.assertListEqual(evicted, ['a'])
+
+    def test_invalidate(self):
+        cache = LRUCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('a', 2)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get('a'), 2)
+
+        cache.invalidate('a')
+        cache.invalidate('b')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.bytes, 0)
+        self.assertEqual(cache.info()['misses'], 1)
+
+
+class TestMemoized(unittest.TestCase):
+    def setUp(self):
+        Series.values.cache_clear()
+        Series.total.cache_clear()
+
+    def test_cached(self):
+        s = Series(100)
+        self.assertIs(s.values(), s.values())
+        self.assertEqual(s.calls, 1)
+
+        # equal arguments of different types are different calls
+        s.values(2)
+        s.values(2.)
+        self.assertEqual(s.calls, 3)
+
+    def test_byte_cap_eviction(self):
+        series = [Series(100) for _ in range(4)]
+        for s in series:
+            s.values()
+        info = Series.values.cache_info()
+        self.assertEqual(info['entries'], 3)
+        self.assertEqual(info['evictions'], 1)
+        self.assertLessEqual(info['bytes'], 3 * 800)
+
+        # the first one was evicted, the last one was not
+        series[0].values()
+        series[3].values()
+        self.assertEqual(series[0].calls, 2)
+        self.assertEqual(series[3].calls, 1)
+
+    def test_invalidate(self):
+        a, b = Series(100), Series(100)
+        a.values()
+        b.values()
+
+        Series.values.invalidate(a)
+        a.values()
+        b.values()
+        self.assertEqual((a.calls, b.calls), (2, 1))
+
+        Series.values.cache_clear(b)
+        b.values()
+        self.assertEqual(b.calls, 2)
+
+    def test_long_lived_instance(self):
+        # the keys of the calls evicted from the cache are forgotten
+        s = Series(1)
+        for i in range(100):
+            s.total('x' * i)
+        info = Series.total.cache_info()
+        self.assertEqual(info['evictions'], 98)
+        self.assertEqual(info['instance_keys'], 2)
+
+        # and so are the ones of values too large to be cached
+        t = Series(400)
+        t.values()
+        self.assertEqual(Series.values.cache_info()['instance_keys'], 0)
+
+    def test_cache_put(self):
+        s = Series(100)
+        Series.total.cache_put(s, -1)
+        self.assertEqual(s.total(), -1)
+        self.assertEqual(s.calls, 0)
+
+    def test_unhashable(self):
+        s = Series(1)
+        self.assertEqual(s.total([1, 2]), 3)
+        self.assertEqual(s.total([1, 2]), 3)
+        self.assertEqual(s.calls, 2)
+        self.assertEqual(Series.total.cache_info()['entries'], 0)
+
+    def test_garbage_collected(self):
+        s = Series(100)
+        s.values()
+        self.assertEqual(Series.values.cache_info()['instances'], 1)
+
+        del s
+        gc.collect()
+        info = Series.values.cache_info()
+        self.assertEqual((info['entries'], info['instances']), (0, 0))
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,8 +4,16 @@ import numpy
 from Cython.Build import cythonize
 from setuptools import Extension
 
-extensions = [Extension("opt_utils", ["broadcast/opt/*.pyx"]),
-              Extension("data_utils", ["broadcast/data/*.pyx"])]
+from broadcast.util.build import openmp_flags
+
+# the .c files are generated from the .pyx sources at build time; utils.pyx runs its prange loops in a single
+# thread when the compiler has no OpenMP
+openmp_compile_args, openmp_link_args = openmp_flags()
+extensions = [Extension('broadcast.opt.utils', ['broadcast/opt/utils.pyx'], include_dirs=[numpy.get_include()],
+                        extra_compile_args=openmp_compile_args, extra_link_args=openmp_link_args),
+              Extension('broadcast.data.helper', ['broadcast/data/helper.pyx'], include_dirs=[numpy.get_include()]),
+              Extension('broadcast.simulator.utils', ['broadcast/simulator/utils.pyx'],
+                        include_dirs=[numpy.get_include()])]
 
 setup(
     name='broadcast_ref',